@@ -87,6 +87,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Concurrent sync workers wait for the write lock instead of failing immediately
+            'timeout': 20,
+        },
     }
 }
 
@@ -150,6 +154,20 @@ GMAIL_SCOPES = [
     'https://www.googleapis.com/auth/userinfo.email'  # Get user email reliably
 ]
 
+# Incremental Gmail sync via the History API (falls back to a full sync when the cursor expires)
+GMAIL_INCREMENTAL_SYNC = os.environ.get('GMAIL_INCREMENTAL_SYNC', 'True') == 'True'
+
+# Messages fetched per Gmail HTTP batch request (Gmail allows 100, recommends <= 50)
+GMAIL_BATCH_SIZE = int(os.environ.get('GMAIL_BATCH_SIZE', 50))
+GMAIL_BATCH_MAX_RETRIES = 3
+
+# Sync only Subject/From/To/Date/labels and fetch message bodies on first access
+GMAIL_LAZY_BODIES = os.environ.get('GMAIL_LAZY_BODIES', 'False') == 'True'
+
+# Gmail push notifications: Pub/Sub topic passed to users.watch (empty = polling only)
+# e.g. projects/<project>/topics/friendlymail-gmail, with a push subscription to /webhooks/gmail/?token=...
+GMAIL_PUBSUB_TOPIC = os.environ.get('GMAIL_PUBSUB_TOPIC', '')
+
 # ========== OUTLOOK/MICROSOFT GRAPH API CONFIGURATION ==========
 OUTLOOK_CLIENT_ID = os.environ.get('OUTLOOK_CLIENT_ID')
 OUTLOOK_CLIENT_SECRET = os.environ.get('OUTLOOK_CLIENT_SECRET')
@@ -159,6 +177,14 @@ OUTLOOK_REDIRECT_URI = os.environ.get(
     'http://localhost:8000/outlook/callback/'
 )
 
+# The first delta sync of an Outlook inbox only covers mail received in the last N days
+# (use the backfill_emails command for older history)
+OUTLOOK_DELTA_INITIAL_DAYS = int(os.environ.get('OUTLOOK_DELTA_INITIAL_DAYS', 30))
+
+# Graph change notifications: public HTTPS URL of /webhooks/outlook/ (empty = polling only)
+OUTLOOK_NOTIFICATION_URL = os.environ.get('OUTLOOK_NOTIFICATION_URL', '')
+OUTLOOK_SUBSCRIPTION_MINUTES = 4230  # Requested lifetime of a subscription (~3 days)
+
 # Authority URL for Microsoft authentication
 OUTLOOK_AUTHORITY = f"https://login.microsoftonline.com/{OUTLOOK_TENANT_ID}"
 
@@ -176,6 +202,47 @@ OUTLOOK_SCOPES = [
 # ========== AI/LLM CONFIGURATION ==========
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o-mini')  # More cost-effective for email analysis
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None  # Alternative endpoint (e.g. a local fake for tests)
+
+# Emails analyzed in parallel per batch
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', 4))
+
+# OpenAI rate limits per model, shared by all the analyzers of a process (0 = unlimited)
+# Models not listed use AI_REQUESTS_PER_MINUTE / AI_TOKENS_PER_MINUTE
+AI_REQUESTS_PER_MINUTE = int(os.environ.get('AI_REQUESTS_PER_MINUTE', 500))
+AI_TOKENS_PER_MINUTE = int(os.environ.get('AI_TOKENS_PER_MINUTE', 200000))
+OPENAI_RATE_LIMITS = {
+    'gpt-4o-mini': {'rpm': AI_REQUESTS_PER_MINUTE, 'tpm': AI_TOKENS_PER_MINUTE},
+}
+
+# Retries of transient OpenAI errors (429, timeouts, 5xx) with exponential backoff / Retry-After
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', 4))
+AI_RETRY_BASE_SECONDS = 1.0
+AI_RETRY_MAX_SECONDS = 60.0
+
+# Emails whose analysis still failed transiently are re-analyzed by retry_ai_failures
+AI_RETRY_INTERVAL_MINUTES = int(os.environ.get('AI_RETRY_INTERVAL_MINUTES', 15))
+
+# Reuse intent analyses of identical content under the same role configuration (0 hours = disabled)
+AI_ANALYSIS_CACHE_TTL_HOURS = int(os.environ.get('AI_ANALYSIS_CACHE_TTL_HOURS', 24))
+AI_ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get('AI_ANALYSIS_CACHE_MAX_ENTRIES', 10000))
+
+# Token budget of the cleaned email body sent to the model (analysis / response generation)
+AI_ANALYSIS_BODY_TOKENS = int(os.environ.get('AI_ANALYSIS_BODY_TOKENS', 500))
+AI_RESPONSE_BODY_TOKENS = int(os.environ.get('AI_RESPONSE_BODY_TOKENS', 400))
+
+# Analyze intent and draft the reply in a single completion instead of two
+AI_COMBINED_ANALYSIS = os.environ.get('AI_COMBINED_ANALYSIS', 'False') == 'True'
+
+# Decide obvious emails (allowed domains, no-reply, bulk mail) locally, without calling OpenAI
+AI_TRIAGE_ENABLED = os.environ.get('AI_TRIAGE_ENABLED', 'True') == 'True'
+
+# OpenAI Batch API backlog processing (process_ai_backlog command)
+AI_BATCH_MAX_REQUESTS = int(os.environ.get('AI_BATCH_MAX_REQUESTS', 50000))  # OpenAI limit per batch
+AI_BATCH_COMPLETION_WINDOW = '24h'
+
+# Compiled temporal rule indexes are rebuilt at least this often (picks up edits from other processes)
+TEMPORAL_RULE_INDEX_MAX_AGE_SECONDS = 300
 
 # Authentication Settings
 LOGIN_URL = 'login'
@@ -227,4 +294,47 @@ SCHEDULER_AUTOSTART = True
 SCHEDULER_DEFAULT = True
 
 # Auto-sync interval in minutes
-AUTO_SYNC_INTERVAL_MINUTES = 20
\ No newline at end of file
+AUTO_SYNC_INTERVAL_MINUTES = 20
+
+# Accounts synced in parallel by auto_sync_emails, and the cap per provider
+AUTO_SYNC_MAX_WORKERS = int(os.environ.get('AUTO_SYNC_MAX_WORKERS', 8))
+AUTO_SYNC_PROVIDER_CONCURRENCY = {
+    'gmail': int(os.environ.get('AUTO_SYNC_GMAIL_CONCURRENCY', 4)),
+    'outlook': int(os.environ.get('AUTO_SYNC_OUTLOOK_CONCURRENCY', 4)),
+}
+
+# Background job queue (manage.py run_workers)
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 4))
+JOB_POLL_SECONDS = 2
+JOB_LEASE_SECONDS = 300  # Renewed while the job runs; a job whose worker died is claimed again after it
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 30
+JOB_RETRY_MAX_SECONDS = 3600
+
+# Outbound queue: send attempts per response and per-account send rates (provider quotas)
+SEND_MAX_ATTEMPTS = 5
+SEND_RATE_LIMITS = {
+    'gmail': {'per_minute': 20, 'per_day': int(os.environ.get('GMAIL_SEND_PER_DAY', 500))},
+    'outlook': {'per_minute': 30, 'per_day': int(os.environ.get('OUTLOOK_SEND_PER_DAY', 10000))},
+}
+
+# Database locks (auto_sync, sync-account:<id>...): renewed while held, free this long after a crash
+LOCK_TTL_SECONDS = 120
+
+# Microsoft Graph HTTP client: pooled connections, timeouts and 429/503 retries of idempotent calls (Retry-After)
+GRAPH_HTTP_POOL_SIZE = int(os.environ.get('GRAPH_HTTP_POOL_SIZE', 10))
+GRAPH_CONNECT_TIMEOUT_SECONDS = 5
+GRAPH_TIMEOUT_SECONDS = 30
+GRAPH_MAX_RETRIES = 3
+GRAPH_MAX_RETRY_AFTER_SECONDS = 60  # Longer waits fail the call and the job queue retries it later
+
+# Access tokens expiring within this margin are refreshed in the background (checked every interval)
+TOKEN_REFRESH_MARGIN_SECONDS = 600
+TOKEN_REFRESH_INTERVAL_SECONDS = 120
+
+# Push notification webhooks: shared secret expected in the ?token= of push requests
+PUSH_VERIFICATION_TOKEN = os.environ.get('PUSH_VERIFICATION_TOKEN', '')
+
+# Watches/subscriptions expiring within this window are renewed (checked every few hours)
+MAIL_WATCH_RENEW_BEFORE_HOURS = 24
+MAIL_WATCH_RENEW_INTERVAL_HOURS = 6
\ No newline at end of file
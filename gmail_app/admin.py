@@ -1,6 +1,6 @@
-from django.contrib import admin
-from .models import EmailAccount, GmailAccount, Email
-from .ai_models import TemporalRule, EmailIntent, AIResponse, AIStats
+from django.contrib import admin, messages
+from .models import EmailAccount, GmailAccount, Email, Job, Lease
+from .ai_models import TemporalRule, EmailIntent, AIResponse, AIStats, AIAnalysisCache, AIBatchJob
 
 
 @admin.register(EmailAccount)
@@ -21,15 +21,53 @@ class GmailAccountAdmin(admin.ModelAdmin):
 @admin.register(Email)
 class EmailAdmin(admin.ModelAdmin):
     list_display = ['subject', 'sender', 'email_account', 'received_date', 'is_read']
-    list_filter = ['is_read', 'is_important', 'received_date']
+    list_filter = ['is_read', 'is_important', 'is_bulk', 'received_date']
     search_fields = ['subject', 'sender', 'body_plain']
     readonly_fields = ['provider_id', 'thread_id', 'created_at']
+    actions = ['submit_ai_batch']
+
+    @admin.action(description='Process with AI (OpenAI Batch API)')
+    def submit_ai_batch(self, request, queryset):
+        from .ai_batch import AIBatchProcessor
+
+        processor = AIBatchProcessor()
+        emails = list(processor.pending_emails().filter(id__in=queryset.values('id')))
+        result = processor.submit(emails)
+        self.message_user(
+            request,
+            f"{result['decided_locally']} emails decided locally, "
+            f"{result['submitted']} submitted in {len(result['jobs'])} batch jobs"
+        )
 
     def get_queryset(self, request):
         # Optimize with select_related
         return super().get_queryset(request).select_related('email_account', 'gmail_account')
 
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'status', 'user', 'priority', 'attempts', 'run_after', 'locked_by', 'created_at']
+    list_filter = ['kind', 'status', 'created_at']
+    search_fields = ['dedupe_key', 'last_error', 'user__username']
+    readonly_fields = ['locked_by', 'lease_expires_at', 'result', 'created_at', 'updated_at', 'finished_at']
+    actions = ['requeue_jobs']
+
+    @admin.action(description='Run selected jobs again')
+    def requeue_jobs(self, request, queryset):
+        from django.utils import timezone
+
+        requeued = queryset.filter(status='failed').update(
+            status='queued', attempts=0, run_after=timezone.now(), locked_by='', lease_expires_at=None
+        )
+        self.message_user(request, f"{requeued} failed jobs queued again")
+
+
+@admin.register(Lease)
+class LeaseAdmin(admin.ModelAdmin):
+    list_display = ['name', 'owner', 'acquired_at', 'renewed_at', 'expires_at']
+    search_fields = ['name', 'owner']
+
+
 @admin.register(TemporalRule)
 class TemporalRuleAdmin(admin.ModelAdmin):
     list_display = ['name', 'ai_context', 'start_date', 'end_date', 'status', 'priority']
@@ -40,15 +78,54 @@ class TemporalRuleAdmin(admin.ModelAdmin):
 @admin.register(EmailIntent)
 class EmailIntentAdmin(admin.ModelAdmin):
     list_display = ['email', 'intent_type', 'ai_decision', 'confidence_score', 'processed_at']
-    list_filter = ['intent_type', 'ai_decision', 'processed_at']
+    list_filter = ['intent_type', 'ai_decision', 'is_transient_failure', 'processed_at']
     search_fields = ['email__subject', 'decision_reason']
 
 
+@admin.register(AIAnalysisCache)
+class AIAnalysisCacheAdmin(admin.ModelAdmin):
+    list_display = ['key', 'ai_role', 'intent_type', 'ai_decision', 'hit_count', 'created_at', 'last_used_at']
+    list_filter = ['ai_decision', 'created_at']
+    readonly_fields = ['key', 'created_at', 'last_used_at']
+
+
+@admin.register(AIBatchJob)
+class AIBatchJobAdmin(admin.ModelAdmin):
+    list_display = ['openai_batch_id', 'phase', 'status', 'user', 'request_count',
+                    'completed_count', 'failed_count', 'created_at', 'applied_at']
+    list_filter = ['phase', 'status', 'created_at']
+    readonly_fields = ['openai_batch_id', 'input_file_id', 'output_file_id', 'error_file_id',
+                       'email_ids', 'created_at', 'updated_at', 'applied_at']
+    actions = ['poll_jobs', 'cancel_jobs']
+
+    @admin.action(description='Poll selected jobs (apply finished results)')
+    def poll_jobs(self, request, queryset):
+        from .ai_batch import AIBatchProcessor
+
+        applied = AIBatchProcessor().poll(queryset.filter(applied_at__isnull=True))
+        self.message_user(request, f"{len(applied)} batch jobs applied")
+
+    @admin.action(description='Cancel selected jobs')
+    def cancel_jobs(self, request, queryset):
+        from .ai_batch import AIBatchProcessor
+
+        processor = AIBatchProcessor()
+        cancelled = 0
+        for job in queryset.exclude(status__in=AIBatchJob.TERMINAL_STATUSES + ['cancelling']):
+            try:
+                processor.cancel(job)
+                cancelled += 1
+            except Exception as e:
+                self.message_user(request, f"Could not cancel {job.openai_batch_id}: {e}", messages.ERROR)
+        self.message_user(request, f"{cancelled} batch jobs cancelling")
+
+
 @admin.register(AIResponse) 
 class AIResponseAdmin(admin.ModelAdmin):
-    list_display = ['email_intent', 'status', 'generated_at', 'sent_at']
+    list_display = ['email_intent', 'status', 'send_attempts', 'generated_at', 'sent_at']
     list_filter = ['status', 'generated_at', 'sent_at']
-    search_fields = ['response_text', 'response_subject']
+    search_fields = ['response_text', 'response_subject', 'idempotency_key', 'provider_message_id']
+    readonly_fields = ['idempotency_key', 'provider_message_id', 'send_attempts', 'last_send_error']
 
 
 @admin.register(AIStats)
@@ -0,0 +1,330 @@
+"""
+Offline backlog processing with the OpenAI Batch API
+
+Unprocessed emails are packaged into JSONL batch files (half the price of synchronous calls,
+separate and much higher rate limits). Results are polled later and written with bulk inserts:
+
+1. submit: emails decided locally (no role, triage, analysis cache) are saved right away;
+   the rest go to an 'analysis' job.
+2. poll: a finished analysis job creates the EmailIntent rows and submits a 'response' job for
+   the emails the model decided to respond to; a finished response job creates the AIResponse
+   rows (pending approval).
+
+The OpenAI client can be injected (or pointed at another endpoint with OPENAI_BASE_URL), so a
+local fake batch endpoint can stand in for OpenAI.
+"""
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .ai_models import AIRole, EmailIntent, AIResponse, AIBatchJob
+from .ai_service import EmailAIProcessor
+from .gmail_service import ensure_email_body
+from .models import Email
+from .rule_matcher import match_temporal_rule
+
+logger = logging.getLogger('gmail_app')
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+
+class AIBatchProcessor:
+    """Submits email backlogs to the OpenAI Batch API and applies the results"""
+
+    def __init__(self, client=None):
+        self.processor = EmailAIProcessor(max_concurrency=1)
+        self.analyzer = self.processor.analyzer
+        self.client = client or self.analyzer.client
+        self.max_requests = getattr(settings, 'AI_BATCH_MAX_REQUESTS', 50000)
+        self.completion_window = getattr(settings, 'AI_BATCH_COMPLETION_WINDOW', '24h')
+
+    # ========== SUBMIT ==========
+
+    def pending_emails(self, user=None):
+        """Emails without EmailIntent that are not part of a pending batch job"""
+        emails = Email.objects.exclude(
+            id__in=EmailIntent.objects.values('email_id')
+        ).select_related('email_account__user', 'gmail_account__user')
+        if user:
+            emails = emails.filter(Q(email_account__user=user) | Q(gmail_account__user=user))
+
+        in_flight = set()
+        for email_ids in AIBatchJob.objects.filter(
+            phase='analysis', applied_at__isnull=True
+        ).values_list('email_ids', flat=True):
+            in_flight.update(email_ids)
+        return emails.exclude(id__in=in_flight)
+
+    def submit_backlog(self, user=None, limit=None):
+        """
+        Submit every unprocessed email of user (or of all users)
+
+        Returns:
+            dict: {'decided_locally', 'submitted', 'jobs'}
+        """
+        emails = self.pending_emails(user).order_by('-received_date')
+        if limit:
+            emails = emails[:limit]
+        return self.submit(list(emails), user=user)
+
+    def submit(self, emails, user=None):
+        """
+        Decide what can be decided locally and submit the rest as analysis jobs
+
+        Returns:
+            dict: {'decided_locally', 'submitted', 'jobs'}
+        """
+        roles = {}
+        plans = {}
+        to_analyze = []
+        for email in emails:
+            ai_role = self.processor._get_ai_role(email, roles)
+            if not isinstance(ai_role, AIRole):
+                plans[email.id] = self.processor.role_missing_plan(ai_role)
+                continue
+
+            ensure_email_body(email)
+            plan = self.processor.triage(email, ai_role) or self._cached_plan(email, ai_role)
+            if plan:
+                plans[email.id] = plan
+            else:
+                to_analyze.append((email, ai_role))
+
+        new_intents, _ = self.processor.save_plans(emails, plans)
+        jobs = self._submit_responses(
+            [intent for intent in new_intents.values() if intent.ai_decision == 'respond'], user
+        )
+
+        for chunk in self._chunks(to_analyze):
+            lines = [
+                self._request_line('analysis', email, self.analyzer.analysis_request(email, ai_role))
+                for email, ai_role in chunk
+            ]
+            jobs.append(self._create_job('analysis', [email.id for email, _ in chunk], lines, user))
+
+        logger.info(
+            f"AI backlog: {len(plans)} emails decided locally, {len(to_analyze)} submitted "
+            f"in {len(jobs)} batch jobs"
+        )
+        return {'decided_locally': len(plans), 'submitted': len(to_analyze), 'jobs': jobs}
+
+    def _cached_plan(self, email, ai_role):
+        """Plan from a fresh analysis cache entry, or None"""
+        cache_key = self.analyzer._analysis_cache_key(email, ai_role)
+        cached = self.analyzer._get_cached_analysis(cache_key, time.time())
+        if not cached:
+            return None
+        return self.processor.make_plan(cached, match_temporal_rule(email, ai_role))
+
+    def _submit_responses(self, intents, user=None, parent=None):
+        """Submit response jobs for EmailIntents decided as 'respond'"""
+        roles = {}
+        requests = []
+        for intent in intents:
+            email = intent.email
+            ai_role = self.processor._get_ai_role(email, roles)
+            if isinstance(ai_role, AIRole):
+                requests.append((email, self.analyzer.response_request(email, ai_role, intent.matched_rule)))
+
+        jobs = []
+        for chunk in self._chunks(requests):
+            lines = [self._request_line('response', email, request) for email, request in chunk]
+            jobs.append(self._create_job('response', [email.id for email, _ in chunk], lines, user, parent))
+        return jobs
+
+    def _request_line(self, phase, email, request):
+        """One JSONL line of a batch input file"""
+        return {
+            'custom_id': f'{phase}-{email.id}',
+            'method': 'POST',
+            'url': BATCH_ENDPOINT,
+            'body': {'model': self.analyzer.model, **request}
+        }
+
+    def _create_job(self, phase, email_ids, lines, user=None, parent=None):
+        """Upload the JSONL file, create the OpenAI batch and record it"""
+        payload = '\n'.join(json.dumps(line) for line in lines).encode('utf-8')
+        input_file = self.client.files.create(file=(f'{phase}.jsonl', payload), purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+            metadata={'phase': phase}
+        )
+
+        job = AIBatchJob.objects.create(
+            user=user,
+            parent=parent,
+            phase=phase,
+            status=batch.status,
+            openai_batch_id=batch.id,
+            input_file_id=input_file.id,
+            email_ids=email_ids,
+            request_count=len(lines)
+        )
+        logger.info(f"Submitted {phase} batch {batch.id} with {len(lines)} emails")
+        return job
+
+    def _chunks(self, items):
+        """Split items into batches of at most AI_BATCH_MAX_REQUESTS"""
+        return [items[i:i + self.max_requests] for i in range(0, len(items), self.max_requests)]
+
+    # ========== POLL ==========
+
+    def poll(self, jobs=None):
+        """
+        Refresh pending jobs and apply the finished ones
+
+        Returns:
+            list: Jobs whose results were applied in this call
+        """
+        if jobs is None:
+            jobs = AIBatchJob.objects.filter(applied_at__isnull=True).order_by('created_at')
+
+        applied = []
+        for job in jobs:
+            try:
+                if self.refresh(job):
+                    applied.append(job)
+            except Exception as e:
+                logger.error(f"Error polling batch {job.openai_batch_id}: {e}")
+        return applied
+
+    def refresh(self, job):
+        """
+        Update job from OpenAI and apply its results once it reaches a terminal state
+
+        Returns:
+            bool: True when the results were applied
+        """
+        if job.applied_at:
+            return False
+
+        batch = self.client.batches.retrieve(job.openai_batch_id)
+        job.status = batch.status
+        job.output_file_id = batch.output_file_id or ''
+        job.error_file_id = batch.error_file_id or ''
+        if batch.request_counts:
+            job.completed_count = batch.request_counts.completed
+            job.failed_count = batch.request_counts.failed
+        if batch.errors and batch.errors.data:
+            job.error_message = '; '.join(error.message or error.code or '' for error in batch.errors.data)
+        job.save()
+
+        if job.status not in AIBatchJob.TERMINAL_STATUSES:
+            return False
+
+        self.apply(job)
+        return True
+
+    def cancel(self, job):
+        """Ask OpenAI to stop the job (results completed so far are applied on the next poll)"""
+        batch = self.client.batches.cancel(job.openai_batch_id)
+        job.status = batch.status
+        job.save(update_fields=['status', 'updated_at'])
+
+    def apply(self, job):
+        """
+        Write the results of a finished job. Emails without a result (failed or expired batch)
+        or whose request failed get no EmailIntent, so they are picked up by the next submit.
+        """
+        results = self._read_results(job)
+        if job.phase == 'analysis':
+            self._apply_analysis(job, results)
+        else:
+            self._apply_responses(results)
+
+        job.applied_at = timezone.now()
+        job.save(update_fields=['applied_at', 'updated_at'])
+        logger.info(f"Applied {job.phase} batch {job.openai_batch_id}: {len(results)} results")
+
+    def _read_results(self, job):
+        """
+        Results of the output and error files
+
+        Returns:
+            dict: {email_id: (message content or None, error or None)}
+        """
+        results = {}
+        for file_id in (job.output_file_id, job.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                email_id = int(record['custom_id'].rpartition('-')[2])
+                response = record.get('response') or {}
+                body = response.get('body') or {}
+
+                if response.get('status_code') == 200:
+                    results[email_id] = (body['choices'][0]['message']['content'], None)
+                else:
+                    error = record.get('error') or body.get('error') or {}
+                    results[email_id] = (None, error.get('message') or f"HTTP {response.get('status_code')}")
+        return results
+
+    def _apply_analysis(self, job, results):
+        """Create the EmailIntents of an analysis job and submit the follow-up response job"""
+        emails = list(
+            Email.objects.filter(id__in=results)
+            .exclude(id__in=EmailIntent.objects.values('email_id'))
+            .select_related('email_account__user', 'gmail_account__user')
+        )
+
+        roles = {}
+        plans = {}
+        for email in emails:
+            ai_role = self.processor._get_ai_role(email, roles)
+            if not isinstance(ai_role, AIRole):
+                plans[email.id] = self.processor.role_missing_plan(ai_role)
+                continue
+
+            content, error = results[email.id]
+            if error:
+                # Failed request (429, 5xx...): no EmailIntent, so the next submit sends it again
+                logger.warning(f"Batch analysis failed for email {email.id}, left for the next submit: {error}")
+                continue
+            try:
+                analysis = self.analyzer.parse_analysis(content, 0)
+                self.analyzer._store_cached_analysis(
+                    self.analyzer._analysis_cache_key(email, ai_role), ai_role, analysis
+                )
+            except Exception as e:
+                analysis = self.analyzer.failed_analysis(e, 0)
+
+            plans[email.id] = self.processor.make_plan(analysis, match_temporal_rule(email, ai_role))
+
+        new_intents, _ = self.processor.save_plans(emails, plans)
+        self._submit_responses(
+            [intent for intent in new_intents.values() if intent.ai_decision == 'respond'],
+            job.user,
+            parent=job
+        )
+
+    def _apply_responses(self, results):
+        """Create the AIResponses (pending approval) of a response job"""
+        intents = EmailIntent.objects.filter(
+            email_id__in=results, airesponse__isnull=True
+        ).select_related('email__email_account__user', 'email__gmail_account__user')
+
+        roles = {}
+        new_responses = []
+        for intent in intents:
+            content, error = results[intent.email_id]
+            if content is None:
+                logger.error(f"Batch response failed for email {intent.email_id}: {error}")
+                ai_role = self.processor._get_ai_role(intent.email, roles)
+                content = self.analyzer.fallback_response(ai_role if isinstance(ai_role, AIRole) else None)
+
+            new_responses.append(AIResponse(
+                email_intent=intent,
+                response_text=content.strip(),
+                response_subject=f"Re: {intent.email.subject}",
+                status='pending_approval'
+            ))
+        AIResponse.objects.bulk_create(new_responses)
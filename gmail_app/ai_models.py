@@ -262,11 +262,111 @@ class EmailIntent(models.Model):
     # AI processing
     processed_at = models.DateTimeField(auto_now_add=True)
     processing_time_ms = models.IntegerField(help_text="Time taken for AI analysis")
+    is_transient_failure = models.BooleanField(
+        default=False,
+        db_index=True,
+        help_text="Analysis failed with a transient error (rate limit, timeout); retried by retry_ai_failures"
+    )
     
     def __str__(self):
         return f"{self.email.subject[:50]} - {self.intent_type} ({self.ai_decision})"
 
 
+class AIAnalysisCache(models.Model):
+    """
+    Cached intent analysis keyed by a hash of the prompt inputs
+    (role configuration version + sender domain + subject + truncated body)
+    """
+
+    key = models.CharField(max_length=64, unique=True)
+    ai_role = models.ForeignKey(AIRole, on_delete=models.CASCADE, related_name='analysis_cache')
+
+    # Cached analysis
+    intent_type = models.CharField(max_length=50)
+    confidence_score = models.FloatField()
+    ai_decision = models.CharField(max_length=20)
+    decision_reason = models.TextField()
+
+    # Usage (for TTL and size-bounded eviction)
+    hit_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.key[:12]} - {self.intent_type} ({self.ai_decision}, {self.hit_count} hits)"
+
+
+class AIBatchJob(models.Model):
+    """
+    OpenAI Batch API job processing a backlog of emails offline
+
+    An 'analysis' job classifies emails; when its results are applied, the emails the model
+    decided to respond to are sent in a follow-up 'response' job.
+    """
+
+    PHASES = [
+        ('analysis', 'Intent analysis'),
+        ('response', 'Response generation')
+    ]
+
+    # Mirrors the OpenAI batch status
+    STATUS_CHOICES = [
+        ('validating', 'Validating'),
+        ('in_progress', 'In progress'),
+        ('finalizing', 'Finalizing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+        ('expired', 'Expired'),
+        ('cancelling', 'Cancelling'),
+        ('cancelled', 'Cancelled')
+    ]
+
+    # OpenAI stops working on the batch in these states (partial results may exist)
+    TERMINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, null=True, blank=True, related_name='ai_batch_jobs',
+        help_text="Owner of the emails, empty when the job covers every user"
+    )
+    parent = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='follow_ups',
+        help_text="Analysis job that produced this response job"
+    )
+    phase = models.CharField(max_length=20, choices=PHASES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='validating')
+
+    # OpenAI identifiers
+    openai_batch_id = models.CharField(max_length=100, unique=True)
+    input_file_id = models.CharField(max_length=100)
+    output_file_id = models.CharField(max_length=100, blank=True)
+    error_file_id = models.CharField(max_length=100, blank=True)
+
+    # Emails in the job (they are not submitted again while it is pending)
+    email_ids = models.JSONField(default=list)
+
+    # Progress
+    request_count = models.IntegerField(default=0)
+    completed_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True)
+
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    applied_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="When the results were written as EmailIntent/AIResponse rows"
+    )
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "AI Batch Job"
+        verbose_name_plural = "AI Batch Jobs"
+
+    def __str__(self):
+        return f"{self.phase} batch {self.openai_batch_id} - {self.status} ({self.request_count} emails)"
+
+
 class AIResponse(models.Model):
     """AI-generated responses"""
     
@@ -291,7 +391,18 @@ class AIResponse(models.Model):
     
     # User actions
     approved_at = models.DateTimeField(null=True, blank=True)
-    sent_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # Outbound queue (see gmail_app.outbox)
+    idempotency_key = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        help_text="Message-ID header of the reply; a retry first looks for it in the mailbox so it is never sent twice"
+    )
+    provider_message_id = models.CharField(max_length=255, blank=True, default='', help_text="ID of the sent message")
+    send_attempts = models.IntegerField(default=0)
+    last_send_error = models.TextField(blank=True)
     
     # Feedback
     user_feedback = models.TextField(blank=True, help_text="User feedback on AI response quality")
@@ -0,0 +1,162 @@
+"""
+Rate limiting and retries for OpenAI calls
+
+All analyzers of a process share one token bucket per model, limited by requests per minute
+and tokens per minute (OPENAI_RATE_LIMITS). A 429 pauses the whole bucket for the time the
+API asks (Retry-After), so concurrent workers back off together instead of hammering the
+limit. Transient errors are retried with exponential backoff; when retries are exhausted the
+caller records the failure as transient so the email is analyzed again later
+(see the retry_ai_failures command).
+"""
+import random
+import threading
+import time
+import logging
+
+import openai
+from django.conf import settings
+
+logger = logging.getLogger('gmail_app')
+
+# Errors worth retrying: rate limits, timeouts, connection problems and 5xx responses
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Token bucket with two budgets (requests and tokens per minute), refilled continuously
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int):
+        """Block until one request of `tokens` tokens fits in both budgets"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                waits = [self._paused_until - now]
+                if self.requests_per_minute and self._requests < 1:
+                    waits.append((1 - self._requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self._tokens < tokens:
+                    waits.append((tokens - self._tokens) * 60 / self.tokens_per_minute)
+
+                wait = max(waits)
+                if wait <= 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+            time.sleep(min(max(wait, 0.05), 60))
+
+    def pause(self, seconds: float):
+        """Stop every caller for `seconds` (the API reported a rate limit)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # The API says the budget is spent, whatever our estimate was
+            self._requests = min(self._requests, 0)
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """Process-wide limiter for model (OPENAI_RATE_LIMITS, falling back to the defaults)"""
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = getattr(settings, 'OPENAI_RATE_LIMITS', {}).get(model, {})
+            _limiters[model] = RateLimiter(
+                requests_per_minute=limits.get('rpm', getattr(settings, 'AI_REQUESTS_PER_MINUTE', 0)),
+                tokens_per_minute=limits.get('tpm', getattr(settings, 'AI_TOKENS_PER_MINUTE', 0)),
+            )
+        return _limiters[model]
+
+
+def is_transient_error(error) -> bool:
+    """Whether an OpenAI error may succeed if the same request is made again later"""
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def _is_retryable_now(error) -> bool:
+    """Transient and worth retrying right away (an exhausted quota won't recover in seconds)"""
+    if isinstance(error, openai.RateLimitError) and getattr(error, 'code', None) == 'insufficient_quota':
+        return False
+    return is_transient_error(error)
+
+
+def _retry_after(error):
+    """Seconds the API asked us to wait (retry-after-ms / retry-after headers), or None"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def call_with_retries(call, rate_limiter: RateLimiter = None, tokens: int = 0):
+    """
+    Run an OpenAI call under the rate limiter, retrying transient errors with exponential backoff
+
+    Args:
+        call: function making the request
+        rate_limiter: shared limiter (None = unlimited)
+        tokens: estimated tokens of the request (prompt + completion allowance)
+
+    Returns:
+        The result of call()
+
+    Raises:
+        The last error when it is not transient or retries are exhausted
+    """
+    max_retries = getattr(settings, 'AI_MAX_RETRIES', 4)
+    base_delay = getattr(settings, 'AI_RETRY_BASE_SECONDS', 1.0)
+    max_delay = getattr(settings, 'AI_RETRY_MAX_SECONDS', 60.0)
+
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire(tokens)
+        try:
+            return call()
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable_now(e):
+                raise
+
+            delay = _retry_after(e)
+            if delay is None:
+                # Exponential backoff with jitter
+                delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if isinstance(e, openai.RateLimitError) and rate_limiter:
+                rate_limiter.pause(delay)
+
+            attempt += 1
+            logger.warning(f"OpenAI call failed ({e.__class__.__name__}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
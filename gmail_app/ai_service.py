@@ -2,17 +2,29 @@
 AI Service for email intent analysis and response generation
 """
 import json
+import hashlib
 import logging
 import time
-from typing import Dict, Any, Tuple
-from datetime import datetime, timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
 
 from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
 from django.utils import timezone as django_timezone
 from openai import OpenAI
 
-from .ai_models import AIRole, TemporalRule, EmailIntent, AIResponse
+from .ai_models import AIRole, TemporalRule, EmailIntent, AIResponse, AIAnalysisCache
 from .models import Email
+from .gmail_service import ensure_email_body
+from .rule_matcher import match_temporal_rule
+from .triage import triage_email
+from . import prompts
+from .text_cleaning import body_for_prompt
+from .ai_rate_limit import RateLimiter, get_rate_limiter, call_with_retries, is_transient_error
 
 logger = logging.getLogger('gmail_app')
 
@@ -20,9 +32,52 @@ logger = logging.getLogger('gmail_app')
 class AIEmailAnalyzer:
     """AI-powered email analyzer using OpenAI"""
 
-    def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+    def __init__(self, rate_limiter: RateLimiter = None):
+        self.client = OpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=getattr(settings, 'OPENAI_BASE_URL', None),
+            max_retries=0  # Retries are handled by call_with_retries (shared limiter, Retry-After)
+        )
         self.model = settings.OPENAI_MODEL
+        self.rate_limiter = rate_limiter or get_rate_limiter(self.model)
+
+        # Token usage reported by the API (cached_tokens = prompt tokens served from the prompt cache)
+        self.usage = {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+        self._usage_lock = threading.Lock()
+
+    def _create_completion(self, **kwargs):
+        """Chat completion call under the shared rate limiter, retrying transient errors"""
+        # Rough estimate (~4 characters per token) plus the completion allowance
+        prompt_chars = sum(len(message['content']) for message in kwargs['messages'])
+        response = call_with_retries(
+            lambda: self.client.chat.completions.create(model=self.model, **kwargs),
+            self.rate_limiter,
+            tokens=prompt_chars // 4 + kwargs.get('max_tokens', 0)
+        )
+        self._record_usage(response)
+        return response
+
+    def _record_usage(self, response):
+        """Add the usage of a completion to self.usage, including prompt-cache hits"""
+        usage = getattr(response, 'usage', None)
+        prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        if not isinstance(prompt_tokens, int):
+            return
+
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+
+        with self._usage_lock:
+            self.usage['requests'] += 1
+            self.usage['prompt_tokens'] += prompt_tokens
+            self.usage['cached_tokens'] += cached_tokens
+            self.usage['completion_tokens'] += completion_tokens
+
+        logger.debug(
+            f"OpenAI usage: {prompt_tokens} prompt tokens ({cached_tokens} cached), "
+            f"{completion_tokens} completion tokens"
+        )
 
     def analyze_email_intent(self, email: Email, ai_role: AIRole) -> Dict[str, Any]:
         """
@@ -38,40 +93,25 @@ class AIEmailAnalyzer:
             }
         """
         start_time = time.time()
-        
+
+        # Identical content under the same role configuration was analyzed recently
+        cache_key = self._analysis_cache_key(email, ai_role)
+        cached = self._get_cached_analysis(cache_key, start_time)
+        if cached:
+            return cached
+
         try:
-            # Prepare context for AI
-            system_prompt = self._build_system_prompt(ai_role)
-            user_message = self._build_user_message(email)
-            
             logger.info(f"Analyzing email intent for: {email.subject[:50]}")
             
             # Call OpenAI API
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.1,  # Low temperature for consistent analysis
-                max_tokens=500,
-                response_format={"type": "json_object"}
-            )
+            response = self._create_completion(**self.analysis_request(email, ai_role))
             
             # Parse AI response
-            ai_analysis = json.loads(response.choices[0].message.content)
-            
             processing_time = int((time.time() - start_time) * 1000)
-            
-            result = {
-                'intent_type': ai_analysis.get('intent_type', 'unclear'),
-                'confidence': ai_analysis.get('confidence', 0.0),
-                'decision': ai_analysis.get('decision', 'escalate'),
-                'reason': ai_analysis.get('reason', 'AI analysis unclear'),
-                'processing_time_ms': processing_time
-            }
+            result = self.parse_analysis(response.choices[0].message.content, processing_time)
             
             logger.info(f"AI Analysis completed: {result['intent_type']} ({result['confidence']:.2f}) - {result['decision']}")
+            self._store_cached_analysis(cache_key, ai_role, result)
             return result
             
         except Exception as e:
@@ -79,14 +119,173 @@ class AIEmailAnalyzer:
             processing_time = int((time.time() - start_time) * 1000)
             
             # Fallback to safe escalation
-            return {
-                'intent_type': 'unclear',
-                'confidence': 0.0,
-                'decision': 'escalate',
-                'reason': f'AI analysis failed: {str(e)}',
-                'processing_time_ms': processing_time
-            }
+            return self.failed_analysis(e, processing_time)
+
+    def analysis_request(self, email: Email, ai_role: AIRole) -> Dict[str, Any]:
+        """Chat completion parameters (without model) for the intent analysis of an email"""
+        return {
+            'messages': [
+                {"role": "system", "content": self._build_system_prompt(ai_role)},
+                {"role": "user", "content": self._build_user_message(email)}
+            ],
+            'temperature': 0.1,  # Low temperature for consistent analysis
+            'max_tokens': 500,
+            'response_format': {"type": "json_object"}
+        }
+
+    @staticmethod
+    def parse_analysis(content: str, processing_time_ms: int) -> Dict[str, Any]:
+        """Analysis result from the JSON content returned by the model"""
+        ai_analysis = json.loads(content)
+        return {
+            'intent_type': ai_analysis.get('intent_type', 'unclear'),
+            'confidence': ai_analysis.get('confidence', 0.0),
+            'decision': ai_analysis.get('decision', 'escalate'),
+            'reason': ai_analysis.get('reason', 'AI analysis unclear'),
+            'processing_time_ms': processing_time_ms
+        }
+
+    @staticmethod
+    def failed_analysis(error, processing_time_ms: int) -> Dict[str, Any]:
+        """
+        Safe escalation recorded when the analysis could not be completed.
+        'transient' marks failures (rate limits, timeouts) to be retried later.
+        """
+        return {
+            'intent_type': 'unclear',
+            'confidence': 0.0,
+            'decision': 'escalate',
+            'reason': f'AI analysis failed: {str(error)}',
+            'processing_time_ms': processing_time_ms,
+            'transient': is_transient_error(error)
+        }
     
+    def _analysis_cache_key(self, email: Email, ai_role: AIRole) -> str:
+        """
+        Hash of the normalized prompt inputs that determine the analysis:
+        model, role configuration version, sender domain, subject and the body as sent in the prompt.
+        Returns None when the cache is disabled.
+        """
+        if not getattr(settings, 'AI_ANALYSIS_CACHE_TTL_HOURS', 0) or not isinstance(ai_role, AIRole):
+            return None
+
+        sender_domain = parseaddr(email.sender)[1].rpartition('@')[2].lower()
+        parts = [
+            self.model,
+            str(ai_role.id),
+            ai_role.updated_at.isoformat(),
+            sender_domain,
+            ' '.join(email.subject.lower().split()),
+            ' '.join(self._analysis_body(email).lower().split()),
+        ]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def _get_cached_analysis(self, cache_key: str, start_time: float) -> Dict[str, Any]:
+        """Return a fresh cached analysis (recording the hit), or None"""
+        if not cache_key:
+            return None
+
+        now = django_timezone.now()
+        ttl = timedelta(hours=settings.AI_ANALYSIS_CACHE_TTL_HOURS)
+        entry = AIAnalysisCache.objects.filter(key=cache_key, created_at__gte=now - ttl).first()
+        if not entry:
+            return None
+
+        AIAnalysisCache.objects.filter(pk=entry.pk).update(hit_count=F('hit_count') + 1, last_used_at=now)
+        logger.info(f"AI Analysis cache hit: {entry.intent_type} ({entry.confidence_score:.2f}) - {entry.ai_decision}")
+
+        return {
+            'intent_type': entry.intent_type,
+            'confidence': entry.confidence_score,
+            'decision': entry.ai_decision,
+            'reason': entry.decision_reason,
+            # Time spent on the cache lookup, so hits are visible in EmailIntent.processing_time_ms
+            'processing_time_ms': int((time.time() - start_time) * 1000),
+            'cached': True
+        }
+
+    def _store_cached_analysis(self, cache_key: str, ai_role: AIRole, result: Dict[str, Any]):
+        """Save a successful analysis and enforce TTL and size bound (never fails the analysis)"""
+        if not cache_key:
+            return
+
+        try:
+            AIAnalysisCache.objects.update_or_create(
+                key=cache_key,
+                defaults={
+                    'ai_role': ai_role,
+                    'intent_type': result['intent_type'],
+                    'confidence_score': result['confidence'],
+                    'ai_decision': result['decision'],
+                    'decision_reason': result['reason'],
+                    'created_at': django_timezone.now(),
+                }
+            )
+
+            # Evict expired entries, then the least recently used ones above the bound
+            ttl = timedelta(hours=settings.AI_ANALYSIS_CACHE_TTL_HOURS)
+            AIAnalysisCache.objects.filter(created_at__lt=django_timezone.now() - ttl).delete()
+
+            excess = AIAnalysisCache.objects.count() - getattr(settings, 'AI_ANALYSIS_CACHE_MAX_ENTRIES', 10000)
+            if excess > 0:
+                stale_ids = list(
+                    AIAnalysisCache.objects.order_by('last_used_at').values_list('id', flat=True)[:excess]
+                )
+                AIAnalysisCache.objects.filter(id__in=stale_ids).delete()
+        except IntegrityError:
+            # Another worker stored the same key concurrently
+            pass
+        except Exception as e:
+            logger.warning(f"Could not store AI analysis in cache: {e}")
+
+    def analyze_and_draft(self, email: Email, ai_role: AIRole, matched_rule: TemporalRule = None) -> Dict[str, Any]:
+        """
+        Analyze email intent and draft the reply in a single completion
+
+        Returns:
+            Same fields as analyze_email_intent plus 'draft' (reply text when the decision
+            is 'respond', otherwise None). Cache hits and failures have no draft.
+        """
+        start_time = time.time()
+
+        cache_key = self._analysis_cache_key(email, ai_role)
+        cached = self._get_cached_analysis(cache_key, start_time)
+        if cached:
+            return {**cached, 'draft': None}
+
+        try:
+            logger.info(f"Analyzing and drafting response for: {email.subject[:50]}")
+
+            response = self._create_completion(**self.combined_request(email, ai_role, matched_rule))
+            content = response.choices[0].message.content
+
+            processing_time = int((time.time() - start_time) * 1000)
+            result = self.parse_analysis(content, processing_time)
+
+            logger.info(f"AI Analysis completed: {result['intent_type']} ({result['confidence']:.2f}) - {result['decision']}")
+            self._store_cached_analysis(cache_key, ai_role, result)
+
+            # The draft only matters when the model decided to respond
+            draft = (json.loads(content).get('draft_reply') or '').strip()
+            return {**result, 'draft': draft if result['decision'] == 'respond' and draft else None}
+
+        except Exception as e:
+            logger.error(f"Error in combined AI analysis: {e}")
+            processing_time = int((time.time() - start_time) * 1000)
+            return {**self.failed_analysis(e, processing_time), 'draft': None}
+
+    def combined_request(self, email: Email, ai_role: AIRole, matched_rule: TemporalRule = None) -> Dict[str, Any]:
+        """Chat completion parameters (without model) for the combined analysis + draft"""
+        return {
+            'messages': [
+                {"role": "system", "content": self._build_combined_system_prompt(ai_role, matched_rule)},
+                {"role": "user", "content": self._build_user_message(email)}
+            ],
+            'temperature': 0.1,
+            'max_tokens': 1300,  # analysis (500) + reply (800)
+            'response_format': {"type": "json_object"}
+        }
+
     def generate_response(self, email: Email, ai_role: AIRole, matched_rule: TemporalRule = None) -> str:
         """
         Generate AI response for an email
@@ -100,20 +299,9 @@ class AIEmailAnalyzer:
             Generated response text
         """
         try:
-            system_prompt = self._build_response_system_prompt(ai_role, matched_rule)
-            user_message = self._build_response_user_message(email)
-            
             logger.info(f"Generating response for: {email.subject[:50]}")
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.3,  # Slightly more creative for responses
-                max_tokens=800
-            )
+            response = self._create_completion(**self.response_request(email, ai_role, matched_rule))
             
             generated_response = response.choices[0].message.content.strip()
             logger.info(f"Response generated successfully, length: {len(generated_response)}")
@@ -122,53 +310,33 @@ class AIEmailAnalyzer:
             
         except Exception as e:
             logger.error(f"Error generating AI response: {e}")
-            # Fallback response
-            role_name = ai_role.name if ai_role else 'AI Assistant'
-            return f"Thank you for your email. I'll get back to you soon.\n\nBest regards,\n{role_name}"
+            return self.fallback_response(ai_role)
+
+    def response_request(self, email: Email, ai_role: AIRole, matched_rule: TemporalRule = None) -> Dict[str, Any]:
+        """Chat completion parameters (without model) for the response to an email"""
+        return {
+            'messages': [
+                {"role": "system", "content": self._build_response_system_prompt(ai_role, matched_rule)},
+                {"role": "user", "content": self._build_response_user_message(email)}
+            ],
+            'temperature': 0.3,  # Slightly more creative for responses
+            'max_tokens': 800
+        }
+
+    @staticmethod
+    def fallback_response(ai_role: AIRole) -> str:
+        """Generic reply used when the response could not be generated"""
+        role_name = ai_role.name if ai_role else 'AI Assistant'
+        return f"Thank you for your email. I'll get back to you soon.\n\nBest regards,\n{role_name}"
 
     def _build_system_prompt(self, ai_role: AIRole) -> str:
         """Build system prompt for intent analysis"""
-
-        role_name = ai_role.name
-
-        # Get topics that this role CAN respond to
-        can_respond_topics = ai_role.can_respond_topics.strip() if ai_role.can_respond_topics else ""
-
-        # Build topics section
-        topics_section = ""
-        if can_respond_topics:
-            topics_list = "\n".join([f"  - {t.strip()}" for t in can_respond_topics.split('\n') if t.strip()])
-            topics_section += f"""
-THIS ROLE CAN RESPOND TO THESE TOPICS:
-{topics_list}
-
-Only respond to emails about these topics. If email is NOT about one of these topics, MUST escalate."""
-
-        prompt = f"""You are an AI email analyzer for: {role_name}
-
-CONTEXT:
-{ai_role.system_prompt}
-{topics_section}
-
-IMPORTANT: Check if email is about allowed topics BEFORE deciding to respond.
-If the email topic is NOT in the list of topics this role can respond to, you MUST escalate.
-
-Return ONLY valid JSON with these fields:
-- intent_type: Type of email (exam_info, schedule_inquiry, academic_question, personal_matter, administrative, unclear)
-- confidence: Your confidence level (0.0 to 1.0)
-- decision: Either "respond" (if topic is allowed), "escalate" (if topic not allowed or sensitive), or "ignore" (if spam)
-- reason: Brief explanation of your decision
-
-EXAMPLE:
-{{"intent_type": "exam_info", "confidence": 0.9, "decision": "respond", "reason": "Student asking about exam dates - this is in allowed topics"}}
-
-CRITICAL RULES:
-1. If email is about a topic NOT in the allowed list → decision MUST be "escalate"
-2. If email is about a topic in the "must escalate" list → decision MUST be "escalate"
-3. Only decide "respond" if topic matches allowed topics AND confidence > 0.7"""
-
-        return prompt
+        return prompts.analysis_system_prompt(ai_role)
     
+    def _analysis_body(self, email: Email) -> str:
+        """Cleaned body truncated to the analysis token budget"""
+        return body_for_prompt(email, getattr(settings, 'AI_ANALYSIS_BODY_TOKENS', 500))
+
     def _build_user_message(self, email: Email) -> str:
         """Build user message with email content"""
         
@@ -179,40 +347,18 @@ SUBJECT: {email.subject}
 DATE: {email.received_date}
 
 CONTENT:
-{email.body_plain[:2000]}  
+{self._analysis_body(email)}
 
 Analyze the intent and decide if this should be automatically responded to or escalated."""
     
     def _build_response_system_prompt(self, ai_role: AIRole, matched_rule: TemporalRule = None) -> str:
         """Build system prompt for response generation"""
+        return prompts.response_system_prompt(ai_role, matched_rule)
 
-        role_name = ai_role.name
+    def _build_combined_system_prompt(self, ai_role: AIRole, matched_rule: TemporalRule = None) -> str:
+        """Build system prompt for the combined analysis + draft"""
+        return prompts.combined_system_prompt(ai_role, matched_rule)
 
-        rule_info = ""
-        if matched_rule:
-            rule_info = f"""
-SPECIFIC RULE MATCHED: {matched_rule.name}
-RULE DESCRIPTION: {matched_rule.description}
-RULE TEMPLATE: {matched_rule.response_template}
-"""
-
-        return f"""You are an AI assistant responding to emails on behalf of:
-
-ROLE: {role_name}
-CONTEXT: {ai_role.system_prompt}
-
-{rule_info}
-
-GUIDELINES:
-- Be helpful, professional, and concise
-- Use the information provided in the context
-- If a specific rule template is provided, use it as a base but adapt to the specific question
-- Sign with the role name
-- Keep responses under 200 words unless more detail is needed
-- Be friendly but professional
-
-Generate a helpful response to the email."""
-    
     def _build_response_user_message(self, email: Email) -> str:
         """Build user message for response generation"""
         
@@ -222,17 +368,20 @@ FROM: {email.sender}
 SUBJECT: {email.subject}
 
 CONTENT:
-{email.body_plain[:1500]}
+{body_for_prompt(email, getattr(settings, 'AI_RESPONSE_BODY_TOKENS', 400))}
 
 Generate an appropriate response."""
 
 
 class EmailAIProcessor:
     """Main processor for AI email handling"""
-    
-    def __init__(self):
+
+    def __init__(self, max_concurrency: int = None):
         self.analyzer = AIEmailAnalyzer()
-    
+        self.max_concurrency = max_concurrency or getattr(settings, 'AI_MAX_CONCURRENCY', 4)
+        self.triage_enabled = getattr(settings, 'AI_TRIAGE_ENABLED', True)
+        self.combined_analysis = getattr(settings, 'AI_COMBINED_ANALYSIS', False)
+
     def process_email(self, email: Email) -> Tuple[EmailIntent, AIResponse]:
         """
         Process a single email through the AI pipeline
@@ -240,101 +389,255 @@ class EmailAIProcessor:
         Returns:
             Tuple of (EmailIntent, AIResponse or None)
         """
-        logger.info(f"Processing email: {email.subject[:50]} from {email.sender}")
+        return self.process_emails([email])[0]
 
+    def process_emails(self, emails) -> List[Tuple[EmailIntent, AIResponse]]:
+        """
+        Process a batch of emails through the AI pipeline
+
+        The LLM calls of different emails run concurrently (bounded by max_concurrency and the
+        shared token budget); the resulting EmailIntent and AIResponse rows are then written
+        with two bulk inserts. Emails that already have an EmailIntent are not analyzed again.
+
+        Returns:
+            List of (EmailIntent, AIResponse or None), in the order of emails
+        """
+        # Each email once, even if the caller passed it twice
+        emails = list({email.id: email for email in emails}.values())
+        if not emails:
+            return []
+
+        existing = {
+            intent.email_id: intent
+            for intent in EmailIntent.objects.filter(email__in=emails).select_related('airesponse')
+        }
+
+        usage_before = dict(self.analyzer.usage)
+        roles = {}
+        plans = {}
+        pending = []
+        for email in emails:
+            if email.id in existing:
+                continue
+
+            logger.info(f"Processing email: {email.subject[:50]} from {email.sender}")
+            ai_role = self._get_ai_role(email, roles)
+            if isinstance(ai_role, AIRole):
+                pending.append((email, ai_role))
+            else:
+                # No usable role: record the reason without calling the model
+                plans[email.id] = self.role_missing_plan(ai_role)
+
+        if len(pending) > 1 and self.max_concurrency > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pending))) as pool:
+                results = pool.map(lambda item: self._analyze_isolated(*item), pending)
+                plans.update((email.id, plan) for (email, _), plan in zip(pending, results))
+        else:
+            for email, ai_role in pending:
+                plans[email.id] = self._analyze(email, ai_role)
+
+        # Persist everything with two bulk inserts
+        new_intents, new_responses = self.save_plans(emails, plans)
+
+        # Emails analyzed meanwhile by another job: report the analysis that was stored
+        concurrent = [email.id for email in emails if email.id not in new_intents and email.id not in existing]
+        if concurrent:
+            existing.update(
+                (intent.email_id, intent)
+                for intent in EmailIntent.objects.filter(email_id__in=concurrent).select_related('airesponse')
+            )
+
+        results = []
+        for email in emails:
+            if email.id in new_intents:
+                results.append((new_intents[email.id], new_responses.get(email.id)))
+            else:
+                intent = existing[email.id]
+                results.append((intent, getattr(intent, 'airesponse', None)))
+
+        usage = {key: value - usage_before[key] for key, value in self.analyzer.usage.items()}
+        logger.info(
+            f"AI batch complete: {len(new_intents)} analyzed, {len(new_responses)} responses, "
+            f"{len(existing)} already processed; {usage['prompt_tokens']} prompt tokens "
+            f"({usage['cached_tokens']} cached), {usage['completion_tokens']} completion tokens"
+        )
+        return results
+
+    def save_plans(self, emails, plans: Dict) -> Tuple[Dict, Dict]:
+        """
+        Write the EmailIntent (and AIResponse, when there is response text) of each planned email
+        with one bulk insert per table
+
+        An email may be analyzed concurrently by another job (push fetch, process_emails,
+        retry_ai_failures). If the bulk insert hits an existing EmailIntent, the intents are
+        inserted one by one and the emails that already had one are left out: their analysis
+        and response are the other job's.
+
+        Args:
+            emails: Email objects
+            plans: {email.id: plan} as returned by make_plan
+
+        Returns:
+            ({email.id: EmailIntent}, {email.id: AIResponse}) for the intents written here
+        """
+        emails = list({email.id: email for email in emails if email.id in plans}.values())
+        new_intents = {
+            email.id: EmailIntent(email=email, **plans[email.id]['intent'])
+            for email in emails
+        }
+        new_responses = {}
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    EmailIntent.objects.bulk_create(new_intents.values())
+            except IntegrityError:
+                new_intents = self._create_intents_one_by_one(emails, plans)
+
+            for email in emails:
+                response_text = plans[email.id].get('response_text')
+                if response_text is not None and email.id in new_intents:
+                    # Always create as 'pending_approval' first
+                    # The scheduler will decide to send automatically if auto_send is enabled
+                    new_responses[email.id] = AIResponse(
+                        email_intent=new_intents[email.id],
+                        response_text=response_text,
+                        response_subject=f"Re: {email.subject}",
+                        status='pending_approval'
+                    )
+            AIResponse.objects.bulk_create(new_responses.values())
+        return new_intents, new_responses
+
+    @staticmethod
+    def _create_intents_one_by_one(emails, plans: Dict) -> Dict:
+        """Insert the intents individually, skipping the emails analyzed meanwhile by another job"""
+        intents = {}
+        for email in emails:
+            intent = EmailIntent(email=email, **plans[email.id]['intent'])
+            try:
+                with transaction.atomic():
+                    intent.save()
+            except IntegrityError:
+                logger.info(f"Email {email.id} was analyzed concurrently, keeping the existing analysis")
+                continue
+            intents[email.id] = intent
+        return intents
+
+    @staticmethod
+    def make_plan(analysis: Dict, matched_rule: TemporalRule = None, response_text: str = None) -> Dict:
+        """Plan for save_plans from an analysis result (as returned by analyze_email_intent)"""
+        return {
+            'intent': {
+                'intent_type': analysis['intent_type'],
+                'confidence_score': analysis['confidence'],
+                'ai_decision': analysis['decision'],
+                'decision_reason': analysis['reason'],
+                'matched_rule': matched_rule,
+                'processing_time_ms': analysis['processing_time_ms'],
+                'is_transient_failure': analysis.get('transient', False)
+            },
+            'response_text': response_text
+        }
+
+    @classmethod
+    def role_missing_plan(cls, reason: str) -> Dict:
+        """Escalation plan for emails whose owner has no usable AIRole"""
+        return cls.make_plan({
+            'intent_type': 'unclear',
+            'confidence': 0.0,
+            'decision': 'escalate',
+            'reason': reason,
+            'processing_time_ms': 0
+        })
+
+    def triage(self, email: Email, ai_role: AIRole) -> Dict:
+        """Plan decided locally by the triage stage, or None when the email needs the model"""
+        if not self.triage_enabled:
+            return None
+
+        started = time.monotonic()
+        decision = triage_email(email, ai_role)
+        if not decision:
+            return None
+
+        logger.info(f"Email {email.id} decided by triage: {decision['reason']}")
+        decision['processing_time_ms'] = int((time.monotonic() - started) * 1000)
+        return self.make_plan(decision)
+
+    def _get_ai_role(self, email: Email, roles: Dict):
+        """
+        Active AIRole of the email's owner (cached per user in `roles`),
+        or the decision reason to record when there is none
+        """
         try:
             # Get user (support both email_account and legacy gmail_account)
             user = email.email_account.user if email.email_account else email.gmail_account.user
-
-            # Get active AIRole
-            ai_role = AIRole.objects.get(user=user, is_active=True)
-            logger.info(f"Using AIRole: {ai_role.name} for user {user.username}")
-
-        except AIRole.DoesNotExist:
-            logger.warning(f"No active AI role configured for user {user.username}")
-            # Create basic intent for unprocessed email
-            intent = EmailIntent.objects.create(
-                email=email,
-                intent_type='unclear',
-                confidence_score=0.0,
-                ai_decision='escalate',
-                decision_reason='No active AI role configured',
-                processing_time_ms=0
-            )
-            return intent, None
         except Exception as e:
             logger.error(f"Error getting AI role for email {email.id}: {e}")
-            intent = EmailIntent.objects.create(
-                email=email,
-                intent_type='unclear',
-                confidence_score=0.0,
-                ai_decision='escalate',
-                decision_reason=f'Error loading AI configuration: {str(e)}',
-                processing_time_ms=0
-            )
-            return intent, None
+            return f'Error loading AI configuration: {str(e)}'
+
+        if user.id not in roles:
+            try:
+                roles[user.id] = AIRole.objects.get(user=user, is_active=True)
+                logger.info(f"Using AIRole: {roles[user.id].name} for user {user.username}")
+            except AIRole.DoesNotExist:
+                logger.warning(f"No active AI role configured for user {user.username}")
+                roles[user.id] = 'No active AI role configured'
+            except Exception as e:
+                logger.error(f"Error getting AI role for email {email.id}: {e}")
+                roles[user.id] = f'Error loading AI configuration: {str(e)}'
+        return roles[user.id]
+
+    def _analyze_isolated(self, email: Email, ai_role: AIRole) -> Dict:
+        """_analyze for worker threads: releases the thread's DB connection when done"""
+        try:
+            return self._analyze(email, ai_role)
+        finally:
+            connections.close_all()
+
+    def _analyze(self, email: Email, ai_role: AIRole) -> Dict:
+        """
+        Run the LLM part of the pipeline for one email (no EmailIntent/AIResponse writes)
+
+        Returns:
+            {'intent': EmailIntent field values, 'response_text': str or None}
+        """
+        # The analysis needs the content, load it if the email was synced metadata-only
+        ensure_email_body(email)
 
-        # Analyze email intent
-        analysis = self.analyzer.analyze_email_intent(email, ai_role)
+        # Obvious cases are decided locally, without calling the model
+        triaged = self.triage(email, ai_role)
+        if triaged:
+            return triaged
 
         # Check for matching temporal rules
-        matched_rule = self._find_matching_rule(email, ai_role, analysis)
-        
-        # Create EmailIntent record
-        intent = EmailIntent.objects.create(
-            email=email,
-            intent_type=analysis['intent_type'],
-            confidence_score=analysis['confidence'],
-            ai_decision=analysis['decision'],
-            decision_reason=analysis['reason'],
-            matched_rule=matched_rule,
-            processing_time_ms=analysis['processing_time_ms']
-        )
-        
-        # Generate response if decision is 'respond'
-        ai_response = None
-        if analysis['decision'] == 'respond':
+        matched_rule = self._find_matching_rule(email, ai_role)
+
+        # Analyze email intent (and draft the reply in the same call in combined mode)
+        if self.combined_analysis:
+            analysis = self.analyzer.analyze_and_draft(email, ai_role, matched_rule)
+        else:
+            analysis = self.analyzer.analyze_email_intent(email, ai_role)
+
+        # Generate response if decision is 'respond' and there is no draft yet
+        response_text = None
+        if analysis['decision'] == 'respond' and analysis.get('draft'):
+            response_text = analysis['draft']
+            logger.info(f"Response drafted with the analysis for email: {email.subject[:50]}")
+        elif analysis['decision'] == 'respond':
             try:
                 response_text = self.analyzer.generate_response(email, ai_role, matched_rule)
-                
-                # Create AIResponse record
-                # Always create as 'pending_approval' first
-                # The scheduler will decide to send automatically if auto_send is enabled
-                ai_response = AIResponse.objects.create(
-                    email_intent=intent,
-                    response_text=response_text,
-                    response_subject=f"Re: {email.subject}",
-                    status='pending_approval'
-                )
-                
                 logger.info(f"Response generated for email: {email.subject[:50]}")
-                
             except Exception as e:
                 logger.error(f"Error generating response for email {email.id}: {e}")
-        
-        return intent, ai_response
-    
-    def _find_matching_rule(self, email: Email, ai_role: AIRole, analysis: Dict) -> TemporalRule:
+
+        return self.make_plan(analysis, matched_rule, response_text)
+
+    def _find_matching_rule(self, email: Email, ai_role: AIRole) -> TemporalRule:
         """
         Find matching temporal rule for the email.
+        Uses the compiled per-role rule index (single pass over the email text).
         """
-
-        now = django_timezone.now()
-
-        active_rules = TemporalRule.objects.filter(
-            ai_role=ai_role,
-            status='active',
-            start_date__lte=now,
-            end_date__gte=now
-        ).order_by('-priority')
-
-        for rule in active_rules:
-            # Check if email content matches rule keywords
-            email_content = f"{email.subject} {email.body_plain}".lower()
-            keywords = [kw.strip().lower() for kw in rule.keywords.split(',') if kw.strip()]
-
-            if any(keyword in email_content for keyword in keywords):
-                logger.info(f"Email matched temporal rule: {rule.name}")
-                return rule
-
-        return None
\ No newline at end of file
+        rule = match_temporal_rule(email, ai_role)
+        if rule:
+            logger.info(f"Email matched temporal rule: {rule.name}")
+        return rule
@@ -21,6 +21,14 @@ class GmailAppConfig(AppConfig):
 
         from django.conf import settings
 
+        # Registrar signal handlers y handlers de jobs (en todos los procesos)
+        from . import signals  # noqa: F401
+        from . import tasks  # noqa: F401
+
+        # Documento de discovery de Gmail incluido en la app: validarlo y dejarlo parseado
+        from .gmail_discovery import check_bundled_document
+        check_bundled_document()
+
         # Evitar que StatReloader de Django inicie el scheduler múltiples veces
         # Solo iniciar si:
         # 1. No ha sido inicializado aún
@@ -62,6 +70,36 @@ class GmailAppConfig(AppConfig):
                 replace_existing=True,
             )
 
+            # Reintentar análisis de IA fallidos por rate limits / timeouts
+            retry_minutes = getattr(settings, 'AI_RETRY_INTERVAL_MINUTES', 15)
+            scheduler.add_job(
+                'gmail_app.scheduler:retry_ai_failures_job',
+                trigger=IntervalTrigger(minutes=retry_minutes),
+                id='retry_ai_failures',
+                name='Reintento de análisis de IA fallidos',
+                replace_existing=True,
+            )
+
+            # Renovar las suscripciones push antes de que expiren
+            renew_hours = getattr(settings, 'MAIL_WATCH_RENEW_INTERVAL_HOURS', 6)
+            scheduler.add_job(
+                'gmail_app.scheduler:renew_mail_watches_job',
+                trigger=IntervalTrigger(hours=renew_hours),
+                id='renew_mail_watches',
+                name='Renovación de suscripciones push',
+                replace_existing=True,
+            )
+
+            # Renovar los access tokens antes de que expiren
+            refresh_seconds = getattr(settings, 'TOKEN_REFRESH_INTERVAL_SECONDS', 120)
+            scheduler.add_job(
+                'gmail_app.scheduler:refresh_tokens_job',
+                trigger=IntervalTrigger(seconds=refresh_seconds),
+                id='refresh_tokens',
+                name='Renovación de access tokens',
+                replace_existing=True,
+            )
+
             # Iniciar el scheduler
             scheduler.start()
             logger.info(
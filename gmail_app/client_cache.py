@@ -0,0 +1,245 @@
+"""
+Process-wide cache of provider credentials and API clients, keyed by EmailAccount.id
+
+Building a Gmail client and reading/refreshing tokens used to happen on
+every GmailService/OutlookService call. Here they are done once per account and process:
+
+- Credentials: the account's tokens are kept in memory; the database is only read again when
+  the cached token is about to expire (another process may have refreshed it), and refreshed
+  inline only if nobody did.
+- Gmail clients: built once per account and thread (googleapiclient clients are not thread
+  safe), all sharing the account's credentials.
+- A background refresher (start_refresher, run by the job workers and the scheduler) renews
+  the tokens of every active account TOKEN_REFRESH_MARGIN_SECONDS before they expire, so syncs
+  and sends never wait for a refresh.
+
+Saving an account keeps its entry in step (see gmail_app.signals): new tokens (refresh or
+reconnection) replace the cached ones and disconnecting or deleting it drops the entry.
+"""
+import logging
+import threading
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import EmailAccount
+
+logger = logging.getLogger('gmail_app')
+
+# A cached token this close to its expiry is not handed out anymore
+EXPIRY_SKEW = timedelta(seconds=60)
+
+
+class _Entry:
+    """Tokens and clients of one account"""
+
+    def __init__(self, account):
+        self.lock = threading.Lock()  # serializes refreshes of the account
+        self.account_id = account.id
+        self.user_id = account.user_id
+        self.provider = account.provider
+        self.access_token = account.access_token
+        self.refresh_token = account.refresh_token
+        self.expires_at = account.token_expires_at
+        self.gmail_credentials = None
+        self.local = threading.local()  # Gmail client of each thread
+
+    def fresh(self):
+        return bool(self.access_token) and self.expires_at is not None and \
+            self.expires_at - EXPIRY_SKEW > timezone.now()
+
+    def update(self, account):
+        if account.refresh_token != self.refresh_token:
+            # New grant (reconnection): build credentials and clients again
+            self.gmail_credentials = None
+            self.local = threading.local()
+        self.access_token = account.access_token
+        self.refresh_token = account.refresh_token
+        self.expires_at = account.token_expires_at
+        if self.gmail_credentials is not None:
+            # In place: the clients built on these credentials pick up the new token
+            self.gmail_credentials.token = account.access_token
+            self.gmail_credentials.expiry = _naive_utc(account.token_expires_at)
+
+
+_entries = {}  # EmailAccount.id -> _Entry
+_entries_lock = threading.Lock()
+
+
+def _naive_utc(value):
+    """google-auth compares expiries as naive UTC datetimes"""
+    return value.astimezone(dt_timezone.utc).replace(tzinfo=None) if value else None
+
+
+def _entry(account):
+    with _entries_lock:
+        entry = _entries.get(account.id)
+        if entry is None:
+            entry = _entries[account.id] = _Entry(account)
+        return entry
+
+
+def invalidate(account_id):
+    """Forget the tokens and clients of an account (disconnected or reconnected)"""
+    with _entries_lock:
+        _entries.pop(account_id, None)
+
+
+def store_tokens(account):
+    """Take the tokens just saved on account (refreshed or reconnected) if it is cached"""
+    entry = _entries.get(account.id)
+    if entry is not None:
+        entry.update(account)
+
+
+def cached_access_token(account_id, user_id, provider):
+    """
+    Valid access token of the account without touching the database
+
+    Returns:
+        str: The token, or None when it is not cached (for that user and provider) or is about
+        to expire
+    """
+    entry = _entries.get(account_id)
+    if entry is not None and entry.user_id == user_id and entry.provider == provider and entry.fresh():
+        return entry.access_token
+    return None
+
+
+def _ensure_fresh(entry, account):
+    """Bring the entry to a valid token: from the database if possible, refreshing otherwise"""
+    with entry.lock:
+        if entry.fresh():
+            return
+        stored = EmailAccount.objects.filter(id=account.id).first() or account
+        if not stored.is_active:
+            invalidate(account.id)
+            from .exceptions import OAuthError
+            raise OAuthError(f"{account.email} is disconnected. Please reconnect your account.")
+        if stored.access_token != entry.access_token or stored.token_expires_at != entry.expires_at:
+            entry.update(stored)
+        if not entry.fresh():
+            logger.info(f"Access token of {stored.email} expired, refreshing inline")
+            _refresh(entry, stored)
+
+
+def get_access_token(account):
+    """
+    Valid access token of account, refreshed if it is about to expire
+
+    Args:
+        account (EmailAccount): Account whose token is needed
+
+    Returns:
+        str: Access token
+    """
+    entry = _entry(account)
+    if not entry.fresh():
+        _ensure_fresh(entry, account)
+    return entry.access_token
+
+
+def get_gmail_credentials(account):
+    """Shared google-auth Credentials of a Gmail account, valid for at least EXPIRY_SKEW"""
+    from google.oauth2.credentials import Credentials
+
+    entry = _entry(account)
+    if not entry.fresh():
+        _ensure_fresh(entry, account)
+    with entry.lock:
+        if entry.gmail_credentials is None:
+            entry.gmail_credentials = Credentials(
+                token=entry.access_token,
+                refresh_token=entry.refresh_token,
+                token_uri="https://oauth2.googleapis.com/token",
+                client_id=settings.GOOGLE_OAUTH2_CLIENT_ID,
+                client_secret=settings.GOOGLE_OAUTH2_CLIENT_SECRET,
+                scopes=settings.GMAIL_SCOPES,
+                expiry=_naive_utc(entry.expires_at)
+            )
+        return entry.gmail_credentials
+
+
+def get_gmail_service(account):
+    """Gmail API client of account for the calling thread, built once"""
+    from .gmail_discovery import build_gmail_service
+
+    credentials = get_gmail_credentials(account)
+    entry = _entry(account)
+    service = getattr(entry.local, 'service', None)
+    if service is None:
+        service = entry.local.service = build_gmail_service(credentials)
+    return service
+
+
+def _refresh(entry, account):
+    """Refresh the tokens of account and save them (caller holds entry.lock)"""
+    if account.provider == 'gmail':
+        from .gmail_service import GmailService
+        GmailService(account.user, email_account=account).refresh_account_token(account)
+    else:
+        from .outlook_service import OutlookService
+        OutlookService(account.user)._refresh_token(account)
+    # Also done by the post_save signal; the entry may have been created after it ran
+    entry.update(account)
+
+
+# ========== BACKGROUND REFRESH ==========
+
+def refresh_expiring_tokens(margin=None):
+    """
+    Refresh the tokens of the active accounts that expire within margin seconds
+
+    Each account is refreshed under the 'token-refresh:<id>' lock, so processes running the
+    refresher at the same time do not refresh the same token twice.
+
+    Returns:
+        int: Accounts refreshed
+    """
+    from .locks import acquire, release, default_owner
+
+    if margin is None:
+        margin = getattr(settings, 'TOKEN_REFRESH_MARGIN_SECONDS', 600)
+    accounts = EmailAccount.objects.select_related('user').filter(
+        is_active=True,
+        token_expires_at__lt=timezone.now() + timedelta(seconds=margin)
+    ).exclude(refresh_token__isnull=True).exclude(refresh_token='')
+
+    owner = default_owner()
+    refreshed = 0
+    for account in accounts:
+        name = f'token-refresh:{account.id}'
+        if not acquire(name, owner):
+            continue
+        try:
+            # Re-read under the lock: another process may have just refreshed it
+            account = EmailAccount.objects.select_related('user').get(id=account.id)
+            if account.is_active and account.token_expires_at < timezone.now() + timedelta(seconds=margin):
+                entry = _entry(account)
+                with entry.lock:
+                    _refresh(entry, account)
+                refreshed += 1
+            else:
+                _entry(account).update(account)
+        except Exception as e:
+            logger.error(f"Proactive token refresh failed for {account.email}: {e}")
+        finally:
+            release(name, owner)
+
+    if refreshed:
+        logger.info(f"Proactively refreshed {refreshed} access tokens")
+    return refreshed
+
+
+def start_refresher(interval=None):
+    """
+    Run refresh_expiring_tokens every TOKEN_REFRESH_INTERVAL_SECONDS in a background thread
+
+    Returns:
+        Heartbeat: Call stop() to end it
+    """
+    from .locks import Heartbeat
+
+    interval = interval or getattr(settings, 'TOKEN_REFRESH_INTERVAL_SECONDS', 120)
+    return Heartbeat(interval, refresh_expiring_tokens, name='token-refresher').start()
@@ -0,0 +1,110 @@
+"""
+Gmail API clients built from the discovery document bundled with the app
+
+googleapiclient.discovery.build reads and parses the Gmail discovery document (or downloads
+it) for every client. The document is shipped in gmail_app/discovery/gmail.v1.json, parsed
+once per process and shared by every client built with build_gmail_service.
+
+build_from_document adds some local parameters to the method descriptions of the document it
+is given. The shared document is run through a full client once, under a lock, so later
+builds only rewrite those keys with the same values and can share it across threads.
+
+To update the bundled document, copy googleapiclient/discovery_cache/documents/gmail.v1.json
+of the installed google-api-python-client over it (check_bundled_document logs when that copy
+is newer).
+"""
+import json
+import logging
+import os
+import threading
+
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+
+logger = logging.getLogger('gmail_app')
+
+DOCUMENT_PATH = os.path.join(os.path.dirname(__file__), 'discovery', 'gmail.v1.json')
+API_NAME = 'gmail'
+API_VERSION = 'v1'
+
+_document = None
+_document_lock = threading.Lock()
+
+
+def _warm(resource, description):
+    """Create every method of resource and its nested resources"""
+    for name, sub_description in description.get('resources', {}).items():
+        _warm(getattr(resource, name)(), sub_description)
+
+
+def get_document():
+    """Parsed bundled discovery document (loaded once per process)"""
+    global _document
+    if _document is None:
+        with _document_lock:
+            if _document is None:
+                with open(DOCUMENT_PATH, encoding='utf-8') as f:
+                    document = json.load(f)
+                # Unauthenticated client: only its method descriptions are needed
+                _warm(build_from_document(document, http=build_http()), document)
+                _document = document
+    return _document
+
+
+def build_gmail_service(credentials):
+    """
+    Gmail API client from the bundled discovery document
+
+    Args:
+        credentials: google-auth credentials of the mailbox
+
+    Returns:
+        googleapiclient.discovery.Resource: Same client as build('gmail', 'v1', ...)
+    """
+    return build_from_document(get_document(), credentials=credentials)
+
+
+def _installed_document():
+    """Gmail discovery document shipped with google-api-python-client, if any"""
+    import googleapiclient
+
+    path = os.path.join(
+        os.path.dirname(googleapiclient.__file__), 'discovery_cache', 'documents', f'{API_NAME}.{API_VERSION}.json'
+    )
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def check_bundled_document():
+    """
+    Startup self-check of the bundled document
+
+    Returns:
+        bool: False when the document is missing or is not Gmail v1 (clients cannot be built)
+    """
+    try:
+        document = get_document()
+    except Exception as e:
+        logger.error(f"Bundled Gmail discovery document {DOCUMENT_PATH} could not be loaded: {e}")
+        return False
+
+    if (document.get('name'), document.get('version')) != (API_NAME, API_VERSION):
+        logger.error(
+            f"Bundled discovery document is {document.get('name')} {document.get('version')}, "
+            f"expected {API_NAME} {API_VERSION}"
+        )
+        return False
+
+    try:
+        installed = _installed_document()
+    except Exception as e:
+        logger.warning(f"Could not read the Gmail discovery document of googleapiclient: {e}")
+        installed = None
+    if installed and installed.get('revision', '') > document.get('revision', ''):
+        logger.warning(
+            f"Bundled Gmail discovery document (revision {document.get('revision')}) is older than "
+            f"the one of google-api-python-client ({installed.get('revision')}); consider updating it"
+        )
+    return True
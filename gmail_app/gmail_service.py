@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import base64
 import logging
 from datetime import datetime, timezone
@@ -7,10 +8,12 @@ from django.conf import settings
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
+from . import client_cache
+from .gmail_discovery import build_gmail_service
 from .models import GmailAccount, EmailAccount, Email
+from .ingest import bulk_upsert_emails, is_bulk_mail, BULK_HEADERS
 from .exceptions import (
     OAuthError, TokenExpiredError, RefreshTokenInvalidError,
     GmailAPIError, QuotaExceededError, PermissionError
@@ -21,10 +24,40 @@ logger = logging.getLogger('gmail_app')
 # Allow insecure transport for local development
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
+# Headers requested when syncing metadata-only (format='metadata')
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date'] + BULK_HEADERS
+
+
+def ensure_email_body(email):
+    """
+    Make sure a lazily-synced email has its body loaded.
+
+    No-op for emails that already have a body or don't come from Gmail. Errors are logged
+    and swallowed so callers can still work with the metadata.
+    """
+    if email.body_fetched or email.provider != 'gmail':
+        return email
+
+    if email.email_account:
+        service = GmailService(email.email_account.user, email_account=email.email_account)
+    else:
+        service = GmailService(email.gmail_account.user)
+    try:
+        service.hydrate_body(email)
+    except Exception as e:
+        logger.error(f"Could not hydrate body for email {email.id}: {e}")
+    return email
+
 
 class GmailService:
-    def __init__(self, user):
+    def __init__(self, user, email_account=None):
+        """
+        Args:
+            user: Owner of the mailbox
+            email_account: Use the tokens of this EmailAccount instead of the legacy GmailAccount
+        """
         self.user = user
+        self.email_account = email_account
         self.credentials = None
         self.service = None
     
@@ -87,7 +120,7 @@ class GmailService:
             )
         
         # Get user info
-        service = build('gmail', 'v1', credentials=credentials)
+        service = build_gmail_service(credentials)
         profile = service.users().getProfile(userId='me').execute()
         
         logger.info(f"Successfully authenticated Gmail for user {self.user.username}, email: {profile['emailAddress']}")
@@ -122,7 +155,12 @@ class GmailService:
         return gmail_account
     
     def get_credentials(self):
+        # EmailAccount tokens come from the process-wide cache, refreshed ahead of expiry
+        if self.email_account:
+            return client_cache.get_gmail_credentials(self.email_account)
+
         try:
+            # Legacy one-per-user GmailAccount
             gmail_account = GmailAccount.objects.get(user=self.user)
             credentials = Credentials(
                 token=gmail_account.access_token,
@@ -134,90 +172,124 @@ class GmailService:
             )
             
             if credentials.expired:
-                logger.info(f"Refreshing expired token for user {self.user.username}")
-                try:
-                    credentials.refresh(Request())
-                    gmail_account.access_token = credentials.token
-                    gmail_account.token_expires_at = datetime.fromtimestamp(credentials.expiry.timestamp(), tz=timezone.utc)
-                    gmail_account.save()
-                    logger.info(f"Token refreshed successfully for user {self.user.username}")
-                except RefreshError as e:
-                    logger.error(f"Failed to refresh token for user {self.user.username}: {e}")
-                    # Check if it's specifically an invalid_grant error
-                    error_str = str(e)
-                    if 'invalid_grant' in error_str:
-                        raise RefreshTokenInvalidError(
-                            "Your Gmail access has expired. Please reconnect your account.",
-                            error_type="invalid_grant",
-                            error_description=error_str
-                        )
-                    else:
-                        raise OAuthError(f"Token refresh failed: {error_str}")
-                except Exception as e:
-                    error_str = str(e)
-                    # Also catch invalid_grant errors that come as generic exceptions
-                    if 'invalid_grant' in error_str or 'Bad Request' in error_str:
-                        logger.error(f"Invalid grant error for user {self.user.username}: {e}")
-                        raise RefreshTokenInvalidError(
-                            "Your Gmail access has expired. Please reconnect your account.",
-                            error_type="invalid_grant", 
-                            error_description=error_str
-                        )
-                    else:
-                        raise
+                self._refresh_credentials(credentials, gmail_account)
             
             return credentials
         except GmailAccount.DoesNotExist:
             logger.warning(f"No Gmail account found for user {self.user.username}")
             return None
+
+    def refresh_account_token(self, account):
+        """
+        Refresh the access token of an account and save it
+
+        Args:
+            account: EmailAccount (or legacy GmailAccount) whose tokens are refreshed
+        """
+        credentials = Credentials(
+            token=account.access_token,
+            refresh_token=account.refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=settings.GOOGLE_OAUTH2_CLIENT_ID,
+            client_secret=settings.GOOGLE_OAUTH2_CLIENT_SECRET,
+            scopes=settings.GMAIL_SCOPES
+        )
+        self._refresh_credentials(credentials, account)
+
+    def _refresh_credentials(self, credentials, account):
+        """Refresh credentials and store the new token on account"""
+        logger.info(f"Refreshing token of {account.email} for user {self.user.username}")
+        try:
+            credentials.refresh(Request())
+            account.access_token = credentials.token
+            account.token_expires_at = datetime.fromtimestamp(credentials.expiry.timestamp(), tz=timezone.utc)
+            account.save(update_fields=['access_token', 'token_expires_at'])
+            logger.info(f"Token refreshed successfully for user {self.user.username}")
+        except RefreshError as e:
+            logger.error(f"Failed to refresh token for user {self.user.username}: {e}")
+            # Check if it's specifically an invalid_grant error
+            error_str = str(e)
+            if 'invalid_grant' in error_str:
+                raise RefreshTokenInvalidError(
+                    "Your Gmail access has expired. Please reconnect your account.",
+                    error_type="invalid_grant",
+                    error_description=error_str
+                )
+            else:
+                raise OAuthError(f"Token refresh failed: {error_str}")
+        except Exception as e:
+            error_str = str(e)
+            # Also catch invalid_grant errors that come as generic exceptions
+            if 'invalid_grant' in error_str or 'Bad Request' in error_str:
+                logger.error(f"Invalid grant error for user {self.user.username}: {e}")
+                raise RefreshTokenInvalidError(
+                    "Your Gmail access has expired. Please reconnect your account.",
+                    error_type="invalid_grant", 
+                    error_description=error_str
+                )
+            else:
+                raise
     
     def get_service(self):
+        if self.email_account:
+            # Built once per account and thread (see gmail_app.client_cache)
+            self.service = client_cache.get_gmail_service(self.email_account)
+            return self.service
+
         if not self.credentials:
             self.credentials = self.get_credentials()
         
         if self.credentials:
-            self.service = build('gmail', 'v1', credentials=self.credentials)
+            self.service = build_gmail_service(self.credentials)
             return self.service
         return None
     
-    def sync_emails(self, max_results=20, email_account_id=None):
+    def sync_emails(self, max_results=20, email_account_id=None, incremental=None, lazy_bodies=None):
         """
         Sync emails from Gmail API
 
         Args:
-            max_results (int): Maximum number of emails to fetch (default: 20)
+            max_results (int): Maximum number of emails to fetch on a full sync (default: 20)
             email_account_id (int): Specific EmailAccount ID to sync. If None, syncs the first active account.
                                    This enables multiple Gmail accounts to be synced.
+            incremental (bool): Use the History API cursor stored on the account when available.
+                                Defaults to settings.GMAIL_INCREMENTAL_SYNC.
+            lazy_bodies (bool): Fetch only metadata now and hydrate bodies on first access.
+                                Defaults to settings.GMAIL_LAZY_BODIES.
 
         Returns:
             list: List of newly created Email objects
         """
         logger.info(f"Starting email sync for user {self.user.username}")
 
+        if incremental is None:
+            incremental = getattr(settings, 'GMAIL_INCREMENTAL_SYNC', True)
+        if lazy_bodies is None:
+            lazy_bodies = getattr(settings, 'GMAIL_LAZY_BODIES', False)
+
         try:
             service = self.get_service()
             if not service:
                 raise OAuthError("Unable to connect to Gmail service. Please reconnect your account.")
 
-            # Get the specific email account to sync
-            if email_account_id:
-                email_account = EmailAccount.objects.get(
-                    id=email_account_id,
-                    user=self.user,
-                    provider='gmail',
-                    is_active=True
-                )
-                logger.info(f"Syncing specific Gmail account: {email_account.email}")
-            else:
-                # Get first active Gmail account for backward compatibility
-                email_account = EmailAccount.objects.filter(
-                    user=self.user,
-                    provider='gmail',
-                    is_active=True
-                ).first()
+            email_account = self._get_email_account(email_account_id)
 
-            if not email_account:
-                raise OAuthError("No active Gmail account found. Please reconnect your account.")
+            # Incremental sync: only fetch what changed since the stored historyId
+            if incremental and email_account.history_id:
+                try:
+                    return self._sync_history(service, email_account, lazy_bodies)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # historyId is too old (Gmail keeps roughly one week of history)
+                    logger.warning(
+                        f"History cursor expired for {email_account.email}, falling back to full sync"
+                    )
+                    email_account.history_id = ''
+                    email_account.save(update_fields=['history_id'])
+
+            # Take the cursor BEFORE listing so changes that arrive meanwhile are seen next run
+            profile = service.users().getProfile(userId='me').execute()
 
             # Get messages
             results = service.users().messages().list(
@@ -225,98 +297,473 @@ class GmailService:
                 maxResults=max_results,
                 q='in:inbox'
             ).execute()
+
+            message_ids = [message['id'] for message in results.get('messages', [])]
+            messages, failed_ids = self._fetch_messages(service, message_ids, lazy_bodies)
+            synced_emails = self._store_messages(email_account, messages, include_body=not lazy_bodies)
         except EmailAccount.DoesNotExist:
             raise OAuthError(f"Gmail account with ID {email_account_id} not found.")
         except HttpError as e:
-            logger.error(f"Gmail API error during sync for user {self.user.username}: {e}")
-            if e.resp.status == 403:
-                raise PermissionError(
-                    "Insufficient permissions to access Gmail. Please reconnect your account.",
-                    status_code=403,
-                    error_details=str(e)
-                )
-            elif e.resp.status == 429:
-                raise QuotaExceededError(
-                    "Gmail API quota exceeded. Please try again later.",
-                    status_code=429,
-                    error_details=str(e)
-                )
-            else:
-                raise GmailAPIError(
-                    f"Gmail API error: {e}",
-                    status_code=e.resp.status,
-                    error_details=str(e)
-                )
+            self._raise_api_error(e, 'sync')
 
-        messages = results.get('messages', [])
-        synced_emails = []
+        if failed_ids:
+            # No cursor yet: the next run lists the inbox again and fetches them
+            logger.warning(
+                f"{len(failed_ids)} messages of {email_account.email} could not be fetched, "
+                f"keeping the account on full sync"
+            )
+        else:
+            email_account.history_id = str(profile.get('historyId', ''))
+            email_account.save(update_fields=['history_id'])
 
-        for message in messages:
-            msg = service.users().messages().get(
+        logger.info(f"Sync complete for {email_account.email}: {len(synced_emails)} new emails")
+        return synced_emails
+
+    def watch_mailbox(self, email_account_id=None):
+        """
+        Register (or renew) Gmail push notifications for the inbox of the account
+
+        Gmail publishes a message to GMAIL_PUBSUB_TOPIC whenever the mailbox changes; the
+        watch expires after 7 days and must be renewed (see renew_mail_watches).
+
+        Args:
+            email_account_id (int): Specific EmailAccount ID (default: first active Gmail account)
+
+        Returns:
+            datetime: When the watch expires
+        """
+        topic = getattr(settings, 'GMAIL_PUBSUB_TOPIC', '')
+        if not topic:
+            raise GmailAPIError("Gmail push is not configured (GMAIL_PUBSUB_TOPIC is empty)")
+
+        service = self.get_service()
+        if not service:
+            raise OAuthError("Unable to connect to Gmail service. Please reconnect your account.")
+
+        try:
+            email_account = self._get_email_account(email_account_id)
+            response = service.users().watch(
                 userId='me',
-                id=message['id'],
-                format='full'
+                body={
+                    'topicName': topic,
+                    'labelIds': ['INBOX'],
+                    'labelFilterBehavior': 'INCLUDE'
+                }
             ).execute()
+        except EmailAccount.DoesNotExist:
+            raise OAuthError(f"Gmail account with ID {email_account_id} not found.")
+        except HttpError as e:
+            self._raise_api_error(e, 'watch')
 
-            # Extract email data
-            headers = msg['payload'].get('headers', [])
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-            to = next((h['value'] for h in headers if h['name'] == 'To'), 'Unknown')
-            date_str = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-
-            # Parse date
-            try:
-                received_date = datetime.strptime(date_str.split(' (')[0], '%a, %d %b %Y %H:%M:%S %z')
-            except:
-                received_date = datetime.now(timezone.utc)
-
-            # Extract body
-            body_plain = ''
-            body_html = ''
-
-            def extract_body(payload):
-                nonlocal body_plain, body_html
-                if 'parts' in payload:
-                    for part in payload['parts']:
-                        extract_body(part)
-                else:
-                    if payload.get('mimeType') == 'text/plain':
-                        data = payload['body'].get('data', '')
-                        if data:
-                            body_plain = base64.urlsafe_b64decode(data).decode('utf-8')
-                    elif payload.get('mimeType') == 'text/html':
-                        data = payload['body'].get('data', '')
-                        if data:
-                            body_html = base64.urlsafe_b64decode(data).decode('utf-8')
-
-            extract_body(msg['payload'])
-
-            # Save email to database (using new unified model)
-            email, created = Email.objects.update_or_create(
-                email_account=email_account,
-                provider_id=msg['id'],
-                defaults={
-                    'thread_id': msg['threadId'],
-                    'subject': subject,
-                    'sender': sender,
-                    'recipient': to,
-                    'body_plain': body_plain,
-                    'body_html': body_html,
-                    'received_date': received_date,
-                    'is_read': 'UNREAD' not in msg['labelIds']
-                }
+        email_account.push_expires_at = datetime.fromtimestamp(int(response['expiration']) / 1000, tz=timezone.utc)
+        email_account.save(update_fields=['push_expires_at'])
+
+        logger.info(f"Gmail watch registered for {email_account.email} until {email_account.push_expires_at}")
+        return email_account.push_expires_at
+
+    def backfill_page(self, email_account_id=None, page_size=100, lazy_bodies=None):
+        """
+        Ingest one page of the inbox history, walking nextPageToken from newest to oldest
+
+        The page token is persisted on the account after the page is stored, so an interrupted
+        backfill resumes from the last completed page.
+
+        Args:
+            email_account_id (int): Specific EmailAccount ID (default: first active Gmail account)
+            page_size (int): Message ids listed per page (Gmail allows up to 500)
+            lazy_bodies (bool): Defaults to settings.GMAIL_LAZY_BODIES
+
+        Returns:
+            dict: {'fetched': int, 'new_emails': int, 'done': bool}
+        """
+        if lazy_bodies is None:
+            lazy_bodies = getattr(settings, 'GMAIL_LAZY_BODIES', False)
+
+        try:
+            email_account = self._get_email_account(email_account_id)
+            if email_account.backfill_completed_at:
+                return {'fetched': 0, 'new_emails': 0, 'done': True}
+
+            service = self.get_service()
+            if not service:
+                raise OAuthError("Unable to connect to Gmail service. Please reconnect your account.")
+
+            params = {'userId': 'me', 'maxResults': page_size, 'q': 'in:inbox'}
+            if email_account.backfill_cursor:
+                params['pageToken'] = email_account.backfill_cursor
+            results = service.users().messages().list(**params).execute()
+
+            message_ids = [message['id'] for message in results.get('messages', [])]
+            messages, failed_ids = self._fetch_messages(service, message_ids, lazy_bodies)
+            new_count = len(self._store_messages(email_account, messages, include_body=not lazy_bodies))
+        except EmailAccount.DoesNotExist:
+            raise OAuthError(f"Gmail account with ID {email_account_id} not found.")
+        except HttpError as e:
+            self._raise_api_error(e, 'backfill')
+
+        if failed_ids:
+            # The page token is not advanced: the next run fetches the page again
+            raise GmailAPIError(
+                f"{len(failed_ids)} messages of the backfill page could not be fetched; "
+                f"{new_count} stored, the page will be retried"
             )
 
-            if created:
-                synced_emails.append(email)
-                logger.info(f"New email synced from {email_account.email}: {subject[:50]}")
+        email_account.backfill_cursor = results.get('nextPageToken', '')
+        if not email_account.backfill_cursor:
+            email_account.backfill_completed_at = datetime.now(timezone.utc)
+        email_account.save(update_fields=['backfill_cursor', 'backfill_completed_at'])
 
-        logger.info(f"Sync complete for {email_account.email}: {len(synced_emails)} new emails")
+        return {
+            'fetched': len(message_ids),
+            'new_emails': new_count,
+            'done': email_account.backfill_completed_at is not None
+        }
+
+    def _sync_history(self, service, email_account, lazy_bodies=False):
+        """
+        Incremental sync using users.history.list starting at the stored historyId.
+        Only messages added to the inbox or whose labels changed are touched.
+
+        Raises:
+            HttpError: 404 when the stored historyId has expired
+        """
+        added_ids = []
+        label_changes = {}
+        page_token = None
+
+        while True:
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=email_account.history_id,
+                historyTypes=['messageAdded', 'labelAdded', 'labelRemoved'],
+                labelId='INBOX',
+                pageToken=page_token
+            ).execute()
+
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    if 'INBOX' in message.get('labelIds', ['INBOX']) and message['id'] not in added_ids:
+                        added_ids.append(message['id'])
+                for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    message = change['message']
+                    if 'labelIds' in message:
+                        # Later records win, so we keep the latest label state
+                        label_changes[message['id']] = message['labelIds']
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        new_history_id = str(response.get('historyId', email_account.history_id))
+
+        # Label changes on messages we already have only need a flag update
+        existing_ids = set(Email.objects.filter(
+            email_account=email_account,
+            provider_id__in=list(label_changes)
+        ).values_list('provider_id', flat=True))
+
+        read_ids, unread_ids = [], []
+        for msg_id, label_ids in label_changes.items():
+            if msg_id in existing_ids:
+                (unread_ids if 'UNREAD' in label_ids else read_ids).append(msg_id)
+            elif 'INBOX' in label_ids and msg_id not in added_ids:
+                # Moved (back) into the inbox: treat as a new message
+                added_ids.append(msg_id)
+
+        if read_ids:
+            Email.objects.filter(email_account=email_account, provider_id__in=read_ids).update(is_read=True)
+        if unread_ids:
+            Email.objects.filter(email_account=email_account, provider_id__in=unread_ids).update(is_read=False)
+
+        messages, failed_ids = self._fetch_messages(service, added_ids, lazy_bodies)
+        synced_emails = self._store_messages(email_account, messages, include_body=not lazy_bodies)
+
+        if failed_ids:
+            # Keep the cursor: the next run replays this history and fetches them again
+            # (messages stored now are not created twice)
+            logger.warning(
+                f"{len(failed_ids)} messages of {email_account.email} could not be fetched, "
+                f"history cursor not advanced"
+            )
+        else:
+            email_account.history_id = new_history_id
+            email_account.save(update_fields=['history_id'])
+
+        logger.info(
+            f"Incremental sync complete for {email_account.email}: "
+            f"{len(synced_emails)} new emails, {len(label_changes)} label changes"
+        )
         return synced_emails
+
+    def _fetch_messages(self, service, message_ids, lazy_bodies=False):
+        """
+        Fetch full messages, or only the headers we store when bodies are loaded lazily
+
+        Returns:
+            tuple: (messages, failed_ids), see _batch_get_messages
+        """
+        if lazy_bodies:
+            return self._batch_get_messages(
+                service, message_ids, message_format='metadata', metadata_headers=METADATA_HEADERS
+            )
+        return self._batch_get_messages(service, message_ids)
+
+    def _batch_get_messages(self, service, message_ids, message_format='full', metadata_headers=None):
+        """
+        Fetch messages through the Gmail HTTP batch endpoint instead of one request per id.
+
+        Ids are sent in chunks of settings.GMAIL_BATCH_SIZE (Gmail accepts up to 100 sub-requests,
+        but recommends 50 to stay under the per-user rate limit). Sub-requests rejected for rate
+        limiting are retried after a backoff in smaller chunks. Messages that no longer exist
+        (404) are skipped; the ids that failed otherwise, or were still throttled after
+        GMAIL_BATCH_MAX_RETRIES, are returned so the caller does not move its cursor past them.
+
+        Returns:
+            tuple: (messages in the same order as message_ids, ids that could not be fetched)
+        """
+        chunk_size = max(1, min(getattr(settings, 'GMAIL_BATCH_SIZE', 50), 100))
+        max_retries = getattr(settings, 'GMAIL_BATCH_MAX_RETRIES', 3)
+
+        message_ids = list(dict.fromkeys(message_ids))
+        fetched = {}
+        failed_ids = []
+        pending = message_ids
+        attempt = 0
+
+        while pending:
+            retry_ids = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    fetched[request_id] = response
+                elif isinstance(exception, HttpError) and self._is_retryable(exception):
+                    retry_ids.append(request_id)
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    # Deleted before we got to it
+                    logger.info(f"Message {request_id} no longer exists, skipping")
+                else:
+                    logger.error(f"Failed to fetch message {request_id}: {exception}")
+                    failed_ids.append(request_id)
+
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                batch = service.new_batch_http_request(callback=callback)
+                for msg_id in chunk:
+                    params = {'userId': 'me', 'id': msg_id, 'format': message_format}
+                    if metadata_headers:
+                        params['metadataHeaders'] = metadata_headers
+                    batch.add(service.users().messages().get(**params), request_id=msg_id)
+                batch.execute()
+
+                if retry_ids:
+                    # We are being throttled: don't fire the remaining chunks at full size
+                    retry_ids.extend(pending[start + chunk_size:])
+                    break
+
+            if not retry_ids:
+                break
+
+            attempt += 1
+            if attempt > max_retries:
+                logger.warning(f"Giving up on {len(retry_ids)} messages after {max_retries} throttled batch retries")
+                failed_ids.extend(retry_ids)
+                break
+
+            chunk_size = max(1, chunk_size // 2)
+            delay = min(2 ** attempt, 30)
+            logger.warning(
+                f"Gmail batch throttled for user {self.user.username}: retrying {len(retry_ids)} messages "
+                f"in chunks of {chunk_size} after {delay}s"
+            )
+            time.sleep(delay)
+            pending = retry_ids
+
+        return [fetched[msg_id] for msg_id in message_ids if msg_id in fetched], failed_ids
+
+    @staticmethod
+    def _is_retryable(error):
+        """Rate limit (429 / 403 rateLimitExceeded) and transient backend errors"""
+        status = error.resp.status
+        if status == 429 or status >= 500:
+            return True
+        return status == 403 and 'ratelimitexceeded' in str(error).lower()
+
+    def _get_email_account(self, email_account_id=None):
+        """Resolve the EmailAccount to sync (specific ID or first active Gmail account)"""
+        if email_account_id:
+            email_account = EmailAccount.objects.get(
+                id=email_account_id,
+                user=self.user,
+                provider='gmail',
+                is_active=True
+            )
+            logger.info(f"Syncing specific Gmail account: {email_account.email}")
+        else:
+            # Get first active Gmail account for backward compatibility
+            email_account = EmailAccount.objects.filter(
+                user=self.user,
+                provider='gmail',
+                is_active=True
+            ).first()
+
+        if not email_account:
+            raise OAuthError("No active Gmail account found. Please reconnect your account.")
+        return email_account
+
+    def _raise_api_error(self, e, action):
+        """Translate a googleapiclient HttpError into our exception hierarchy"""
+        logger.error(f"Gmail API error during {action} for user {self.user.username}: {e}")
+        if e.resp.status == 403:
+            raise PermissionError(
+                "Insufficient permissions to access Gmail. Please reconnect your account.",
+                status_code=403,
+                error_details=str(e)
+            )
+        elif e.resp.status == 429:
+            raise QuotaExceededError(
+                "Gmail API quota exceeded. Please try again later.",
+                status_code=429,
+                error_details=str(e)
+            )
+        else:
+            raise GmailAPIError(
+                f"Gmail API error: {e}",
+                status_code=e.resp.status,
+                error_details=str(e)
+            )
+
+    def _parse_message(self, msg):
+        """Extract Email field values from a Gmail API message resource"""
+        headers = msg['payload'].get('headers', [])
+        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+        sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
+        to = next((h['value'] for h in headers if h['name'] == 'To'), 'Unknown')
+        date_str = next((h['value'] for h in headers if h['name'] == 'Date'), '')
+
+        # Parse date
+        try:
+            received_date = datetime.strptime(date_str.split(' (')[0], '%a, %d %b %Y %H:%M:%S %z')
+        except:
+            received_date = datetime.now(timezone.utc)
+
+        # Extract body
+        body_plain = ''
+        body_html = ''
+
+        def extract_body(payload):
+            nonlocal body_plain, body_html
+            if 'parts' in payload:
+                for part in payload['parts']:
+                    extract_body(part)
+            else:
+                if payload.get('mimeType') == 'text/plain':
+                    data = payload['body'].get('data', '')
+                    if data:
+                        body_plain = base64.urlsafe_b64decode(data).decode('utf-8')
+                elif payload.get('mimeType') == 'text/html':
+                    data = payload['body'].get('data', '')
+                    if data:
+                        body_html = base64.urlsafe_b64decode(data).decode('utf-8')
+
+        extract_body(msg['payload'])
+
+        return {
+            'thread_id': msg['threadId'],
+            'subject': subject,
+            'sender': sender,
+            'recipient': to,
+            'body_plain': body_plain,
+            'body_html': body_html,
+            'received_date': received_date,
+            'is_read': 'UNREAD' not in msg.get('labelIds', []),
+            'is_bulk': is_bulk_mail({h['name']: h['value'] for h in headers})
+        }
+
+    def _store_messages(self, email_account, msgs, include_body=True):
+        """
+        Save a page of Gmail API messages to the database (using new unified model)
+
+        With include_body=False (metadata-only fetch) existing bodies are left untouched and new
+        rows are flagged body_fetched=False so they get hydrated on first access.
+
+        Returns:
+            list: Newly created Email objects
+        """
+        rows = []
+        for msg in msgs:
+            row = self._parse_message(msg)
+            row['provider_id'] = msg['id']
+            row['body_fetched'] = include_body
+            if not include_body:
+                # Only applies to inserts: bulk_upsert_emails never clears a stored body
+                del row['body_plain'], row['body_html']
+            rows.append(row)
+
+        created = bulk_upsert_emails(email_account, rows)
+        for email in created:
+            logger.info(f"New email synced from {email_account.email}: {email.subject[:50]}")
+        return created
+
+    def hydrate_body(self, email):
+        """
+        Fetch and store the body of an email that was synced metadata-only
+
+        Returns:
+            Email: The same instance with body_plain/body_html populated
+        """
+        service = self.get_service()
+        if not service:
+            raise OAuthError("Unable to connect to Gmail service. Please reconnect your account.")
+
+        try:
+            msg = service.users().messages().get(
+                userId='me',
+                id=email.provider_id,
+                format='full'
+            ).execute()
+        except HttpError as e:
+            self._raise_api_error(e, 'body fetch')
+
+        fields = self._parse_message(msg)
+        email.body_plain = fields['body_plain']
+        email.body_html = fields['body_html']
+        email.body_fetched = True
+        email.cleaned_body = None
+        email.save(update_fields=['body_plain', 'body_html', 'body_fetched', 'cleaned_body'])
+
+        logger.info(f"Hydrated body for email {email.id}: {email.subject[:50]}")
+        return email
     
-    def send_email(self, to_email: str, subject: str, body: str, reply_to_message_id: str = None):
-        """Send email via Gmail API"""
+    def find_message_by_rfc822_id(self, message_id: str):
+        """
+        Look up a message of the mailbox by its Message-ID header (e.g. a reply already sent)
+
+        Returns:
+            str: Gmail message ID, or None when there is no such message
+        """
+        service = self.get_service()
+        if not service:
+            raise OAuthError("Unable to connect to Gmail service")
+
+        try:
+            result = service.users().messages().list(
+                userId='me', q=f'rfc822msgid:{message_id.strip("<>")}', maxResults=1
+            ).execute()
+        except HttpError as e:
+            self._raise_api_error(e, 'looking up sent message')
+        messages = result.get('messages') or []
+        return messages[0]['id'] if messages else None
+
+    def send_email(self, to_email: str, subject: str, body: str, reply_to_message_id: str = None,
+                   message_id: str = None, thread_id: str = None):
+        """
+        Send email via Gmail API
+
+        Args:
+            message_id: Message-ID header to use (lets a retry find the message if it was sent)
+            thread_id: Gmail thread of the email being answered (keeps the reply in the conversation)
+        """
         service = self.get_service()
         if not service:
             raise OAuthError("Unable to connect to Gmail service for sending")
@@ -339,6 +786,8 @@ class GmailService:
             message = MIMEMultipart()
             message['to'] = clean_email
             message['subject'] = subject
+            if message_id:
+                message['Message-ID'] = message_id
             
             # Add reply headers if replying to a message
             if reply_to_message_id:
@@ -353,9 +802,12 @@ class GmailService:
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
             
             # Send message
+            message_body = {'raw': raw_message}
+            if thread_id:
+                message_body['threadId'] = thread_id
             sent_message = service.users().messages().send(
                 userId='me',
-                body={'raw': raw_message}
+                body=message_body
             ).execute()
             
             logger.info(f"Email sent successfully. Message ID: {sent_message['id']}")
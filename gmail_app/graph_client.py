@@ -0,0 +1,142 @@
+"""
+Shared HTTP client for Microsoft Graph and the Microsoft identity platform
+
+- One requests.Session per process with a connection pool (GRAPH_HTTP_POOL_SIZE), so Graph
+  calls of every thread reuse keep-alive TLS connections instead of opening one per call.
+- Every call has a timeout (GRAPH_CONNECT_TIMEOUT_SECONDS / GRAPH_TIMEOUT_SECONDS) and asks for
+  gzip responses.
+- Throttled calls (429) and 503s are retried after the Retry-After Graph sends, up to
+  GRAPH_MAX_RETRIES times. A wait longer than GRAPH_MAX_RETRY_AFTER_SECONDS is not slept: the
+  response is returned and the caller fails, so the job queue retries it later without holding
+  a worker.
+- Only idempotent methods are retried here. A POST (sendMail, createReply, send) may have been
+  carried out before the 503, so it is left to the outbox, which checks for an already-sent
+  reply before trying again.
+- One MSAL ConfidentialClientApplication per process (it resolves the authority over the
+  network when created), with its in-memory token cache and the pooled session.
+"""
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import msal
+import requests
+from django.conf import settings
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('gmail_app')
+
+RETRY_STATUSES = (429, 503)
+# Repeating these cannot perform the operation twice
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'PATCH', 'DELETE')
+
+_session = None
+_msal_apps = {}  # (client_id, authority) -> ConfidentialClientApplication
+_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide pooled session"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                pool_size = getattr(settings, 'GRAPH_HTTP_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                _session = session
+    return _session
+
+
+def _timeout():
+    return (
+        getattr(settings, 'GRAPH_CONNECT_TIMEOUT_SECONDS', 5),
+        getattr(settings, 'GRAPH_TIMEOUT_SECONDS', 30)
+    )
+
+
+def _retry_after(response, attempt):
+    """Seconds to wait before retrying response (Retry-After in seconds or as a date)"""
+    value = response.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0, int(value))
+        except ValueError:
+            try:
+                return max(0, int((parsedate_to_datetime(value) - timezone.now()).total_seconds()) + 1)
+            except (TypeError, ValueError):
+                pass
+    # No usable header: exponential backoff
+    return 2 ** attempt
+
+
+def request(method, url, retry=None, **kwargs):
+    """
+    Graph call through the pooled session (same arguments as requests.request)
+
+    Args:
+        retry (bool): Retry throttled calls (default: only for idempotent methods)
+
+    Returns:
+        requests.Response: The response; a 429/503 only when the retries are exhausted, the
+        requested wait is too long or the call is not retried
+    """
+    kwargs.setdefault('timeout', _timeout())
+    if retry is None:
+        retry = method.upper() in IDEMPOTENT_METHODS
+    max_retries = getattr(settings, 'GRAPH_MAX_RETRIES', 3) if retry else 0
+    max_wait = getattr(settings, 'GRAPH_MAX_RETRY_AFTER_SECONDS', 60)
+    session = get_session()
+
+    attempt = 0
+    while True:
+        response = session.request(method, url, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+            return response
+
+        delay = _retry_after(response, attempt)
+        if delay > max_wait:
+            logger.warning(f"Graph {method} {url[:80]} returned {response.status_code}, retry after {delay}s: giving up")
+            return response
+
+        attempt += 1
+        logger.warning(
+            f"Graph {method} {url[:80]} returned {response.status_code}, "
+            f"retrying in {delay}s ({attempt}/{max_retries})"
+        )
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
+
+
+def get_msal_app(client_id, client_secret, authority):
+    """Process-wide MSAL confidential client (with its token cache) for these credentials"""
+    key = (client_id, authority)
+    session = get_session()
+    with _lock:
+        app = _msal_apps.get(key)
+        if app is None:
+            app = _msal_apps[key] = msal.ConfidentialClientApplication(
+                client_id,
+                authority=authority,
+                client_credential=client_secret,
+                token_cache=msal.TokenCache(),
+                http_client=session,
+                timeout=_timeout()
+            )
+        return app
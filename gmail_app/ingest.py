@@ -0,0 +1,99 @@
+"""
+Bulk persistence of synced messages shared by the provider services
+"""
+import logging
+from django.db import transaction
+from .models import Email
+
+logger = logging.getLogger('gmail_app')
+
+# Rows per INSERT statement (keeps SQLite under its bound-variable limit)
+BULK_BATCH_SIZE = 500
+
+# Fields that are only written when the body was actually downloaded
+BODY_FIELDS = {'body_plain', 'body_html', 'body_fetched', 'cleaned_body'}
+
+# Headers that mark mailing-list / automated mail (RFC 2369, RFC 3834)
+BULK_HEADERS = ['List-Unsubscribe', 'List-Id', 'Precedence', 'Auto-Submitted']
+
+
+def is_bulk_mail(headers):
+    """
+    Whether a message looks like a newsletter or an automated notification
+
+    Args:
+        headers: dict of header name (any case) -> value
+
+    Returns:
+        bool
+    """
+    headers = {name.lower(): (value or '').strip().lower() for name, value in headers.items()}
+    if headers.get('list-unsubscribe') or headers.get('list-id'):
+        return True
+    if headers.get('precedence') in ('bulk', 'list', 'junk'):
+        return True
+    auto_submitted = headers.get('auto-submitted')
+    return bool(auto_submitted) and auto_submitted != 'no'
+
+
+def bulk_upsert_emails(email_account, rows):
+    """
+    Insert or update a page of parsed messages in a single transaction
+
+    Uses INSERT ... ON CONFLICT (email_account, provider_id) DO UPDATE instead of one
+    update_or_create (SELECT + INSERT/UPDATE) per message. Each row only updates the fields
+    it carries: rows without body fields (metadata-only sync) never overwrite a body that is
+    already stored.
+
+    Args:
+        email_account: EmailAccount the messages belong to
+        rows: list of dicts with 'provider_id' plus Email field values
+
+    Returns:
+        list: Newly created Email objects, in the order of rows
+    """
+    if not rows:
+        return []
+
+    # Later rows win if a page contains the same message twice
+    rows_by_id = {row['provider_id']: row for row in rows}
+    for row in rows_by_id.values():
+        if 'body_plain' in row:
+            # A stored body invalidates the cached AI version of it
+            row['cleaned_body'] = None
+
+    # Rows of different shapes (e.g. metadata-only and full-body rows in the same page) are
+    # upserted separately, so a row never gets defaults written over fields it does not carry
+    groups = {}
+    for row in rows_by_id.values():
+        groups.setdefault(frozenset(row), []).append(row)
+
+    with transaction.atomic():
+        existing_ids = set(Email.objects.filter(
+            email_account=email_account,
+            provider_id__in=list(rows_by_id)
+        ).values_list('provider_id', flat=True))
+
+        for fields, group in groups.items():
+            Email.objects.bulk_create(
+                [Email(email_account=email_account, **row) for row in group],
+                batch_size=BULK_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['email_account', 'provider_id'],
+                update_fields=sorted(
+                    field for field in fields
+                    if field != 'provider_id' and (field not in BODY_FIELDS or 'body_plain' in fields)
+                )
+            )
+
+        new_ids = [provider_id for provider_id in rows_by_id if provider_id not in existing_ids]
+        created = {
+            email.provider_id: email
+            for email in Email.objects.filter(email_account=email_account, provider_id__in=new_ids)
+        }
+
+    logger.debug(
+        f"Bulk upsert for {email_account.email}: {len(created)} new, "
+        f"{len(rows_by_id) - len(created)} updated"
+    )
+    return [created[provider_id] for provider_id in new_ids if provider_id in created]
@@ -0,0 +1,276 @@
+"""
+Durable job queue stored in the database
+
+Long work (mailbox syncs, AI processing, sends) is enqueued as Job rows by views, webhooks and
+the scheduler, and executed by `manage.py run_workers` processes instead of the web workers.
+
+Claiming a job:
+- PostgreSQL: SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers never wait on or
+  claim the same row.
+- SQLite (no row locks): the candidate row is leased with a conditional UPDATE that only
+  succeeds while the row is still in the state it was read in, so exactly one worker wins it.
+
+A claimed job holds a lease (JOB_LEASE_SECONDS) that a heartbeat renews while it runs; when
+its worker dies the job is claimed again once the lease expires. Failures are retried with
+exponential backoff up to max_attempts.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .locks import Heartbeat
+from .models import Job
+
+logger = logging.getLogger('gmail_app')
+
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10  # Started by a user or a push notification
+
+# Rows tried by a SQLite worker per claim before giving up to the other workers
+CLAIM_CANDIDATES = 5
+
+_handlers = {}
+
+
+class RetryLater(Exception):
+    """
+    Raised by a handler that cannot run yet (e.g. the account is locked); the run does not
+    count as an attempt
+    """
+
+    def __init__(self, reason, delay=None):
+        super().__init__(reason)
+        self.delay = delay if delay is not None else getattr(settings, 'JOB_RETRY_BASE_SECONDS', 30)
+
+
+def register(kind):
+    """Decorator registering handler(job) for jobs of kind; its return value is the job result"""
+    def decorator(handler):
+        _handlers[kind] = handler
+        return handler
+    return decorator
+
+
+def enqueue(kind, payload=None, user=None, priority=PRIORITY_NORMAL, dedupe_key='', delay=0,
+            max_attempts=None):
+    """
+    Add a job to the queue
+
+    Args:
+        kind (str): Registered handler name
+        payload (dict): JSON arguments of the handler
+        user (User): User the job works for
+        priority (int): Higher runs first
+        dedupe_key (str): While a job with this key is queued, it is returned instead of a new one
+        delay (int): Seconds before the job may run
+        max_attempts (int): Runs before the job is marked failed (default: JOB_MAX_ATTEMPTS)
+
+    Returns:
+        Job: The new job, or the queued job with the same dedupe_key
+    """
+    fields = {
+        'kind': kind,
+        'payload': payload or {},
+        'user': user,
+        'priority': priority,
+        'dedupe_key': dedupe_key,
+        'run_after': timezone.now() + timedelta(seconds=delay),
+        'max_attempts': max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 3),
+    }
+    if not dedupe_key:
+        return Job.objects.create(**fields)
+
+    try:
+        with transaction.atomic():
+            return Job.objects.create(**fields)
+    except IntegrityError:
+        existing = Job.objects.filter(dedupe_key=dedupe_key, status='queued').first()
+        if existing:
+            return existing
+        # The queued job was claimed in the meantime
+        return Job.objects.create(**fields)
+
+
+def _claimable(now, kinds=None):
+    """Due queued jobs and running jobs whose lease expired, in claim order"""
+    jobs = Job.objects.filter(
+        Q(status='queued', run_after__lte=now) | Q(status='running', lease_expires_at__lt=now)
+    ).order_by('-priority', 'run_after', 'id')
+    if kinds:
+        jobs = jobs.filter(kind__in=kinds)
+    return jobs
+
+
+def claim(worker_id, kinds=None):
+    """
+    Lease the next due job to worker_id
+
+    Args:
+        worker_id (str): Unique name of the worker thread
+        kinds (list): Only claim jobs of these kinds (default: any)
+
+    Returns:
+        Job: The claimed job (status 'running'), or None when the queue is empty
+    """
+    now = timezone.now()
+    lease = {
+        'status': 'running',
+        'locked_by': worker_id,
+        'lease_expires_at': now + timedelta(seconds=getattr(settings, 'JOB_LEASE_SECONDS', 300)),
+        'attempts': F('attempts') + 1,
+    }
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = _claimable(now, kinds).select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**lease)
+        job_id = job.pk
+    else:
+        job_id = None
+        candidates = _claimable(now, kinds).values(
+            'id', 'status', 'locked_by', 'attempts'
+        )[:CLAIM_CANDIDATES]
+        for candidate in candidates:
+            # Matches only if no other worker leased the row since we read it
+            if Job.objects.filter(**candidate).update(**lease):
+                job_id = candidate['id']
+                break
+        if job_id is None:
+            return None
+
+    return Job.objects.get(pk=job_id)
+
+
+def run_job(job):
+    """
+    Execute a claimed job and record the outcome
+
+    Returns:
+        bool: True when the handler succeeded
+    """
+    if job.attempts > job.max_attempts:
+        # Its workers kept dying before finishing (lease expired on every attempt)
+        _finish(job, 'failed', error=job.last_error or 'Lease expired on every attempt')
+        return False
+
+    handler = _handlers.get(job.kind)
+    lease_seconds = getattr(settings, 'JOB_LEASE_SECONDS', 300)
+
+    def extend_lease():
+        return bool(Job.objects.filter(pk=job.pk, locked_by=job.locked_by, status='running').update(
+            lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds)
+        ))
+
+    # Keep the lease while the handler runs, however long it takes
+    heartbeat = Heartbeat(lease_seconds / 3, extend_lease, name=f'job-{job.pk}').start()
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job kind '{job.kind}'")
+        result = handler(job)
+    except RetryLater as e:
+        logger.info(f"Job {job} postponed {e.delay}s: {e}")
+        _postpone(job, e.delay, str(e))
+        return False
+    except Exception as e:
+        logger.exception(f"Job {job} failed (attempt {job.attempts}/{job.max_attempts})")
+        _retry_or_fail(job, f"{e.__class__.__name__}: {e}")
+        return False
+    finally:
+        heartbeat.stop()
+
+    _finish(job, 'done', result=result)
+    return True
+
+
+def _finish(job, status, result=None, error=''):
+    """Store the final state, unless another worker took the job over after our lease expired"""
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+        status=status,
+        result=result,
+        last_error=error,
+        lease_expires_at=None,
+        finished_at=timezone.now(),
+        updated_at=timezone.now()
+    )
+
+
+def _retry_or_fail(job, error):
+    """Queue the job again after an exponential backoff, or fail it when attempts are exhausted"""
+    if job.attempts >= job.max_attempts:
+        _finish(job, 'failed', error=error)
+        return
+
+    base = getattr(settings, 'JOB_RETRY_BASE_SECONDS', 30)
+    delay = min(getattr(settings, 'JOB_RETRY_MAX_SECONDS', 3600), base * 2 ** (job.attempts - 1))
+    _requeue(job, delay, error)
+
+
+def _postpone(job, delay, reason):
+    """Queue the job again without counting this run as an attempt"""
+    _requeue(job, delay, reason, attempts=F('attempts') - 1)
+
+
+def _requeue(job, delay, error, **fields):
+    """Put a running job back in the queue to run after delay seconds"""
+    try:
+        with transaction.atomic():
+            Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+                status='queued',
+                locked_by='',
+                lease_expires_at=None,
+                last_error=error,
+                run_after=timezone.now() + timedelta(seconds=delay),
+                updated_at=timezone.now(),
+                **fields
+            )
+    except IntegrityError:
+        # A newer job with the same dedupe_key is queued and will do the work
+        _finish(job, 'done', result={'status': 'superseded'}, error=error)
+
+
+def work(worker_id, stop_event, kinds=None, burst=False, deadline=None):
+    """
+    Claim and run jobs until stop_event is set
+
+    Args:
+        worker_id (str): Unique name of the worker thread
+        stop_event (threading.Event): Set to stop after the current job
+        kinds (list): Only run jobs of these kinds
+        burst (bool): Return as soon as the queue is empty
+        deadline (float): time.monotonic() after which no new job is claimed
+
+    Returns:
+        int: Number of jobs run
+    """
+    poll_seconds = getattr(settings, 'JOB_POLL_SECONDS', 2)
+    processed = 0
+    try:
+        while not stop_event.is_set():
+            if deadline and time.monotonic() >= deadline:
+                break
+            try:
+                job = claim(worker_id, kinds)
+            except Exception as e:
+                logger.error(f"Worker {worker_id} could not claim a job: {e}")
+                job = None
+
+            if job is None:
+                if burst:
+                    break
+                stop_event.wait(poll_seconds)
+                continue
+
+            run_job(job)
+            processed += 1
+    finally:
+        # Each worker thread has its own database connection
+        connections.close_all()
+    return processed
+
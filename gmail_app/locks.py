@@ -0,0 +1,142 @@
+"""
+Distributed locks stored in the database
+
+Cron, the APScheduler job and the job workers of every instance may start the same work at
+the same time. Each entry point takes a named lease first:
+
+- 'auto_sync', 'renew_mail_watches', 'retry_ai_failures': one run of the command at a time
+- 'sync-account:<id>': one sync (or push fetch) of an account at a time
+- 'backfill-account:<id>': one backfill of an account at a time
+- 'token-refresh:<id>': one proactive token refresh of an account at a time
+
+A lease expires LOCK_TTL_SECONDS after its last renewal. While it is held a heartbeat thread
+renews it, so long work keeps it and the lock of a crashed process frees itself quickly.
+"""
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.utils import timezone
+
+from .models import Lease
+
+logger = logging.getLogger('gmail_app')
+
+
+class LockHeld(Exception):
+    """The lock is held by another process"""
+
+    def __init__(self, name):
+        super().__init__(f"Lock '{name}' is held by another process")
+        self.name = name
+
+
+def default_owner():
+    """Identity of the calling thread across instances"""
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def _ttl(ttl):
+    return ttl or getattr(settings, 'LOCK_TTL_SECONDS', 120)
+
+
+def acquire(name, owner, ttl=None):
+    """
+    Take the lock if it is free or expired
+
+    Returns:
+        bool: True when owner now holds the lock
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=_ttl(ttl))
+
+    # Take over an expired lease (the conditional UPDATE lets a single process win)
+    if Lease.objects.filter(name=name, expires_at__lt=now).update(
+        owner=owner, expires_at=expires_at, acquired_at=now, renewed_at=now
+    ):
+        return True
+
+    try:
+        with transaction.atomic():
+            Lease.objects.create(name=name, owner=owner, expires_at=expires_at, acquired_at=now, renewed_at=now)
+        return True
+    except IntegrityError:
+        return False
+
+
+def renew(name, owner, ttl=None):
+    """
+    Extend the lease of owner
+
+    Returns:
+        bool: False when the lease was lost (expired and taken by another process)
+    """
+    now = timezone.now()
+    return bool(Lease.objects.filter(name=name, owner=owner).update(
+        expires_at=now + timedelta(seconds=_ttl(ttl)), renewed_at=now
+    ))
+
+
+def release(name, owner):
+    """Free the lock if owner still holds it"""
+    Lease.objects.filter(name=name, owner=owner).delete()
+
+
+class Heartbeat:
+    """Background thread calling beat() every `interval` seconds until stopped"""
+
+    def __init__(self, interval, beat, name='heartbeat'):
+        self.interval = interval
+        self.beat = beat
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    if self.beat() is False:
+                        return
+                except Exception as e:
+                    logger.error(f"Heartbeat {self._thread.name} failed: {e}")
+        finally:
+            connections.close_all()
+
+
+@contextmanager
+def hold(name, ttl=None):
+    """
+    Hold the lock for the duration of the block, renewing it in the background
+
+    Raises:
+        LockHeld: Another process holds the lock
+    """
+    ttl = _ttl(ttl)
+    owner = default_owner()
+    if not acquire(name, owner, ttl):
+        raise LockHeld(name)
+
+    def beat():
+        if not renew(name, owner, ttl):
+            logger.warning(f"Lost lock '{name}' while holding it")
+            return False
+
+    heartbeat = Heartbeat(ttl / 3, beat, name=f'lock-{name}').start()
+    try:
+        yield
+    finally:
+        heartbeat.stop()
+        release(name, owner)
@@ -0,0 +1,111 @@
+"""
+Provider-agnostic sending of AI replies
+
+A reply goes out from the mailbox that received the email (Email.email_account), whatever its
+provider:
+- Gmail: users.messages.send in the original thread (threadId), with the response's
+  Message-ID so a retry can look it up (rfc822msgid:).
+- Outlook: Graph createReply + send, which keeps the conversation. The draft is created with an
+  immutable ID that is stored on the response before sending, so a retry can tell whether it
+  was already sent.
+
+Tokens and Gmail clients of each account are cached process-wide (gmail_app.client_cache).
+"""
+import logging
+
+from .exceptions import OAuthError
+from .gmail_service import GmailService
+from .models import EmailAccount
+from .outlook_service import OutlookService
+
+logger = logging.getLogger('gmail_app')
+
+
+def resolve_account(email):
+    """
+    EmailAccount that received email
+
+    Legacy rows (only gmail_account) map to the user's Gmail EmailAccount with the same address.
+
+    Returns:
+        EmailAccount, or None when a legacy row has no EmailAccount
+    """
+    if email.email_account_id:
+        return email.email_account
+
+    legacy = email.gmail_account
+    return EmailAccount.objects.filter(
+        user=legacy.user, provider='gmail', email__iexact=legacy.email, is_active=True
+    ).first()
+
+
+def get_client(account):
+    """Service of account (GmailService bound to its tokens, or OutlookService)"""
+    if account.provider == 'gmail':
+        return GmailService(account.user, email_account=account)
+    return OutlookService(account.user)
+
+
+def _client_for(email):
+    """(account, client) sending replies to email"""
+    account = resolve_account(email)
+    if account is None:
+        # Legacy Gmail row without EmailAccount: legacy per-user credentials
+        return None, GmailService(email.gmail_account.user)
+    if not account.is_active:
+        raise OAuthError(f"{account.email} is disconnected. Reconnect it to send replies.")
+    return account, get_client(account)
+
+
+def find_sent_reply(ai_response, email):
+    """
+    Provider ID of the reply if a previous attempt already sent it
+
+    Returns:
+        str: Message ID, or None when it has to be sent
+    """
+    account, client = _client_for(email)
+    if account is not None and account.provider == 'outlook':
+        draft_id = ai_response.provider_message_id
+        if draft_id and client.get_draft_state(draft_id, email_account_id=account.id) == 'sent':
+            return draft_id
+        return None
+    return client.find_message_by_rfc822_id(ai_response.idempotency_key)
+
+
+def send_reply(ai_response, email):
+    """
+    Send ai_response as the reply to email from the account that received it
+
+    Returns:
+        str: Provider ID of the sent message
+    """
+    account, client = _client_for(email)
+    if account is not None and account.provider == 'outlook':
+        return _send_outlook_reply(ai_response, email, account, client)
+
+    return client.send_email(
+        to_email=email.sender,
+        subject=ai_response.response_subject,
+        body=ai_response.response_text,
+        reply_to_message_id=email.provider_id,
+        message_id=ai_response.idempotency_key,
+        thread_id=email.thread_id or None
+    )
+
+
+def _send_outlook_reply(ai_response, email, account, client):
+    """createReply + send, reusing the draft of a previous attempt that did not send it"""
+    draft_id = ai_response.provider_message_id
+    state = client.get_draft_state(draft_id, email_account_id=account.id) if draft_id else None
+    if state == 'sent':
+        return draft_id
+
+    if state is None:
+        draft_id = client.create_reply_draft(email.provider_id, ai_response.response_text, email_account_id=account.id)
+        # Stored before sending so a retry finds the draft instead of creating another reply
+        ai_response.provider_message_id = draft_id
+        ai_response.save(update_fields=['provider_message_id'])
+
+    client.send_draft(draft_id, email_account_id=account.id)
+    return draft_id
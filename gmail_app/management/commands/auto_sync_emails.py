@@ -1,22 +1,37 @@
 """
 Comando de management para sincronizar emails automáticamente
-Se ejecuta periódicamente mediante APScheduler
+Se ejecuta periódicamente mediante APScheduler y cron
+
+Sincroniza todas las EmailAccount activas (Gmail y Outlook) en paralelo con un pool de
+threads. Cada proveedor tiene su propio límite de concurrencia y los errores de una cuenta
+no afectan a las demás.
+
+Cron y el scheduler de cada instancia pueden lanzarlo a la vez: el lock 'auto_sync' evita
+ejecuciones solapadas y el lock 'sync-account:<id>' que una cuenta se sincronice dos veces
+al mismo tiempo (también desde los jobs de push).
 """
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from django.utils import timezone
-from gmail_app.models import GmailAccount, Email
+from django.db import connections
+from gmail_app.models import EmailAccount, GmailAccount
 from gmail_app.gmail_service import GmailService
+from gmail_app.outlook_service import OutlookService
 from gmail_app.ai_service import EmailAIProcessor
 from gmail_app.ai_models import AIRole
 from gmail_app.exceptions import RefreshTokenInvalidError, GmailAPIError
+from gmail_app.locks import hold, LockHeld
+from gmail_app.outbox import queue_send
 
 logger = logging.getLogger('gmail_app')
 
 
 class Command(BaseCommand):
-    help = 'Sincroniza emails automáticamente para todos los usuarios con cuentas Gmail conectadas'
+    help = 'Sincroniza emails automáticamente para todas las cuentas Gmail y Outlook conectadas'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -24,151 +39,222 @@ class Command(BaseCommand):
             type=str,
             help='Sincronizar solo para un usuario específico (username)',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Número de cuentas sincronizadas en paralelo (default: AUTO_SYNC_MAX_WORKERS)',
+        )
+        parser.add_argument(
+            '--serial',
+            action='store_true',
+            help='Sincronizar las cuentas una por una',
+        )
 
     def handle(self, *args, **options):
+        try:
+            with hold('auto_sync'):
+                self.sync_all(options)
+        except LockHeld:
+            self.stdout.write(self.style.WARNING('Otra sincronización automática está en curso, omitiendo'))
+
+    def sync_all(self, options):
+        """Sincroniza todas las cuentas activas (o las de --user)"""
         username = options.get('user')
 
+        accounts = EmailAccount.objects.filter(is_active=True).select_related('user')
         if username:
             # Sincronizar solo para un usuario específico
-            try:
-                user = User.objects.get(username=username)
-                self.sync_user_emails(user)
-            except User.DoesNotExist:
+            if not User.objects.filter(username=username).exists():
                 self.stdout.write(self.style.ERROR(f'Usuario "{username}" no encontrado'))
+                return
+            accounts = accounts.filter(user__username=username)
+
+        accounts = list(accounts)
+        if not accounts:
+            self.stdout.write(self.style.WARNING('No hay cuentas de correo conectadas'))
+            return
+
+        if options.get('serial'):
+            workers = 1
         else:
-            # Sincronizar para todos los usuarios con Gmail conectado
-            gmail_accounts = GmailAccount.objects.select_related('user').all()
+            workers = options.get('workers') or getattr(settings, 'AUTO_SYNC_MAX_WORKERS', 8)
 
-            if not gmail_accounts:
-                self.stdout.write(self.style.WARNING('No hay cuentas Gmail conectadas'))
-                return
+        self.stdout.write(f'Sincronizando {len(accounts)} cuentas ({workers} en paralelo)...')
+        started = time.monotonic()
 
-            self.stdout.write(f'Sincronizando {gmail_accounts.count()} cuentas...')
+        if workers == 1:
+            results = [self.sync_account(account) for account in accounts]
+            for result in results:
+                self.report_account(result)
+        else:
+            results = self.sync_parallel(accounts, workers)
 
-            success_count = 0
-            error_count = 0
+        self.report_summary(results, time.monotonic() - started)
 
-            for gmail_account in gmail_accounts:
-                try:
-                    self.sync_user_emails(gmail_account.user)
-                    success_count += 1
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f'Error al sincronizar {gmail_account.user.username}: {e}')
+    def sync_parallel(self, accounts, workers):
+        """Sincroniza las cuentas en un pool de threads respetando el límite por proveedor"""
+        provider_limits = getattr(settings, 'AUTO_SYNC_PROVIDER_CONCURRENCY', {})
+        semaphores = {
+            provider: threading.BoundedSemaphore(provider_limits.get(provider, workers))
+            for provider in {account.provider for account in accounts}
+        }
 
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Sincronización completada: {success_count} exitosas, {error_count} errores'
-                )
-            )
+        results = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auto-sync') as pool:
+            futures = [
+                pool.submit(self.sync_account_isolated, account, semaphores[account.provider])
+                for account in accounts
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                self.report_account(result)
+                results.append(result)
+        return results
 
-    def sync_user_emails(self, user):
-        """Sincroniza emails para un usuario específico"""
+    def sync_account_isolated(self, account, semaphore):
+        """Ejecuta sync_account dentro del límite del proveedor y libera la conexión del thread"""
         try:
-            gmail_service = GmailService(user)
-            synced_emails = gmail_service.sync_emails()
+            with semaphore:
+                return self.sync_account(account)
+        finally:
+            # Cada thread abre su propia conexión a la base de datos
+            connections.close_all()
 
-            if not synced_emails:
-                self.stdout.write(f'  [{user.username}] No hay emails nuevos')
-                return
+    def sync_account(self, account):
+        """
+        Sincroniza una cuenta y procesa los emails nuevos con IA.
+        Nunca lanza excepciones: el error queda registrado en el resultado
+        (status 'locked' si otro proceso ya está sincronizando la cuenta).
+        """
+        result = {
+            'account': account,
+            'status': 'ok',
+            'new_emails': 0,
+            'ai_processed': 0,
+            'responses_generated': 0,
+            'auto_sent': 0,
+            'error': '',
+        }
+        started = time.monotonic()
+        user = account.user
 
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'  [{user.username}] {len(synced_emails)} emails sincronizados'
-                )
-            )
+        try:
+            with hold(f'sync-account:{account.id}'):
+                if account.provider == 'gmail':
+                    synced_emails = GmailService(user, email_account=account).sync_emails(email_account_id=account.id)
+                else:
+                    synced_emails = OutlookService(user).sync_emails(email_account_id=account.id)['emails']
 
-            # Procesar con IA si está configurado
-            try:
-                # Get active AIRole
-                ai_context = AIRole.get_active_role(user)
-
-                if not ai_context:
-                    logger.info(f"No active AI role for user {user.username}, skipping AI processing")
-                    return
-
-                ai_processor = EmailAIProcessor()
-
-                processed_count = 0
-                responses_generated = 0
-                auto_sent = 0
-
-                logger.info(f"Processing emails with AIRole: {ai_context}")
-
-                for email in synced_emails:
-                    try:
-                        intent, ai_response = ai_processor.process_email(email)
-                        processed_count += 1
-
-                        if ai_response:
-                            responses_generated += 1
-
-                            # Auto-enviar si está configurado
-                            if ai_context.auto_send and ai_response.status == 'pending_approval':
-                                try:
-                                    # Enviar el email automáticamente
-                                    sent_message_id = gmail_service.send_email(
-                                        to_email=ai_response.email_intent.email.sender,
-                                        subject=ai_response.response_subject,
-                                        body=ai_response.response_text,
-                                        reply_to_message_id=ai_response.email_intent.email.provider_id
-                                    )
-
-                                    # Marcar como enviado
-                                    ai_response.status = 'sent'
-                                    ai_response.sent_at = timezone.now()
-                                    ai_response.save()
-
-                                    auto_sent += 1
-                                    logger.info(
-                                        f'Auto-enviado: {ai_response.response_subject[:50]} a {email.sender}'
-                                    )
-                                except Exception as e:
-                                    logger.error(f'Error auto-enviando email {email.id}: {e}')
-                                    # Dejar como approved si falla el envío
-                                    ai_response.status = 'approved'
-                                    ai_response.save()
-
-                    except Exception as e:
-                        logger.error(f'Error procesando email {email.id}: {e}')
-
-                if responses_generated > 0:
-                    self.stdout.write(
-                        f'    ├─ IA procesó {processed_count} emails'
-                    )
-                    self.stdout.write(
-                        f'    ├─ {responses_generated} respuestas generadas'
-                    )
-                    if auto_sent > 0:
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'    └─ {auto_sent} respuestas AUTO-ENVIADAS'
-                            )
-                        )
-                    else:
-                        self.stdout.write(
-                            f'    └─ 0 auto-enviadas (pendientes de aprobación)'
-                        )
-
-        except RefreshTokenInvalidError as e:
-            self.stdout.write(
-                self.style.ERROR(
-                    f'  [{user.username}] Token expirado - Se requiere reconexión'
-                )
-            )
-            # Eliminar cuenta para forzar reconexión
-            try:
-                GmailAccount.objects.get(user=user).delete()
-            except GmailAccount.DoesNotExist:
-                pass
+                result['new_emails'] = len(synced_emails)
+                if synced_emails:
+                    self.process_with_ai(account, synced_emails, result)
+
+        except LockHeld:
+            result['status'] = 'locked'
+            result['error'] = 'Sincronización en curso en otro proceso'
+
+        except RefreshTokenInvalidError:
+            result['status'] = 'error'
+            result['error'] = 'Token expirado - Se requiere reconexión'
+            # Desactivar la cuenta (también la saca del cache de clientes) para forzar reconexión
+            account.is_active = False
+            account.save(update_fields=['is_active'])
+            # La cuenta legacy solo se elimina si es el mismo buzón
+            GmailAccount.objects.filter(user=user, email__iexact=account.email).delete()
 
         except GmailAPIError as e:
-            self.stdout.write(
-                self.style.ERROR(f'  [{user.username}] Error de API: {str(e)}')
-            )
+            result['status'] = 'error'
+            result['error'] = f'Error de API: {str(e)}'
 
         except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f'Error inesperado: {str(e)}'
+            logger.exception(f'Error sincronizando {account.email} ({user.username})')
+
+        result['elapsed_ms'] = int((time.monotonic() - started) * 1000)
+        return result
+
+    def process_with_ai(self, account, synced_emails, result):
+        """Procesa los emails nuevos con IA y auto-envía si el rol lo permite"""
+        user = account.user
+
+        # Get active AIRole
+        ai_context = AIRole.get_active_role(user)
+        if not ai_context:
+            logger.info(f"No active AI role for user {user.username}, skipping AI processing")
+            return
+
+        ai_processor = EmailAIProcessor()
+
+        logger.info(f"Processing emails with AIRole: {ai_context}")
+
+        try:
+            processed = ai_processor.process_emails(synced_emails)
+        except Exception as e:
+            logger.error(f'Error procesando emails de {account.email}: {e}')
+            return
+        result['ai_processed'] = len(processed)
+
+        for intent, ai_response in processed:
+            if not ai_response:
+                continue
+            result['responses_generated'] += 1
+            email = intent.email
+
+            # Auto-enviar si está configurado: se encola y los workers lo envían desde la
+            # cuenta que recibió el email, respetando su límite de envíos
+            if ai_context.auto_send and ai_response.status == 'pending_approval':
+                try:
+                    queue_send(ai_response, user)
+                    result['auto_sent'] += 1
+                    logger.info(
+                        f'Auto-envío encolado: {ai_response.response_subject[:50]} a {email.sender}'
+                    )
+                except Exception as e:
+                    logger.error(f'Error encolando auto-envío del email {email.id}: {e}')
+
+    def report_account(self, result):
+        """Imprime el resultado de una cuenta"""
+        account = result['account']
+        label = f'  [{account.user.username}] {account.email} ({account.provider})'
+
+        if result['status'] == 'locked':
+            self.stdout.write(self.style.WARNING(f'{label} {result["error"]}'))
+            return
+
+        if result['status'] != 'ok':
+            self.stdout.write(self.style.ERROR(f'{label} {result["error"]}'))
+            return
+
+        if not result['new_emails']:
+            self.stdout.write(f'{label} No hay emails nuevos')
+            return
+
+        self.stdout.write(self.style.SUCCESS(f'{label} {result["new_emails"]} emails sincronizados'))
+        if result['responses_generated'] > 0:
+            self.stdout.write(f'    ├─ IA procesó {result["ai_processed"]} emails')
+            self.stdout.write(f'    ├─ {result["responses_generated"]} respuestas generadas')
+            if result['auto_sent'] > 0:
+                self.stdout.write(self.style.SUCCESS(f'    └─ {result["auto_sent"]} respuestas en cola de AUTO-ENVÍO'))
+            else:
+                self.stdout.write('    └─ 0 auto-enviadas (pendientes de aprobación)')
+
+    def report_summary(self, results, elapsed):
+        """Imprime el resumen de tiempos por cuenta (las más lentas primero)"""
+        success_count = sum(1 for result in results if result['status'] == 'ok')
+        error_count = len(results) - success_count
+
+        self.stdout.write('Tiempos por cuenta:')
+        for result in sorted(results, key=lambda r: r['elapsed_ms'], reverse=True):
+            account = result['account']
             self.stdout.write(
-                self.style.ERROR(f'  [{user.username}] Error inesperado: {str(e)}')
+                f'  {result["elapsed_ms"]:>7} ms  {result["status"]:<5}  '
+                f'{account.email} ({account.provider})  {result["new_emails"]} nuevos'
             )
-            logger.exception(f'Error sincronizando para {user.username}')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Sincronización completada en {elapsed:.1f}s: '
+                f'{success_count} exitosas, {error_count} errores'
+            )
+        )
@@ -0,0 +1,89 @@
+"""
+Management command to ingest the full mailbox history of connected accounts
+Walks the provider's pages from newest to oldest and persists the cursor after every page,
+so it can be stopped at any time and resumed later:
+
+    python manage.py backfill_emails --user alice --sleep 1
+"""
+import time
+import logging
+from django.core.management.base import BaseCommand
+from gmail_app.locks import hold, LockHeld
+from gmail_app.models import EmailAccount
+from gmail_app.gmail_service import GmailService
+from gmail_app.outlook_service import OutlookService
+
+logger = logging.getLogger('gmail_app')
+
+
+class Command(BaseCommand):
+    help = 'Backfill the complete inbox history of Gmail and Outlook accounts (resumable)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', help='EmailAccount ID (repeatable)')
+        parser.add_argument('--user', type=str, help='Only backfill accounts of this username')
+        parser.add_argument('--page-size', type=int, default=100, help='Messages per page (default: 100)')
+        parser.add_argument('--max-pages', type=int, help='Stop each account after this many pages in this run')
+        parser.add_argument('--sleep', type=float, default=0.0, help='Seconds to wait between pages (throttling)')
+        parser.add_argument('--reset', action='store_true', help='Discard stored cursors and start from the newest mail')
+
+    def handle(self, *args, **options):
+        accounts = EmailAccount.objects.filter(is_active=True).select_related('user')
+        if options['account']:
+            accounts = accounts.filter(id__in=options['account'])
+        if options['user']:
+            accounts = accounts.filter(user__username=options['user'])
+
+        if options['reset']:
+            accounts.update(backfill_cursor='', backfill_completed_at=None)
+        else:
+            accounts = accounts.filter(backfill_completed_at__isnull=True)
+
+        if not accounts:
+            self.stdout.write(self.style.WARNING('No accounts pending backfill'))
+            return
+
+        for account in accounts:
+            try:
+                with hold(f'backfill-account:{account.id}'):
+                    self.backfill_account(account, options)
+            except LockHeld:
+                self.stdout.write(self.style.WARNING(f'{account.email} is being backfilled by another process, skipping'))
+
+    def backfill_account(self, account, options):
+        """Ingest pages for one account until done, --max-pages is reached or an error occurs"""
+        if account.provider == 'gmail':
+            service = GmailService(account.user, email_account=account)
+        else:
+            service = OutlookService(account.user)
+
+        resumed = ' (resuming)' if account.backfill_cursor else ''
+        self.stdout.write(f'Backfilling {account.email} ({account.provider}){resumed}')
+
+        pages = 0
+        fetched = 0
+        new_emails = 0
+        while True:
+            try:
+                result = service.backfill_page(email_account_id=account.id, page_size=options['page_size'])
+            except Exception as e:
+                # Cursor of the last completed page is already saved: rerun to resume
+                logger.exception(f'Backfill failed for {account.email}')
+                self.stdout.write(self.style.ERROR(f'  Error after {pages} pages: {e}'))
+                return
+
+            pages += 1
+            fetched += result['fetched']
+            new_emails += result['new_emails']
+            self.stdout.write(f'  page {pages}: {result["fetched"]} fetched, {result["new_emails"]} new')
+
+            if result['done']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'  Backfill complete for {account.email}: {fetched} fetched, {new_emails} new'
+                ))
+                return
+            if options['max_pages'] and pages >= options['max_pages']:
+                self.stdout.write(f'  Paused after {pages} pages, run again to continue')
+                return
+            if options['sleep']:
+                time.sleep(options['sleep'])
@@ -0,0 +1,66 @@
+"""
+Management command to process the AI backlog offline with the OpenAI Batch API
+Submits unprocessed emails as batch jobs and applies the results of finished jobs:
+
+    python manage.py process_ai_backlog --user alice      # submit + poll once
+    python manage.py process_ai_backlog --poll            # only poll pending jobs
+    python manage.py process_ai_backlog --wait            # submit, then poll until everything is applied
+"""
+import time
+import logging
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from gmail_app.ai_batch import AIBatchProcessor
+from gmail_app.ai_models import AIBatchJob
+
+logger = logging.getLogger('gmail_app')
+
+
+class Command(BaseCommand):
+    help = 'Process unanalyzed emails with the OpenAI Batch API (submit jobs and apply finished ones)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, help='Only emails of this username (default: all users)')
+        parser.add_argument('--limit', type=int, help='Maximum number of emails to submit')
+        parser.add_argument('--poll', action='store_true', help='Do not submit, only poll pending jobs')
+        parser.add_argument('--wait', action='store_true', help='Keep polling until every job is applied')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between polls with --wait (default: 60)')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if not user:
+                self.stdout.write(self.style.ERROR(f'User "{options["user"]}" not found'))
+                return
+
+        processor = AIBatchProcessor()
+
+        if not options['poll']:
+            result = processor.submit_backlog(user=user, limit=options['limit'])
+            self.stdout.write(
+                f'{result["decided_locally"]} emails decided locally, '
+                f'{result["submitted"]} submitted in {len(result["jobs"])} batch jobs'
+            )
+
+        while True:
+            for job in processor.poll():
+                self.stdout.write(self.style.SUCCESS(
+                    f'Applied {job.phase} batch {job.openai_batch_id} ({job.status}): '
+                    f'{job.completed_count} completed, {job.failed_count} failed'
+                ))
+
+            pending = AIBatchJob.objects.filter(applied_at__isnull=True)
+            if user:
+                pending = pending.filter(user=user)
+            pending = pending.count()
+
+            if not pending or not options['wait']:
+                break
+            self.stdout.write(f'{pending} batch jobs pending, next poll in {options["interval"]}s')
+            time.sleep(options['interval'])
+
+        if pending:
+            self.stdout.write(f'{pending} batch jobs still pending (run with --poll later)')
+        else:
+            self.stdout.write(self.style.SUCCESS('No pending batch jobs'))
@@ -0,0 +1,79 @@
+"""
+Management command to register and renew push notifications before they expire
+(Gmail users.watch lasts 7 days, Graph subscriptions about 3). Runs from the scheduler and cron:
+
+    python manage.py renew_mail_watches
+    python manage.py renew_mail_watches --force --account 3
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from gmail_app.locks import hold, LockHeld
+from gmail_app.models import EmailAccount
+from gmail_app.gmail_service import GmailService
+from gmail_app.outlook_service import OutlookService
+
+logger = logging.getLogger('gmail_app')
+
+
+class Command(BaseCommand):
+    help = 'Register or renew Gmail watches and Outlook subscriptions that are missing or about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', help='EmailAccount ID (repeatable)')
+        parser.add_argument('--force', action='store_true', help='Renew even if the watch is not about to expire')
+
+    def handle(self, *args, **options):
+        try:
+            with hold('renew_mail_watches'):
+                self.renew_all(options)
+        except LockHeld:
+            self.stdout.write(self.style.WARNING('Push subscriptions are being renewed by another process, skipping'))
+
+    def renew_all(self, options):
+        """Renew the watches that are missing or about to expire (all of them with --force)"""
+        accounts = EmailAccount.objects.filter(is_active=True).select_related('user')
+        if options['account']:
+            accounts = accounts.filter(id__in=options['account'])
+        if not options['force']:
+            renew_before = timedelta(hours=getattr(settings, 'MAIL_WATCH_RENEW_BEFORE_HOURS', 24))
+            accounts = accounts.filter(
+                Q(push_expires_at__isnull=True) | Q(push_expires_at__lte=timezone.now() + renew_before)
+            )
+
+        renewed = 0
+        failed = 0
+        for account in accounts:
+            try:
+                if not self.renew(account):
+                    continue
+                renewed += 1
+                self.stdout.write(f'  {account.email} ({account.provider}) until {account.push_expires_at}')
+            except Exception as e:
+                failed += 1
+                logger.error(f'Error renewing push for {account.email}: {e}')
+                self.stdout.write(self.style.ERROR(f'  {account.email} ({account.provider}) {e}'))
+
+        self.stdout.write(self.style.SUCCESS(f'{renewed} push subscriptions renewed, {failed} errors'))
+
+    def renew(self, account):
+        """
+        Renew the push registration of one account
+
+        Returns:
+            bool: False when push is not configured for the account's provider
+        """
+        if account.provider == 'gmail':
+            if not getattr(settings, 'GMAIL_PUBSUB_TOPIC', ''):
+                return False
+            account.push_expires_at = GmailService(account.user, email_account=account).watch_mailbox(account.id)
+            return True
+        if account.provider == 'outlook':
+            if not getattr(settings, 'OUTLOOK_NOTIFICATION_URL', ''):
+                return False
+            account.push_expires_at = OutlookService(account.user).subscribe_inbox(account.id)
+            return True
+        return False
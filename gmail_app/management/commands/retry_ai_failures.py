@@ -0,0 +1,71 @@
+"""
+Management command to re-analyze emails whose AI analysis failed with a transient error
+(rate limit, timeout, OpenAI 5xx). Runs periodically from the scheduler:
+
+    python manage.py retry_ai_failures --limit 50
+"""
+import logging
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from gmail_app.ai_models import EmailIntent
+from gmail_app.ai_service import EmailAIProcessor
+from gmail_app.locks import hold, LockHeld
+
+logger = logging.getLogger('gmail_app')
+
+
+class Command(BaseCommand):
+    help = 'Re-analyze emails whose AI analysis failed with a transient error'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, help='Only emails of this username')
+        parser.add_argument('--limit', type=int, default=100, help='Maximum emails to retry (default: 100)')
+        parser.add_argument(
+            '--min-age', type=int, default=5,
+            help='Only failures older than this many minutes (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with hold('retry_ai_failures'):
+                self.retry(options)
+        except LockHeld:
+            self.stdout.write(self.style.WARNING('AI failures are being retried by another process, skipping'))
+
+    def retry(self, options):
+        """Delete the failed intents and analyze their emails again"""
+        intents = EmailIntent.objects.filter(
+            is_transient_failure=True,
+            airesponse__isnull=True,
+            processed_at__lte=timezone.now() - timedelta(minutes=options['min_age'])
+        ).select_related('email').order_by('processed_at')
+        if options['user']:
+            username = options['user']
+            intents = intents.filter(
+                Q(email__email_account__user__username=username) | Q(email__gmail_account__user__username=username)
+            )
+
+        intents = list(intents[:options['limit']])
+        if not intents:
+            self.stdout.write('No transient AI failures to retry')
+            return
+
+        emails = [intent.email for intent in intents]
+        self.stdout.write(f'Retrying AI analysis of {len(emails)} emails...')
+
+        # The failed intents are replaced by the new analysis
+        with transaction.atomic():
+            EmailIntent.objects.filter(id__in=[intent.id for intent in intents]).delete()
+
+        processed = EmailAIProcessor().process_emails(emails)
+        still_failing = sum(1 for intent, _ in processed if intent.is_transient_failure)
+        responses = sum(1 for _, ai_response in processed if ai_response)
+
+        logger.info(f'AI retry: {len(processed)} emails, {still_failing} still failing, {responses} responses')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(processed) - still_failing} emails analyzed, {responses} responses generated, '
+            f'{still_failing} still failing'
+        ))
@@ -0,0 +1,77 @@
+"""
+Management command running background job workers (see gmail_app.jobs)
+
+    python manage.py run_workers --threads 4
+    python manage.py run_workers --burst --max-runtime 55   # from cron: drain the queue and exit
+
+SIGTERM / Ctrl+C stop the workers after their current job.
+"""
+import os
+import signal
+import socket
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from gmail_app.client_cache import start_refresher
+from gmail_app.jobs import work
+from gmail_app.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Run background job workers (syncs, AI processing, sends)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int,
+            help='Worker threads in this process (default: JOB_WORKER_THREADS)'
+        )
+        parser.add_argument(
+            '--kind', action='append', dest='kinds',
+            help='Only run jobs of this kind (can be repeated)'
+        )
+        parser.add_argument('--burst', action='store_true', help='Exit when the queue is empty')
+        parser.add_argument(
+            '--max-runtime', type=int,
+            help='Stop claiming new jobs after this many seconds'
+        )
+
+    def handle(self, *args, **options):
+        threads = options['threads'] or getattr(settings, 'JOB_WORKER_THREADS', 4)
+        deadline = time.monotonic() + options['max_runtime'] if options['max_runtime'] else None
+        stop_event = threading.Event()
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping workers after their current job...')
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        prefix = f'{socket.gethostname()}:{os.getpid()}'
+        queued = Job.objects.filter(status='queued').count()
+        self.stdout.write(f'Starting {threads} workers ({prefix}), {queued} jobs queued')
+
+        counts = [0] * threads
+
+        def run(index):
+            counts[index] = work(
+                f'{prefix}:{index}', stop_event,
+                kinds=options['kinds'], burst=options['burst'], deadline=deadline
+            )
+
+        workers = [
+            threading.Thread(target=run, args=(index,), name=f'job-worker-{index}')
+            for index in range(threads)
+        ]
+        # Access tokens are renewed before they expire, outside the jobs
+        refresher = start_refresher()
+        for worker in workers:
+            worker.start()
+        # Join with a timeout so the main thread keeps receiving signals
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=1)
+        refresher.stop()
+
+        self.stdout.write(self.style.SUCCESS(f'Workers stopped: {sum(counts)} jobs run'))
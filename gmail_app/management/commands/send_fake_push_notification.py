@@ -0,0 +1,60 @@
+"""
+Management command that posts a fake push notification to the local webhook, standing in for
+Cloud Pub/Sub during development:
+
+    python manage.py runserver                      # in another terminal
+    python manage.py send_fake_push_notification --account 3
+"""
+import json
+import base64
+import uuid
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from django.utils import timezone
+from gmail_app.models import EmailAccount
+
+
+class Command(BaseCommand):
+    help = 'Post a fake Gmail Pub/Sub push notification to the local webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, required=True, help='EmailAccount ID')
+        parser.add_argument(
+            '--history-id', type=int,
+            help='historyId announced by the notification (default: stored cursor + 1)'
+        )
+        parser.add_argument(
+            '--base-url', type=str, default='http://127.0.0.1:8000',
+            help='Base URL of the running server (default: http://127.0.0.1:8000)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            account = EmailAccount.objects.get(id=options['account'])
+        except EmailAccount.DoesNotExist:
+            raise CommandError(f'EmailAccount {options["account"]} not found')
+
+        if account.provider != 'gmail':
+            raise CommandError(f'Account {account.email} is not a Gmail account')
+
+        url = options['base_url'].rstrip('/') + reverse('gmail_push_webhook')
+        params = {'token': getattr(settings, 'PUSH_VERIFICATION_TOKEN', '')}
+
+        history_id = options['history_id'] or int(account.history_id or 0) + 1
+        data = {'emailAddress': account.email, 'historyId': history_id}
+        payload = {
+            # Same envelope as a Pub/Sub push subscription
+            'message': {
+                'data': base64.b64encode(json.dumps(data).encode('utf-8')).decode('ascii'),
+                'messageId': uuid.uuid4().hex,
+                'publishTime': timezone.now().isoformat()
+            },
+            'subscription': 'projects/local/subscriptions/fake-push'
+        }
+
+        response = requests.post(url, params=params, json=payload, timeout=10)
+        if response.status_code >= 300:
+            raise CommandError(f'Webhook answered {response.status_code}: {response.text[:200]}')
+        self.stdout.write(self.style.SUCCESS(f'Notification delivered to {url} ({response.status_code})'))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0005_alter_temporalrule_ai_context_airole_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='history_id',
+            field=models.CharField(blank=True, default='', help_text='Gmail historyId of the last completed sync (incremental sync cursor)', max_length=64),
+        ),
+    ]
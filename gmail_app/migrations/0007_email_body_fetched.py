@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0006_emailaccount_history_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='body_fetched',
+            field=models.BooleanField(default=True, help_text='False when only metadata was synced; the body is fetched on first access'),
+        ),
+    ]
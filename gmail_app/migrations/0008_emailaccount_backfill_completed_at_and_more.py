@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0007_email_body_fetched'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='backfill_completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailaccount',
+            name='backfill_cursor',
+            field=models.TextField(blank=True, default='', help_text='Next page token (Gmail) or @odata.nextLink (Outlook) of the history backfill'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0008_emailaccount_backfill_completed_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='delta_link',
+            field=models.TextField(blank=True, default='', help_text='Microsoft Graph @odata.deltaLink of the last completed inbox sync'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:49
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def dedupe_emails(apps, schema_editor):
+    """
+    Remove duplicate (email_account, provider_id) rows left by concurrent syncs so the
+    unique constraint added in the next migration can be created.
+    Keeps the row that already has an AI analysis, otherwise the oldest one.
+    """
+    Email = apps.get_model('gmail_app', 'Email')
+    EmailIntent = apps.get_model('gmail_app', 'EmailIntent')
+
+    duplicates = (
+        Email.objects.filter(email_account__isnull=False)
+        .values('email_account', 'provider_id')
+        .annotate(total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        ids = list(Email.objects.filter(
+            email_account=duplicate['email_account'],
+            provider_id=duplicate['provider_id']
+        ).order_by('id').values_list('id', flat=True))
+        analyzed = set(EmailIntent.objects.filter(email_id__in=ids).values_list('email_id', flat=True))
+        keep = next((email_id for email_id in ids if email_id in analyzed), ids[0])
+        Email.objects.filter(id__in=ids).exclude(id=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0009_emailaccount_delta_link'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_emails, migrations.RunPython.noop),
+    ]
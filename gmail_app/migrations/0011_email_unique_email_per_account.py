@@ -0,0 +1,21 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0010_dedupe_emails'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='email',
+            name='gmail_app_e_email_a_c87bb8_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='email',
+            constraint=models.UniqueConstraint(fields=('email_account', 'provider_id'), name='unique_email_per_account'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0011_email_unique_email_per_account'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIAnalysisCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('intent_type', models.CharField(max_length=50)),
+                ('confidence_score', models.FloatField()),
+                ('ai_decision', models.CharField(max_length=20)),
+                ('decision_reason', models.TextField()),
+                ('hit_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('ai_role', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analysis_cache', to='gmail_app.airole')),
+            ],
+        ),
+    ]
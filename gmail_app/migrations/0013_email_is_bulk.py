@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0012_aianalysiscache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='is_bulk',
+            field=models.BooleanField(default=False, help_text='Newsletter or automated mail (List-Unsubscribe, Precedence or Auto-Submitted headers)'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.15 on 2026-10-17 01:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gmail_app', '0013_email_is_bulk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIBatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phase', models.CharField(choices=[('analysis', 'Intent analysis'), ('response', 'Response generation')], max_length=20)),
+                ('status', models.CharField(choices=[('validating', 'Validating'), ('in_progress', 'In progress'), ('finalizing', 'Finalizing'), ('completed', 'Completed'), ('failed', 'Failed'), ('expired', 'Expired'), ('cancelling', 'Cancelling'), ('cancelled', 'Cancelled')], default='validating', max_length=20)),
+                ('openai_batch_id', models.CharField(max_length=100, unique=True)),
+                ('input_file_id', models.CharField(max_length=100)),
+                ('output_file_id', models.CharField(blank=True, max_length=100)),
+                ('error_file_id', models.CharField(blank=True, max_length=100)),
+                ('email_ids', models.JSONField(default=list)),
+                ('request_count', models.IntegerField(default=0)),
+                ('completed_count', models.IntegerField(default=0)),
+                ('failed_count', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('applied_at', models.DateTimeField(blank=True, help_text='When the results were written as EmailIntent/AIResponse rows', null=True)),
+                ('parent', models.ForeignKey(blank=True, help_text='Analysis job that produced this response job', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='follow_ups', to='gmail_app.aibatchjob')),
+                ('user', models.ForeignKey(blank=True, help_text='Owner of the emails, empty when the job covers every user', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ai_batch_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'AI Batch Job',
+                'verbose_name_plural': 'AI Batch Jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0014_aibatchjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='cleaned_body',
+            field=models.TextField(blank=True, help_text='Body prepared for the AI (HTML converted, quotes/signature removed); null until computed', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0015_email_cleaned_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailintent',
+            name='is_transient_failure',
+            field=models.BooleanField(db_index=True, default=False, help_text='Analysis failed with a transient error (rate limit, timeout); retried by retry_ai_failures'),
+        ),
+    ]
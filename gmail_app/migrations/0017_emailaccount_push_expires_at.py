@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0016_emailintent_is_transient_failure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='push_expires_at',
+            field=models.DateTimeField(blank=True, help_text='When the Gmail watch / Graph subscription expires (renewed by renew_mail_watches)', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0017_emailaccount_push_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='push_client_state',
+            field=models.CharField(blank=True, default='', help_text='Secret echoed by Graph in every notification of the subscription', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='emailaccount',
+            name='push_subscription_id',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Microsoft Graph subscription ID for inbox change notifications', max_length=255),
+        ),
+    ]
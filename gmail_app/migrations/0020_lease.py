@@ -0,0 +1,24 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0019_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='e.g. auto_sync, sync-account:3', max_length=255, unique=True)),
+                ('owner', models.CharField(help_text='host:pid:thread of the holder', max_length=100)),
+                ('expires_at', models.DateTimeField()),
+                ('acquired_at', models.DateTimeField()),
+                ('renewed_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.15 on 2026-10-17 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gmail_app', '0020_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='airesponse',
+            name='idempotency_key',
+            field=models.CharField(blank=True, default='', help_text='Message-ID header of the reply; a retry first looks for it in the mailbox so it is never sent twice', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='airesponse',
+            name='last_send_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='airesponse',
+            name='provider_message_id',
+            field=models.CharField(blank=True, default='', help_text='ID of the sent message', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='airesponse',
+            name='send_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='airesponse',
+            name='sent_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -24,6 +24,45 @@ class EmailAccount(models.Model):
     # Account status
     is_active = models.BooleanField(default=True)
 
+    # Sync cursors
+    history_id = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        help_text="Gmail historyId of the last completed sync (incremental sync cursor)"
+    )
+    backfill_cursor = models.TextField(
+        blank=True,
+        default='',
+        help_text="Next page token (Gmail) or @odata.nextLink (Outlook) of the history backfill"
+    )
+    backfill_completed_at = models.DateTimeField(null=True, blank=True)
+    delta_link = models.TextField(
+        blank=True,
+        default='',
+        help_text="Microsoft Graph @odata.deltaLink of the last completed inbox sync"
+    )
+
+    # Push notifications
+    push_expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the Gmail watch / Graph subscription expires (renewed by renew_mail_watches)"
+    )
+    push_subscription_id = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text="Microsoft Graph subscription ID for inbox change notifications"
+    )
+    push_client_state = models.CharField(
+        max_length=128,
+        blank=True,
+        default='',
+        help_text="Secret echoed by Graph in every notification of the subscription"
+    )
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -86,21 +125,37 @@ class Email(models.Model):
     recipient = models.CharField(max_length=255)
     body_plain = models.TextField(blank=True)
     body_html = models.TextField(blank=True)
+    body_fetched = models.BooleanField(
+        default=True,
+        help_text="False when only metadata was synced; the body is fetched on first access"
+    )
+    cleaned_body = models.TextField(
+        null=True,
+        blank=True,
+        help_text="Body prepared for the AI (HTML converted, quotes/signature removed); null until computed"
+    )
     received_date = models.DateTimeField(db_index=True)  # Index for sorting
 
     # Flags
     is_read = models.BooleanField(default=False)
     is_important = models.BooleanField(default=False)
+    is_bulk = models.BooleanField(
+        default=False,
+        help_text="Newsletter or automated mail (List-Unsubscribe, Precedence or Auto-Submitted headers)"
+    )
 
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-received_date']  # Most recent first
-        # Prevent duplicate emails per account
         indexes = [
             models.Index(fields=['-received_date']),  # Fast sorting
-            models.Index(fields=['email_account', 'provider_id']),  # Fast lookups
+        ]
+        constraints = [
+            # Prevent duplicate emails per account (also the lookup index, and the conflict
+            # target for bulk upserts)
+            models.UniqueConstraint(fields=['email_account', 'provider_id'], name='unique_email_per_account'),
         ]
 
     def __str__(self):
@@ -111,4 +166,86 @@ class Email(models.Model):
         """Get provider from email_account"""
         if self.email_account:
             return self.email_account.provider
-        return 'gmail'  # Legacy default
\ No newline at end of file
+        return 'gmail'  # Legacy default
+
+
+class Job(models.Model):
+    """
+    Background job of the durable queue (see gmail_app.jobs)
+
+    Views and webhooks enqueue jobs; run_workers processes claim them under a lease, so a job
+    whose worker died is claimed again once the lease expires.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50, help_text="Handler name (e.g. sync_account, send_response)")
+    payload = models.JSONField(default=dict)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs',
+        help_text="User the job works for (shown in job status responses)"
+    )
+    dedupe_key = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        help_text="Jobs with the same key are coalesced while one of them is queued"
+    )
+
+    # Scheduling
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    priority = models.IntegerField(default=0, help_text="Higher runs first")
+    run_after = models.DateTimeField(help_text="Not claimed before this time (retry backoff)")
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+
+    # Lease of the worker running the job
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    # Outcome
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Claim query: next queued job by priority and due time
+            models.Index(fields=['status', '-priority', 'run_after'], name='job_claim_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=models.Q(status='queued') & ~models.Q(dedupe_key=''),
+                name='unique_queued_job_dedupe_key'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.id} ({self.status})"
+
+
+class Lease(models.Model):
+    """
+    Named lock shared by every process and instance (see gmail_app.locks)
+
+    The holder renews expires_at while it works (heartbeat); a lock whose holder died is free
+    again once it expires.
+    """
+    name = models.CharField(max_length=255, unique=True, help_text="e.g. auto_sync, sync-account:3")
+    owner = models.CharField(max_length=100, help_text="host:pid:thread of the holder")
+    expires_at = models.DateTimeField()
+    acquired_at = models.DateTimeField()
+    renewed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} ({self.owner})"
@@ -0,0 +1,165 @@
+"""
+Outbound queue for AI responses
+
+Approving, resending and auto-sending only queue the AIResponse (a 'send_response' job); the
+job workers deliver it:
+
+- Per-account rate limits (SEND_RATE_LIMITS, per minute and per day, counted from the
+  responses sent by the account) keep bursts of auto-sends under the provider quotas. Sends
+  of an account are serialized by the 'send-account:<id>' lock, so the count is exact.
+- Every response gets a Message-ID (idempotency_key) when it is queued. A retry first checks
+  whether the previous attempt reached the provider (Gmail: that Message-ID in the mailbox;
+  Outlook: the stored reply draft was sent) and then marks it sent instead of sending again.
+- Replies go out from the account that received the email (see gmail_app.mail_dispatch).
+- Failures are retried with exponential backoff (SEND_MAX_ATTEMPTS); the attempts and last
+  error are stored on the response, which ends as 'failed' when they are exhausted.
+"""
+import logging
+import uuid
+from datetime import timedelta
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.utils import timezone
+
+from .ai_models import AIResponse
+from .jobs import enqueue, RetryLater, PRIORITY_HIGH
+from .locks import hold, LockHeld
+from .mail_dispatch import find_sent_reply, send_reply
+
+logger = logging.getLogger('gmail_app')
+
+DEFAULT_SEND_RATE_LIMITS = {'per_minute': 20, 'per_day': 500}
+
+
+def make_idempotency_key(ai_response):
+    """New Message-ID for the reply, in the domain of the mailbox that received the email"""
+    email = ai_response.email_intent.email
+    address = email.email_account.email if email.email_account_id else parseaddr(email.recipient)[1]
+    domain = address.rpartition('@')[2] or 'friendlymail.local'
+    return f'<friendlymail.{ai_response.id}.{uuid.uuid4().hex}@{domain}>'
+
+
+def queue_send(ai_response, user, resend=False):
+    """
+    Mark the response approved and queue it for delivery
+
+    Args:
+        ai_response (AIResponse): Response to send
+        user (User): Owner of the mailbox that sends it
+        resend (bool): Deliberately send again a response that was already sent (new Message-ID)
+
+    Returns:
+        Job: The send job
+    """
+    if resend or not ai_response.idempotency_key:
+        ai_response.idempotency_key = make_idempotency_key(ai_response)
+        ai_response.provider_message_id = ''
+        ai_response.send_attempts = 0
+        ai_response.last_send_error = ''
+
+    ai_response.status = 'approved'
+    ai_response.approved_at = ai_response.approved_at or timezone.now()
+    ai_response.save()
+
+    return enqueue(
+        'send_response',
+        {'response_id': ai_response.id},
+        user=user,
+        priority=PRIORITY_HIGH,
+        dedupe_key=f'send-response:{ai_response.id}',
+        max_attempts=getattr(settings, 'SEND_MAX_ATTEMPTS', 5)
+    )
+
+
+def _rate_limits(provider):
+    return {**DEFAULT_SEND_RATE_LIMITS, **getattr(settings, 'SEND_RATE_LIMITS', {}).get(provider, {})}
+
+
+def _rate_limit_delay(email):
+    """Seconds to wait before the account may send again (0 when it is under its limits)"""
+    if not email.email_account_id:
+        return 0
+
+    now = timezone.now()
+    limits = _rate_limits(email.email_account.provider)
+    sent = AIResponse.objects.filter(
+        email_intent__email__email_account_id=email.email_account_id, status='sent'
+    )
+    for window, limit in ((timedelta(minutes=1), limits['per_minute']), (timedelta(days=1), limits['per_day'])):
+        if not limit:
+            continue
+        recent = list(
+            sent.filter(sent_at__gt=now - window).order_by('-sent_at').values_list('sent_at', flat=True)[:limit]
+        )
+        if len(recent) >= limit:
+            # Free again when the oldest of the last `limit` sends leaves the window
+            return max(1, int((recent[-1] + window - now).total_seconds()) + 1)
+    return 0
+
+
+def deliver(response_id, final_attempt=False):
+    """
+    Send a queued response from the account that received the email (job handler)
+
+    Args:
+        response_id (int): AIResponse ID
+        final_attempt (bool): Mark the response 'failed' if this attempt fails
+
+    Returns:
+        dict: {'status', 'message_id'}
+
+    Raises:
+        RetryLater: The account is over its send rate or another worker is sending for it
+    """
+    ai_response = AIResponse.objects.select_related(
+        'email_intent__email__email_account', 'email_intent__email__gmail_account'
+    ).get(id=response_id)
+    if ai_response.status != 'approved':
+        return {'status': 'skipped', 'message_id': ai_response.provider_message_id}
+
+    email = ai_response.email_intent.email
+    account_key = email.email_account_id or f'legacy-{email.gmail_account_id}'
+    try:
+        with hold(f'send-account:{account_key}'):
+            delay = _rate_limit_delay(email)
+            if delay:
+                raise RetryLater(f'Send rate limit of {email.email_account.email}', delay=delay)
+            return _send(ai_response, email, final_attempt)
+    except LockHeld as e:
+        raise RetryLater(str(e), delay=2)
+
+
+def _send(ai_response, email, final_attempt):
+    """One delivery attempt, skipped if a previous attempt already reached the provider"""
+    if not ai_response.idempotency_key:
+        ai_response.idempotency_key = make_idempotency_key(ai_response)
+
+    try:
+        message_id = None
+        if ai_response.send_attempts:
+            # The previous attempt may have failed after the provider accepted the message
+            message_id = find_sent_reply(ai_response, email)
+            if message_id:
+                logger.info(f"Response {ai_response.id} was already sent (message {message_id}), not sending again")
+
+        # Recorded before sending: a worker that dies mid-send leaves a trace for the next attempt
+        ai_response.send_attempts += 1
+        ai_response.save(update_fields=['idempotency_key', 'send_attempts'])
+        if not message_id:
+            message_id = send_reply(ai_response, email)
+    except Exception as e:
+        ai_response.last_send_error = str(e) or type(e).__name__
+        if final_attempt:
+            ai_response.status = 'failed'
+        ai_response.save(update_fields=['idempotency_key', 'send_attempts', 'last_send_error', 'status'])
+        logger.error(f"Error sending response {ai_response.id} (attempt {ai_response.send_attempts}): {e}")
+        raise
+
+    ai_response.status = 'sent'
+    ai_response.sent_at = timezone.now()
+    ai_response.provider_message_id = message_id or ''
+    ai_response.last_send_error = ''
+    ai_response.save()
+    logger.info(f"Response {ai_response.id} sent to {email.sender} (message {message_id})")
+    return {'status': 'ok', 'message_id': message_id}
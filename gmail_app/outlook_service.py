@@ -2,18 +2,27 @@
 Outlook/Microsoft Graph API Service
 Handles OAuth2 authentication and email operations for Office 365/Outlook
 """
-import msal
-import requests
 import secrets
 import logging
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.utils import timezone
-from gmail_app.models import EmailAccount, Email
+from gmail_app import client_cache, graph_client
+from gmail_app.models import EmailAccount
+from gmail_app.ingest import bulk_upsert_emails, is_bulk_mail
 
 
 logger = logging.getLogger('gmail_app')
 
+# Message fields requested from Graph for every sync path
+MESSAGE_SELECT = (
+    'id,conversationId,subject,from,toRecipients,receivedDateTime,body,isRead,importance,'
+    'internetMessageHeaders'
+)
+
+# Graph keeps these IDs when a message moves between folders (e.g. a sent draft)
+IMMUTABLE_ID_HEADER = {'Prefer': 'IdType="ImmutableId"'}
+
 
 class OutlookService:
     """
@@ -39,12 +48,8 @@ class OutlookService:
         Returns:
             str: Authorization URL to redirect user to
         """
-        # Create MSAL confidential client
-        msal_app = msal.ConfidentialClientApplication(
-            self.client_id,
-            authority=self.authority,
-            client_credential=self.client_secret
-        )
+        # Shared MSAL confidential client
+        msal_app = graph_client.get_msal_app(self.client_id, self.client_secret, self.authority)
 
         # Generate state for CSRF protection
         state = secrets.token_urlsafe(32)
@@ -87,12 +92,8 @@ class OutlookService:
             error_description = request.GET.get('error_description', 'Unknown error')
             raise Exception(f"OAuth error: {error} - {error_description}")
 
-        # Create MSAL app
-        msal_app = msal.ConfidentialClientApplication(
-            self.client_id,
-            authority=self.authority,
-            client_credential=self.client_secret
-        )
+        # Shared MSAL app
+        msal_app = graph_client.get_msal_app(self.client_id, self.client_secret, self.authority)
 
         # Exchange code for tokens
         result = msal_app.acquire_token_by_authorization_code(
@@ -153,7 +154,7 @@ class OutlookService:
             str: User's email address
         """
         headers = {'Authorization': f'Bearer {access_token}'}
-        response = requests.get('https://graph.microsoft.com/v1.0/me', headers=headers)
+        response = graph_client.get('https://graph.microsoft.com/v1.0/me', headers=headers)
 
         if response.status_code != 200:
             raise Exception(f"Failed to get user info: {response.text}")
@@ -162,31 +163,51 @@ class OutlookService:
         # Use 'mail' if available, otherwise fall back to 'userPrincipalName'
         return user_data.get('mail') or user_data.get('userPrincipalName')
 
-    def get_credentials(self):
+    def _get_account(self, email_account_id=None):
+        """
+        Get the Outlook EmailAccount to work with
+
+        Args:
+            email_account_id: Specific EmailAccount ID. If None, uses the first active Outlook account.
+
+        Raises:
+            Exception: If no active Outlook account found
+        """
+        accounts = EmailAccount.objects.filter(
+            user=self.user,
+            provider='outlook',
+            is_active=True
+        )
+        if email_account_id:
+            accounts = accounts.filter(id=email_account_id)
+
+        account = accounts.first()
+        if not account:
+            raise Exception("No active Outlook account found. Please connect your Outlook account.")
+        return account
+
+    def get_credentials(self, email_account_id=None):
         """
         Get valid access token, refreshing if necessary
 
+        Args:
+            email_account_id: Specific EmailAccount ID (default: first active Outlook account)
+
         Returns:
             str: Valid access token
 
         Raises:
             Exception: If no active Outlook account found or refresh fails
         """
-        try:
-            account = EmailAccount.objects.get(
-                user=self.user,
-                provider='outlook',
-                is_active=True
-            )
-        except EmailAccount.DoesNotExist:
-            raise Exception("No active Outlook account found. Please connect your Outlook account.")
+        # Cached token of the account: no database read while it is valid
+        if email_account_id:
+            token = client_cache.cached_access_token(email_account_id, self.user.id, 'outlook')
+            if token:
+                return token
 
-        # Check if token expired
-        if timezone.now() >= account.token_expires_at:
-            logger.info(f"Access token expired for {account.email}, refreshing...")
-            account = self._refresh_token(account)
-
-        return account.access_token
+        account = self._get_account(email_account_id)
+        # Refreshed here only if the background refresher did not get to it first
+        return client_cache.get_access_token(account)
 
     def _refresh_token(self, account):
         """
@@ -198,11 +219,7 @@ class OutlookService:
         Returns:
             EmailAccount: Updated account with new tokens
         """
-        msal_app = msal.ConfidentialClientApplication(
-            self.client_id,
-            authority=self.authority,
-            client_credential=self.client_secret
-        )
+        msal_app = graph_client.get_msal_app(self.client_id, self.client_secret, self.authority)
 
         result = msal_app.acquire_token_by_refresh_token(
             refresh_token=account.refresh_token,
@@ -230,121 +247,363 @@ class OutlookService:
         logger.info(f"Successfully refreshed token for {account.email}")
         return account
 
-    def sync_emails(self, max_results=50):
+    def sync_emails(self, max_results=50, email_account_id=None):
         """
-        Sync emails from Microsoft Graph API
+        Sync the inbox using Microsoft Graph delta query
+
+        The first run enumerates mail received in the last OUTLOOK_DELTA_INITIAL_DAYS days and
+        stores the returned @odata.deltaLink on the account. Later runs replay that link, so Graph
+        only returns messages that were created, changed or removed since the previous sync.
 
         Args:
-            max_results: Maximum number of emails to fetch (default 50)
+            max_results: Page size requested from Graph (default 50)
+            email_account_id: Specific EmailAccount ID to sync (default: first active Outlook account)
 
         Returns:
-            dict: Sync results with counts
+            dict: Sync results with counts, plus 'emails' (the newly created Email objects)
         """
-        access_token = self.get_credentials()
-        account = EmailAccount.objects.get(
-            user=self.user,
-            provider='outlook',
-            is_active=True
-        )
+        account = self._get_account(email_account_id)
+        access_token = self.get_credentials(account.id)
 
-        # Microsoft Graph API endpoint
-        headers = {'Authorization': f'Bearer {access_token}'}
-        params = {
-            '$top': max_results,
-            '$orderby': 'receivedDateTime desc',
-            '$select': 'id,subject,from,toRecipients,receivedDateTime,body,isRead,importance'
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Prefer': f'odata.maxpagesize={max_results}'
         }
 
-        response = requests.get(
-            'https://graph.microsoft.com/v1.0/me/messages',
-            headers=headers,
-            params=params
+        new_emails = []
+        updated_count = 0
+        removed_ids = []
+        url, params = self._delta_start(account)
+        restarted = False
+
+        while True:
+            response = graph_client.get(url, headers=headers, params=params)
+
+            if response.status_code == 410 and not restarted:
+                # Delta token expired or sync state lost: start a new delta round
+                logger.warning(f"Delta link expired for {account.email}, restarting delta sync")
+                account.delta_link = ''
+                url, params = self._delta_start(account)
+                restarted = True
+                continue
+
+            if response.status_code != 200:
+                raise Exception(f"Failed to fetch emails: {response.text}")
+
+            data = response.json()
+            changed = []
+            for msg in data.get('value', []):
+                if '@removed' in msg:
+                    # Moved/archived out of the inbox or deleted: the stored row, its analysis
+                    # and sent replies are kept (as with Gmail history sync)
+                    removed_ids.append(msg['id'])
+                else:
+                    changed.append(msg)
+
+            created = self._store_messages(account, changed)
+            new_emails.extend(created)
+            updated_count += len(changed) - len(created)
+
+            if '@odata.nextLink' in data:
+                # nextLink already carries every query parameter
+                url, params = data['@odata.nextLink'], None
+                continue
+
+            account.delta_link = data.get('@odata.deltaLink', '')
+            break
+
+        account.save(update_fields=['delta_link'])
+
+        logger.info(
+            f"Outlook sync complete for {account.email}: "
+            f"{len(new_emails)} new, {updated_count} updated, {len(removed_ids)} left the inbox"
         )
 
+        return {
+            'new_emails': len(new_emails),
+            'updated_emails': updated_count,
+            'removed_emails': len(removed_ids),
+            'total_synced': len(new_emails) + updated_count,
+            'emails': new_emails
+        }
+
+    def _delta_start(self, account):
+        """
+        URL and query params for the next delta request: the stored deltaLink, or a new round
+        """
+        if account.delta_link:
+            return account.delta_link, None
+
+        since = timezone.now() - timedelta(days=getattr(settings, 'OUTLOOK_DELTA_INITIAL_DAYS', 30))
+        return 'https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta', {
+            '$select': MESSAGE_SELECT,
+            '$filter': f"receivedDateTime ge {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+        }
+
+    def backfill_page(self, email_account_id=None, page_size=100):
+        """
+        Ingest one page of the inbox history, oldest pages last, following @odata.nextLink
+
+        The nextLink is persisted on the account after the page is stored, so an interrupted
+        backfill resumes from the last completed page.
+
+        Args:
+            email_account_id: Specific EmailAccount ID (default: first active Outlook account)
+            page_size: Messages per Graph page
+
+        Returns:
+            dict: {'fetched': int, 'new_emails': int, 'done': bool}
+        """
+        account = self._get_account(email_account_id)
+        if account.backfill_completed_at:
+            return {'fetched': 0, 'new_emails': 0, 'done': True}
+
+        access_token = self.get_credentials(account.id)
+        headers = {'Authorization': f'Bearer {access_token}'}
+
+        if account.backfill_cursor:
+            # nextLink already carries every query parameter
+            response = graph_client.get(account.backfill_cursor, headers=headers)
+        else:
+            response = graph_client.get(
+                'https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages',
+                headers=headers,
+                params={
+                    '$top': page_size,
+                    '$orderby': 'receivedDateTime desc',
+                    '$select': MESSAGE_SELECT
+                }
+            )
+
         if response.status_code != 200:
             raise Exception(f"Failed to fetch emails: {response.text}")
 
-        messages = response.json().get('value', [])
+        data = response.json()
+        messages = data.get('value', [])
 
-        new_count = 0
-        updated_count = 0
+        new_count = len(self._store_messages(account, messages))
 
-        for msg in messages:
-            msg_id = msg['id']
-
-            # Extract email data
-            subject = msg.get('subject', '')[:500]  # Limit to 500 chars
-
-            from_data = msg.get('from', {}).get('emailAddress', {})
-            sender = from_data.get('address', '')[:255]
-
-            # Get first recipient (can have multiple)
-            recipients = msg.get('toRecipients', [])
-            recipient = ''
-            if recipients:
-                recipient = recipients[0].get('emailAddress', {}).get('address', '')[:255]
-
-            # Parse received date
-            received_date_str = msg.get('receivedDateTime')
-            if received_date_str:
-                # Remove 'Z' and parse as UTC
-                received_date = datetime.fromisoformat(received_date_str.replace('Z', '+00:00'))
-            else:
-                received_date = timezone.now()
-
-            # Extract body
-            body_content = msg.get('body', {})
-            content_type = body_content.get('contentType', 'text')
-            content = body_content.get('content', '')
-
-            if content_type == 'html':
-                body_html = content
-                body_plain = ''  # Could add HTML to text conversion here
-            else:
-                body_plain = content
-                body_html = ''
+        account.backfill_cursor = data.get('@odata.nextLink', '')
+        if not account.backfill_cursor:
+            account.backfill_completed_at = timezone.now()
+        account.save(update_fields=['backfill_cursor', 'backfill_completed_at'])
 
-            # Flags
-            is_read = msg.get('isRead', False)
-            is_important = msg.get('importance') == 'high'
+        return {
+            'fetched': len(messages),
+            'new_emails': new_count,
+            'done': account.backfill_completed_at is not None
+        }
 
+    def _parse_message(self, msg):
+        """
+        Extract Email field values from a Graph message resource
+        """
+        msg_id = msg['id']
+
+        # Extract email data
+        subject = (msg.get('subject') or '')[:500]  # Limit to 500 chars
+
+        from_data = msg.get('from', {}).get('emailAddress', {})
+        sender = from_data.get('address', '')[:255]
+
+        # Get first recipient (can have multiple)
+        recipients = msg.get('toRecipients', [])
+        recipient = ''
+        if recipients:
+            recipient = recipients[0].get('emailAddress', {}).get('address', '')[:255]
+
+        # Parse received date
+        received_date_str = msg.get('receivedDateTime')
+        if received_date_str:
+            # Remove 'Z' and parse as UTC
+            received_date = datetime.fromisoformat(received_date_str.replace('Z', '+00:00'))
+        else:
+            received_date = timezone.now()
+
+        # Extract body
+        body_content = msg.get('body', {})
+        content_type = body_content.get('contentType', 'text')
+        content = body_content.get('content', '')
+
+        if content_type == 'html':
+            body_html = content
+            body_plain = ''  # Could add HTML to text conversion here
+        else:
+            body_plain = content
+            body_html = ''
+
+        return {
             # Thread ID (Outlook uses conversationId)
-            thread_id = msg.get('conversationId', msg_id)
-
-            # Create or update email
-            email, created = Email.objects.update_or_create(
-                email_account=account,
-                provider_id=msg_id,
-                defaults={
-                    'thread_id': thread_id,
-                    'subject': subject,
-                    'sender': sender,
-                    'recipient': recipient,
-                    'body_plain': body_plain,
-                    'body_html': body_html,
-                    'received_date': received_date,
-                    'is_read': is_read,
-                    'is_important': is_important
+            'thread_id': msg.get('conversationId', msg_id),
+            'subject': subject,
+            'sender': sender,
+            'recipient': recipient,
+            'body_plain': body_plain,
+            'body_html': body_html,
+            'received_date': received_date,
+            # Flags
+            'is_read': msg.get('isRead', False),
+            'is_important': msg.get('importance') == 'high',
+            'is_bulk': is_bulk_mail({
+                h.get('name', ''): h.get('value', '') for h in msg.get('internetMessageHeaders') or []
+            })
+        }
+
+    def subscribe_inbox(self, email_account_id=None):
+        """
+        Create or renew the Graph change-notification subscription for new inbox messages
+
+        Graph POSTs to OUTLOOK_NOTIFICATION_URL for every message created in the inbox; the
+        subscription expires after OUTLOOK_SUBSCRIPTION_MINUTES and must be renewed
+        (see renew_mail_watches).
+
+        Args:
+            email_account_id: Specific EmailAccount ID (default: first active Outlook account)
+
+        Returns:
+            datetime: When the subscription expires
+        """
+        notification_url = getattr(settings, 'OUTLOOK_NOTIFICATION_URL', '')
+        if not notification_url:
+            raise Exception("Outlook push is not configured (OUTLOOK_NOTIFICATION_URL is empty)")
+
+        account = self._get_account(email_account_id)
+        access_token = self.get_credentials(account.id)
+        headers = {'Authorization': f'Bearer {access_token}'}
+
+        expires_at = timezone.now() + timedelta(minutes=getattr(settings, 'OUTLOOK_SUBSCRIPTION_MINUTES', 4230))
+        expiration = expires_at.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+
+        response = None
+        if account.push_subscription_id:
+            # Renew the existing subscription
+            response = graph_client.patch(
+                f'https://graph.microsoft.com/v1.0/subscriptions/{account.push_subscription_id}',
+                headers=headers,
+                json={'expirationDateTime': expiration}
+            )
+            if response.status_code == 404:
+                # Expired or deleted by Graph: create a new one
+                response = None
+            elif response.status_code != 200:
+                raise Exception(f"Failed to renew subscription: {response.text}")
+
+        if response is None:
+            account.push_client_state = secrets.token_urlsafe(32)
+            response = graph_client.post(
+                'https://graph.microsoft.com/v1.0/subscriptions',
+                headers=headers,
+                json={
+                    'changeType': 'created',
+                    'notificationUrl': notification_url,
+                    'resource': "me/mailFolders('inbox')/messages",
+                    'expirationDateTime': expiration,
+                    'clientState': account.push_client_state
                 }
             )
+            if response.status_code != 201:
+                raise Exception(f"Failed to create subscription: {response.text}")
 
-            if created:
-                new_count += 1
-            else:
-                updated_count += 1
+        subscription = response.json()
+        account.push_subscription_id = subscription['id']
+        # Graph may shorten the requested expiration (UTC, up to 7 fractional digits)
+        account.push_expires_at = datetime.fromisoformat(subscription['expirationDateTime'][:19] + '+00:00')
+        account.save(update_fields=['push_subscription_id', 'push_client_state', 'push_expires_at'])
 
-        logger.info(
-            f"Outlook sync complete for {account.email}: "
-            f"{new_count} new, {updated_count} updated"
+        logger.info(f"Graph subscription for {account.email} active until {account.push_expires_at}")
+        return account.push_expires_at
+
+    def fetch_message(self, message_id, email_account_id=None):
+        """
+        Fetch and store a single message (targeted ingestion from a change notification)
+
+        Returns:
+            list: Newly created Email objects (empty if the message was already stored)
+        """
+        account = self._get_account(email_account_id)
+        access_token = self.get_credentials(account.id)
+
+        response = graph_client.get(
+            f'https://graph.microsoft.com/v1.0/me/messages/{message_id}',
+            headers={'Authorization': f'Bearer {access_token}'},
+            params={'$select': MESSAGE_SELECT}
         )
+        if response.status_code == 404:
+            # Deleted or moved before we got to it
+            return []
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch message: {response.text}")
 
-        return {
-            'new_emails': new_count,
-            'updated_emails': updated_count,
-            'total_synced': len(messages)
-        }
+        return self._store_messages(account, [response.json()])
+
+    def _store_messages(self, account, messages):
+        """
+        Bulk insert/update the Email rows for a page of Graph messages
+
+        Returns:
+            list: Newly created Email objects
+        """
+        rows = []
+        for msg in messages:
+            row = self._parse_message(msg)
+            row['provider_id'] = msg['id']
+            rows.append(row)
+        return bulk_upsert_emails(account, rows)
+
+    def create_reply_draft(self, message_id, body, email_account_id=None):
+        """
+        Create the reply to a received message as a draft (Graph createReply keeps the
+        conversation, recipients and In-Reply-To/References headers)
+
+        Args:
+            message_id: Graph ID of the message being answered (Email.provider_id)
+            body: Plain-text reply
+            email_account_id: Specific EmailAccount ID (default: first active Outlook account)
+
+        Returns:
+            str: Immutable ID of the draft (still valid once it is sent and moved to Sent Items)
+        """
+        access_token = self.get_credentials(email_account_id)
+        response = graph_client.post(
+            f'https://graph.microsoft.com/v1.0/me/messages/{message_id}/createReply',
+            headers={'Authorization': f'Bearer {access_token}', **IMMUTABLE_ID_HEADER},
+            json={'message': {'body': {'contentType': 'Text', 'content': body}}}
+        )
+        if response.status_code != 201:
+            raise Exception(f"Failed to create reply: {response.text}")
+        return response.json()['id']
+
+    def send_draft(self, draft_id, email_account_id=None):
+        """Send a draft created by create_reply_draft"""
+        access_token = self.get_credentials(email_account_id)
+        response = graph_client.post(
+            f'https://graph.microsoft.com/v1.0/me/messages/{draft_id}/send',
+            headers={'Authorization': f'Bearer {access_token}', **IMMUTABLE_ID_HEADER}
+        )
+        if response.status_code != 202:
+            raise Exception(f"Failed to send reply: {response.text}")
+        logger.info(f"Reply {draft_id[:20]}... sent via Outlook")
+
+    def get_draft_state(self, draft_id, email_account_id=None):
+        """
+        Whether a reply draft was sent
+
+        Returns:
+            str: 'draft', 'sent', or None when the message no longer exists
+        """
+        access_token = self.get_credentials(email_account_id)
+        response = graph_client.get(
+            f'https://graph.microsoft.com/v1.0/me/messages/{draft_id}',
+            headers={'Authorization': f'Bearer {access_token}', **IMMUTABLE_ID_HEADER},
+            params={'$select': 'id,isDraft'}
+        )
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Failed to get reply state: {response.text}")
+        return 'draft' if response.json().get('isDraft') else 'sent'
 
-    def send_email(self, to, subject, body, is_html=True):
+    def send_email(self, to, subject, body, is_html=True, email_account_id=None):
         """
         Send email using Microsoft Graph API
 
@@ -353,11 +612,12 @@ class OutlookService:
             subject: Email subject
             body: Email body content
             is_html: Whether body is HTML (default True)
+            email_account_id: Specific EmailAccount ID (default: first active Outlook account)
 
         Returns:
             bool: True if sent successfully
         """
-        access_token = self.get_credentials()
+        access_token = self.get_credentials(email_account_id)
 
         # Build message payload
         message = {
@@ -381,7 +641,7 @@ class OutlookService:
         }
 
         # Send email
-        response = requests.post(
+        response = graph_client.post(
             'https://graph.microsoft.com/v1.0/me/sendMail',
             headers=headers,
             json={'message': message}
@@ -0,0 +1,125 @@
+"""
+System prompts for the AI email pipeline
+
+Every system prompt starts with the same role prefix (role name, context and topics), so
+consecutive requests of a role, whether analysis or response, share a long identical
+prefix that OpenAI can serve from its prompt cache. Per-call variable content (the matched
+temporal rule) goes at the end, and the email itself goes in the user message.
+
+Rendered prompts are memoized per AIRole and invalidated when the role's updated_at changes.
+"""
+import threading
+
+# Rendered prompts: (kind, ai_role.id) -> (ai_role.updated_at, prompt)
+_rendered = {}
+_lock = threading.Lock()
+
+ANALYSIS_INSTRUCTIONS = """TASK: ANALYZE THE EMAIL
+IMPORTANT: Check if email is about allowed topics BEFORE deciding to respond.
+If the email topic is NOT in the list of topics this role can respond to, you MUST escalate.
+
+Return ONLY valid JSON with these fields:
+- intent_type: Type of email (exam_info, schedule_inquiry, academic_question, personal_matter, administrative, unclear)
+- confidence: Your confidence level (0.0 to 1.0)
+- decision: Either "respond" (if topic is allowed), "escalate" (if topic not allowed or sensitive), or "ignore" (if spam)
+- reason: Brief explanation of your decision
+
+EXAMPLE:
+{"intent_type": "exam_info", "confidence": 0.9, "decision": "respond", "reason": "Student asking about exam dates - this is in allowed topics"}
+
+CRITICAL RULES:
+1. If email is about a topic NOT in the allowed list → decision MUST be "escalate"
+2. If email is about a topic in the "must escalate" list → decision MUST be "escalate"
+3. Only decide "respond" if topic matches allowed topics AND confidence > 0.7"""
+
+REPLY_GUIDELINES = """REPLY GUIDELINES:
+- Be helpful, professional, and concise
+- Use the information provided in the context
+- If a specific rule template is provided, use it as a base but adapt to the specific question
+- Sign with the role name
+- Keep responses under 200 words unless more detail is needed
+- Be friendly but professional"""
+
+RESPONSE_INSTRUCTIONS = f"""TASK: WRITE THE REPLY
+{REPLY_GUIDELINES}
+
+Generate a helpful response to the email."""
+
+COMBINED_INSTRUCTIONS = f"""{ANALYSIS_INSTRUCTIONS}
+
+DRAFT REPLY:
+Also return a field "draft_reply". If decision is "respond", it contains the reply to send on behalf of this role; otherwise it MUST be an empty string.
+{REPLY_GUIDELINES}"""
+
+
+def _topics_list(topics):
+    """Bullet list from a one-topic-per-line text field"""
+    return "\n".join(f"  - {topic.strip()}" for topic in (topics or '').split('\n') if topic.strip())
+
+
+def _render_role_prefix(ai_role):
+    """Static part shared by every prompt of the role"""
+    sections = [
+        f"You are an AI email assistant working on behalf of: {ai_role.name}",
+        f"CONTEXT:\n{ai_role.context_description}"
+    ]
+
+    can_respond = _topics_list(ai_role.can_respond_topics)
+    if can_respond:
+        sections.append(
+            f"THIS ROLE CAN RESPOND TO THESE TOPICS:\n{can_respond}\n\n"
+            "Only respond to emails about these topics. If email is NOT about one of these topics, MUST escalate."
+        )
+
+    cannot_respond = _topics_list(ai_role.cannot_respond_topics)
+    if cannot_respond:
+        sections.append(f"THIS ROLE MUST ESCALATE THESE TOPICS (never respond):\n{cannot_respond}")
+
+    return "\n\n".join(sections)
+
+
+def _memoized(kind, ai_role, render):
+    """Rendered prompt of kind for ai_role, rendered again only when the role was updated"""
+    key = (kind, ai_role.id)
+    with _lock:
+        entry = _rendered.get(key)
+        if entry and entry[0] == ai_role.updated_at:
+            return entry[1]
+
+    prompt = render()
+    with _lock:
+        _rendered[key] = (ai_role.updated_at, prompt)
+    return prompt
+
+
+def role_prefix(ai_role):
+    """Role name, context and topics: the identical prefix of all the role's system prompts"""
+    return _memoized('prefix', ai_role, lambda: _render_role_prefix(ai_role))
+
+
+def rule_section(matched_rule):
+    """Temporal rule details appended at the end of response prompts"""
+    if not matched_rule:
+        return ""
+    return f"""
+
+SPECIFIC RULE MATCHED: {matched_rule.name}
+RULE DESCRIPTION: {matched_rule.description}
+RULE TEMPLATE: {matched_rule.response_template}"""
+
+
+def analysis_system_prompt(ai_role):
+    """System prompt for intent analysis"""
+    return _memoized('analysis', ai_role, lambda: f"{role_prefix(ai_role)}\n\n{ANALYSIS_INSTRUCTIONS}")
+
+
+def response_system_prompt(ai_role, matched_rule=None):
+    """System prompt for response generation"""
+    base = _memoized('response', ai_role, lambda: f"{role_prefix(ai_role)}\n\n{RESPONSE_INSTRUCTIONS}")
+    return base + rule_section(matched_rule)
+
+
+def combined_system_prompt(ai_role, matched_rule=None):
+    """System prompt for the single-call analysis + draft"""
+    base = _memoized('combined', ai_role, lambda: f"{role_prefix(ai_role)}\n\n{COMBINED_INSTRUCTIONS}")
+    return base + rule_section(matched_rule)
@@ -0,0 +1,93 @@
+"""
+Push ingestion: mailbox change notifications trigger targeted work for only the notified account
+
+- Gmail publishes mailbox changes to a Cloud Pub/Sub topic (users.watch); a push subscription
+  delivers them to gmail_push_webhook, which schedules an incremental (History API) sync of
+  that account.
+- Microsoft Graph change notifications (subscriptions) reach outlook_push_webhook with the
+  id of each new inbox message, which is fetched on its own.
+
+The work is enqueued as high-priority jobs for the run_workers processes (see gmail_app.jobs).
+Notifications for work that is already queued are coalesced into the queued job; one arriving
+while the work runs queues exactly one more run.
+"""
+import base64
+import json
+import logging
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+from .jobs import PRIORITY_HIGH
+from .models import EmailAccount
+from .tasks import enqueue_account_sync, enqueue_message_fetch
+
+logger = logging.getLogger('gmail_app')
+
+
+def verify_push_token(token):
+    """Whether token matches PUSH_VERIFICATION_TOKEN (push is rejected when it is not set)"""
+    expected = getattr(settings, 'PUSH_VERIFICATION_TOKEN', '')
+    return bool(expected) and constant_time_compare(token or '', expected)
+
+
+def parse_gmail_notification(body):
+    """
+    Decode a Pub/Sub push request body
+
+    Returns:
+        dict: {'email': mailbox address, 'history_id': int}
+
+    Raises:
+        ValueError, KeyError, TypeError: malformed payload
+    """
+    envelope = json.loads(body)
+    data = json.loads(base64.b64decode(envelope['message']['data']))
+    return {'email': data['emailAddress'].lower(), 'history_id': int(data['historyId'])}
+
+
+def handle_gmail_notification(notification):
+    """
+    Queue a sync of the Gmail accounts of the notified mailbox
+
+    Returns:
+        int: Number of accounts queued
+    """
+    scheduled = 0
+    accounts = EmailAccount.objects.filter(provider='gmail', email__iexact=notification['email'], is_active=True)
+    for account in accounts:
+        # Already synced past this change
+        if account.history_id and int(account.history_id) >= notification['history_id']:
+            continue
+        enqueue_account_sync(account, priority=PRIORITY_HIGH)
+        scheduled += 1
+
+    if not scheduled:
+        logger.debug(f"Gmail push for {notification['email']}: nothing to sync")
+    return scheduled
+
+
+def handle_outlook_notifications(payload):
+    """
+    Queue the fetch of each new message announced by a Graph notification payload.
+    Notifications whose clientState does not match the subscription are discarded.
+
+    Returns:
+        int: Number of messages queued
+    """
+    scheduled = 0
+    for notification in payload.get('value', []):
+        subscription_id = notification.get('subscriptionId', '')
+        account = EmailAccount.objects.filter(
+            provider='outlook', push_subscription_id=subscription_id, is_active=True
+        ).first() if subscription_id else None
+
+        if not account or not constant_time_compare(notification.get('clientState') or '', account.push_client_state):
+            logger.warning(f"Ignoring Graph notification for unknown subscription {subscription_id}")
+            continue
+
+        message_id = (notification.get('resourceData') or {}).get('id')
+        if message_id:
+            enqueue_message_fetch(account, message_id)
+            scheduled += 1
+    return scheduled
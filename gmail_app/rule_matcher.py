@@ -0,0 +1,158 @@
+"""
+Compiled temporal rule matching
+
+Instead of querying TemporalRule and re-scanning the email once per rule and keyword, the
+active rules of an AIRole are compiled into a single Aho-Corasick automaton over all their
+keywords. Each email is then matched in one pass over its text.
+
+Indexes are cached per role and rebuilt when a rule is saved or deleted (see signals.py),
+when a rule crosses its start/end date, or after TEMPORAL_RULE_INDEX_MAX_AGE_SECONDS so
+changes made by other processes are picked up.
+"""
+import logging
+import threading
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min
+from django.utils import timezone
+
+from .ai_models import TemporalRule
+from .text_cleaning import get_cleaned_body
+
+logger = logging.getLogger('gmail_app')
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton returning the best (lowest) rank among all keywords found in a text
+    """
+
+    def __init__(self, keyword_ranks):
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [None]
+
+        # Trie of all keywords; each terminal state keeps the best rank ending there
+        for keyword, rank in keyword_ranks.items():
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                    self.goto[state][char] = next_state
+                state = next_state
+            if self.best[state] is None or rank < self.best[state]:
+                self.best[state] = rank
+
+        # Failure links (BFS), merging the best rank reachable through them
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+
+                inherited = self.best[self.fail[next_state]]
+                if inherited is not None and (self.best[next_state] is None or inherited < self.best[next_state]):
+                    self.best[next_state] = inherited
+
+    def search(self, text):
+        """Best rank of any keyword occurring in text, or None"""
+        goto, fail, best = self.goto, self.fail, self.best
+        state = 0
+        found = None
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            rank = best[state]
+            if rank is not None and (found is None or rank < found):
+                found = rank
+                if found == 0:
+                    break
+        return found
+
+
+class CompiledRuleIndex:
+    """Active temporal rules of one AIRole, ordered by priority, with their keyword automaton"""
+
+    def __init__(self, rules, expires_at):
+        self.rules = rules
+        self.expires_at = expires_at
+
+        keyword_ranks = {}
+        for rank, rule in enumerate(rules):
+            for keyword in rule.keywords.split(','):
+                keyword = keyword.strip().lower()
+                if keyword:
+                    keyword_ranks.setdefault(keyword, rank)
+
+        self.automaton = KeywordAutomaton(keyword_ranks) if keyword_ranks else None
+
+    def match(self, text):
+        """Highest priority rule with a keyword contained in text (lowercased by the caller)"""
+        if not self.automaton:
+            return None
+        rank = self.automaton.search(text)
+        return self.rules[rank] if rank is not None else None
+
+
+def build_rule_index(ai_role):
+    """Compile the rules of ai_role that are active right now"""
+    now = timezone.now()
+    rules = list(TemporalRule.objects.filter(
+        ai_role=ai_role,
+        status='active',
+        start_date__lte=now,
+        end_date__gte=now
+    ).order_by('-priority', '-created_at'))
+
+    # Valid until the first rule ends, the next scheduled rule starts, or the max age
+    max_age = getattr(settings, 'TEMPORAL_RULE_INDEX_MAX_AGE_SECONDS', 300)
+    boundaries = [now + timedelta(seconds=max_age)]
+    boundaries.extend(rule.end_date for rule in rules)
+    next_start = TemporalRule.objects.filter(
+        ai_role=ai_role,
+        status='active',
+        start_date__gt=now
+    ).aggregate(next_start=Min('start_date'))['next_start']
+    if next_start:
+        boundaries.append(next_start)
+
+    logger.debug(f"Compiled {len(rules)} temporal rules for AIRole {ai_role.id}")
+    return CompiledRuleIndex(rules, min(boundaries))
+
+
+def get_rule_index(ai_role):
+    """Cached compiled index for ai_role, rebuilt when expired"""
+    now = timezone.now()
+    with _lock:
+        index = _indexes.get(ai_role.id)
+        if index is None or now >= index.expires_at:
+            index = build_rule_index(ai_role)
+            _indexes[ai_role.id] = index
+    return index
+
+
+def invalidate_rule_index(ai_role_id):
+    """Drop the cached index of a role (called when one of its rules changes)"""
+    with _lock:
+        _indexes.pop(ai_role_id, None)
+
+
+def match_temporal_rule(email, ai_role):
+    """Highest priority active rule of ai_role whose keywords appear in the email, or None"""
+    email_content = f"{email.subject} {get_cleaned_body(email)}".lower()
+    return get_rule_index(ai_role).match(email_content)
@@ -9,10 +9,43 @@ logger = logging.getLogger('gmail_app')
 
 
 def auto_sync_job():
-    """Job que ejecuta la sincronización automática"""
-    logger.info('Iniciando sincronizacion automatica...')
+    """
+    Job que encola la sincronización automática de cada cuenta activa.
+    Los workers (run_workers) la ejecutan fuera del proceso web.
+    """
+    from .models import EmailAccount
+    from .tasks import enqueue_account_sync
+
     try:
-        call_command('auto_sync_emails')
-        logger.info('Sincronizacion automatica completada')
+        accounts = EmailAccount.objects.filter(is_active=True).select_related('user')
+        for account in accounts:
+            enqueue_account_sync(account)
+        logger.info(f'Sincronizacion automatica encolada para {len(accounts)} cuentas')
     except Exception as e:
         logger.error(f'Error en sincronizacion automatica: {e}')
+
+
+def renew_mail_watches_job():
+    """Job que renueva las suscripciones push (Gmail watch, Graph subscriptions) antes de que expiren"""
+    try:
+        call_command('renew_mail_watches')
+    except Exception as e:
+        logger.error(f'Error renovando suscripciones push: {e}')
+
+
+def retry_ai_failures_job():
+    """Job que reintenta los análisis de IA que fallaron por errores transitorios"""
+    try:
+        call_command('retry_ai_failures')
+    except Exception as e:
+        logger.error(f'Error reintentando analisis de IA: {e}')
+
+
+def refresh_tokens_job():
+    """Job que renueva los access tokens que están por expirar (ver gmail_app.client_cache)"""
+    from .client_cache import refresh_expiring_tokens
+
+    try:
+        refresh_expiring_tokens()
+    except Exception as e:
+        logger.error(f'Error renovando access tokens: {e}')
@@ -0,0 +1,32 @@
+"""
+Signal handlers for gmail_app
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import client_cache
+from .ai_models import TemporalRule
+from .models import EmailAccount
+from .rule_matcher import invalidate_rule_index
+
+
+@receiver(post_save, sender=TemporalRule)
+@receiver(post_delete, sender=TemporalRule)
+def temporal_rule_changed(sender, instance, **kwargs):
+    """Recompile the rule index of the role on its next match"""
+    if instance.ai_role_id:
+        invalidate_rule_index(instance.ai_role_id)
+
+
+@receiver(post_save, sender=EmailAccount)
+def email_account_saved(sender, instance, update_fields=None, **kwargs):
+    """Keep the cached tokens and clients of the account in step"""
+    if not instance.is_active:
+        client_cache.invalidate(instance.id)
+    elif update_fields is None or 'access_token' in update_fields:
+        client_cache.store_tokens(instance)
+
+
+@receiver(post_delete, sender=EmailAccount)
+def email_account_deleted(sender, instance, **kwargs):
+    client_cache.invalidate(instance.id)
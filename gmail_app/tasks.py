@@ -0,0 +1,140 @@
+"""
+Handlers of the background jobs (see gmail_app.jobs) and helpers to enqueue them
+"""
+import logging
+
+from django.db.models import Q
+
+from .jobs import register, enqueue, RetryLater, PRIORITY_HIGH, PRIORITY_NORMAL
+from .locks import hold, LockHeld
+from .models import Email, EmailAccount
+
+logger = logging.getLogger('gmail_app')
+
+# Emails analyzed per process_emails job
+PROCESS_EMAILS_LIMIT = 100
+
+
+# ========== ENQUEUE ==========
+
+def enqueue_account_sync(account, priority=PRIORITY_NORMAL):
+    """Queue a sync (incremental fetch + AI processing) of account, coalesced with a queued one"""
+    return enqueue(
+        'sync_account',
+        {'account_id': account.id},
+        user=account.user,
+        priority=priority,
+        dedupe_key=f'sync-account:{account.id}'
+    )
+
+
+def enqueue_message_fetch(account, message_id):
+    """Queue the fetch and AI processing of one Outlook message announced by Graph"""
+    return enqueue(
+        'fetch_outlook_message',
+        {'account_id': account.id, 'message_id': message_id},
+        user=account.user,
+        priority=PRIORITY_HIGH,
+        dedupe_key=f'outlook-message:{account.id}:{message_id}'
+    )
+
+
+def enqueue_email_processing(user):
+    """Queue the AI analysis of the user's unprocessed emails"""
+    return enqueue(
+        'process_emails',
+        {'user_id': user.id},
+        user=user,
+        priority=PRIORITY_HIGH,
+        dedupe_key=f'process-emails:{user.id}'
+    )
+
+
+# ========== HANDLERS ==========
+
+@register('sync_account')
+def sync_account(job):
+    """Same pipeline as the periodic sync: incremental fetch, AI processing, auto-send"""
+    from .management.commands.auto_sync_emails import Command as AutoSyncCommand
+
+    account = EmailAccount.objects.select_related('user').filter(
+        id=job.payload['account_id'], is_active=True
+    ).first()
+    if not account:
+        return {'status': 'skipped', 'error': 'Account disconnected'}
+
+    result = AutoSyncCommand().sync_account(account)
+    if result['status'] == 'locked':
+        # Another process is syncing the account; run again after it, in case it started
+        # before the change that queued this job
+        raise RetryLater(result['error'])
+    logger.info(
+        f"Job sync {account.email}: {result['status']}, {result['new_emails']} new, "
+        f"{result['elapsed_ms']} ms {result['error']}"
+    )
+    return {key: value for key, value in result.items() if key != 'account'}
+
+
+@register('fetch_outlook_message')
+def fetch_outlook_message(job):
+    """Store one announced Outlook message and run it through the AI pipeline"""
+    from .management.commands.auto_sync_emails import Command as AutoSyncCommand
+    from .outlook_service import OutlookService
+
+    account = EmailAccount.objects.select_related('user').filter(
+        id=job.payload['account_id'], is_active=True
+    ).first()
+    if not account:
+        return {'status': 'skipped', 'error': 'Account disconnected'}
+
+    result = {'new_emails': 0, 'ai_processed': 0, 'responses_generated': 0, 'auto_sent': 0}
+    try:
+        with hold(f'sync-account:{account.id}'):
+            new_emails = OutlookService(account.user).fetch_message(
+                job.payload['message_id'], email_account_id=account.id
+            )
+            result['new_emails'] = len(new_emails)
+            if new_emails:
+                AutoSyncCommand().process_with_ai(account, new_emails, result)
+    except LockHeld as e:
+        raise RetryLater(str(e), delay=10)
+
+    if result['new_emails']:
+        logger.info(f"Push fetch {account.email}: {result['new_emails']} new, {result['responses_generated']} responses")
+    return result
+
+
+@register('process_emails')
+def process_emails(job):
+    """Analyze the user's emails that have no EmailIntent yet"""
+    from .ai_models import AIRole, EmailIntent
+    from .ai_service import EmailAIProcessor
+
+    user_id = job.payload['user_id']
+    if not AIRole.objects.filter(user_id=user_id, is_active=True).exists():
+        return {'status': 'skipped', 'error': 'No active AI role'}
+
+    unprocessed = Email.objects.filter(
+        Q(email_account__user_id=user_id) | Q(gmail_account__user_id=user_id)
+    ).exclude(
+        id__in=EmailIntent.objects.values('email_id')
+    )
+    emails = list(unprocessed[:PROCESS_EMAILS_LIMIT])
+
+    processed = EmailAIProcessor().process_emails(emails) if emails else []
+    responses = sum(1 for _, ai_response in processed if ai_response)
+    logger.info(f"Job process_emails user {user_id}: {len(processed)} analyzed, {responses} responses")
+    return {
+        'status': 'ok',
+        'ai_processed': len(processed),
+        'responses_generated': responses,
+        'remaining': unprocessed.count()
+    }
+
+
+@register('send_response')
+def send_response(job):
+    """Deliver a queued AIResponse (see gmail_app.outbox)"""
+    from .outbox import deliver
+
+    return deliver(job.payload['response_id'], final_attempt=job.attempts >= job.max_attempts)
@@ -0,0 +1,1113 @@
+import base64
+import json
+import random
+import threading
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+import openai
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
+from .gmail_service import GmailService
+from .ingest import bulk_upsert_emails
+from . import graph_client, jobs, rule_matcher
+from .jobs import PRIORITY_HIGH, RetryLater, _handlers, claim, enqueue, register, run_job
+from .outlook_service import OutlookService
+from .ai_rate_limit import RateLimiter, call_with_retries, is_transient_error
+from .ai_models import AIBatchJob, AIResponse, AIRole, EmailIntent, TemporalRule
+from .exceptions import RefreshTokenInvalidError
+from .locks import Heartbeat, LockHeld, acquire, default_owner, hold, release, renew
+from .models import Email, EmailAccount, GmailAccount, Job, Lease
+from .outbox import deliver, queue_send
+from .rule_matcher import KeywordAutomaton, get_rule_index
+from .push import (
+    handle_gmail_notification, handle_outlook_notifications, parse_gmail_notification, verify_push_token
+)
+from .text_cleaning import html_to_text, strip_noise
+from .triage import triage_email
+
+
+def make_account(username='ana', provider='gmail', **fields):
+    """User with one active EmailAccount"""
+    user = User.objects.create_user(username=username, password='x')
+    account = EmailAccount.objects.create(
+        user=user,
+        email=f'{username}@example.com',
+        provider=provider,
+        access_token='token',
+        refresh_token='refresh',
+        token_expires_at=timezone.now() + timedelta(hours=1),
+        **fields
+    )
+    return user, account
+
+
+class StripNoiseTests(SimpleTestCase):
+    """Quoted history, signatures and disclaimers removed from plain-text bodies"""
+
+    def test_disclaimer_word_inside_a_sentence_is_kept(self):
+        body = (
+            "Hi professor,\n"
+            "I read the course disclaimer but I still have a question: when is the final exam?\n"
+            "Thanks"
+        )
+        self.assertEqual(strip_noise(body), body)
+
+    def test_disclaimer_block_at_the_end_is_removed(self):
+        body = "Please confirm the meeting.\n\nCONFIDENTIALITY NOTICE: This email is private.\nLegal text"
+        self.assertEqual(strip_noise(body), "Please confirm the meeting.")
+
+    def test_from_line_in_the_body_is_kept(self):
+        body = "Hi,\nFrom: the syllabus I understood the exam is on Monday.\nIs that right?"
+        self.assertEqual(strip_noise(body), body)
+
+    def test_quoted_header_block_is_removed(self):
+        body = (
+            "See my answer below.\n\n"
+            "From: Ana <ana@example.com>\n"
+            "Sent: Monday, March 4, 2024\n"
+            "To: me@example.com\n"
+            "Subject: Exam\n\n"
+            "Old message"
+        )
+        self.assertEqual(strip_noise(body), "See my answer below.")
+
+
+class HtmlToTextTests(SimpleTestCase):
+
+    def test_text_after_gmail_quote_is_kept(self):
+        html = (
+            '<div>Hello</div>'
+            '<div class="gmail_quote"><blockquote>old</blockquote></div>'
+            '<div>After quote text</div>'
+        )
+        self.assertEqual(html_to_text(html), "Hello\n\nAfter quote text")
+
+    def test_nested_divs_inside_gmail_quote_are_dropped(self):
+        html = (
+            '<div>Hi</div>'
+            '<div class="gmail_quote"><div>On Monday Ana wrote:</div><blockquote><div>old</div></blockquote></div>'
+            '<p>Bye</p>'
+        )
+        self.assertEqual(html_to_text(html), "Hi\n\nBye")
+
+
+class _Executable:
+    def __init__(self, value):
+        self.value = value
+
+    def execute(self):
+        return self.value
+
+
+class _HttpStatus(dict):
+    def __init__(self, status):
+        super().__init__()
+        self.status = status
+        self.reason = 'error'
+
+
+class FakeGmailApi:
+    """Gmail client returning the given history and failing the ids in errors (id -> status)"""
+
+    def __init__(self, history, errors=None):
+        self.history_response = history
+        self.errors = errors or {}
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **params):
+        return _Executable(self.history_response)
+
+    def get(self, **params):
+        return params
+
+    def new_batch_http_request(self, callback):
+        api = self
+
+        class Batch:
+            def __init__(self):
+                self.ids = []
+
+            def add(self, request, request_id):
+                self.ids.append(request_id)
+
+            def execute(self):
+                for msg_id in self.ids:
+                    if msg_id in api.errors:
+                        callback(msg_id, None, HttpError(_HttpStatus(api.errors[msg_id]), b'error'))
+                    else:
+                        callback(msg_id, {
+                            'id': msg_id, 'threadId': f't{msg_id}', 'labelIds': ['INBOX'],
+                            'payload': {'mimeType': 'text/plain', 'body': {'data': 'aGk='}, 'headers': [
+                                {'name': 'Subject', 'value': f'Subject {msg_id}'},
+                                {'name': 'From', 'value': 'sender@example.com'},
+                                {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'},
+                            ]}
+                        }, None)
+
+        return Batch()
+
+
+class GmailHistorySyncTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account(history_id='100')
+        self.history = {
+            'history': [{'messagesAdded': [{'message': {'id': 'm1', 'labelIds': ['INBOX']}},
+                                           {'message': {'id': 'm2', 'labelIds': ['INBOX']}}]}],
+            'historyId': '200'
+        }
+        # Throttled/transient batch retries back off without waiting
+        sleep = mock.patch('gmail_app.gmail_service.time.sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def sync(self, api):
+        service = GmailService(self.user, email_account=self.account)
+        return service._sync_history(api, self.account, lazy_bodies=False)
+
+    def test_cursor_advances_when_every_message_is_fetched(self):
+        self.sync(FakeGmailApi(self.history))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.history_id, '200')
+        self.assertEqual(Email.objects.filter(email_account=self.account).count(), 2)
+
+    def test_cursor_kept_when_a_message_fails(self):
+        self.sync(FakeGmailApi(self.history, errors={'m2': 500}))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.history_id, '100')
+        self.assertEqual(list(Email.objects.values_list('provider_id', flat=True)), ['m1'])
+
+        # The replay fetches the missing message without duplicating the stored one
+        self.sync(FakeGmailApi(self.history))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.history_id, '200')
+        self.assertEqual(Email.objects.filter(email_account=self.account).count(), 2)
+
+    def test_throttled_messages_given_up_keep_the_cursor(self):
+        with self.settings(GMAIL_BATCH_MAX_RETRIES=1):
+            self.sync(FakeGmailApi(self.history, errors={'m1': 429}))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.history_id, '100')
+
+    def test_deleted_messages_do_not_block_the_cursor(self):
+        self.sync(FakeGmailApi(self.history, errors={'m2': 404}))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.history_id, '200')
+
+
+class OutlookDeltaSyncTests(TestCase):
+
+    def test_removed_messages_are_kept(self):
+        user, account = make_account(provider='outlook')
+        Email.objects.create(
+            email_account=account, provider_id='msg-1', subject='Kept',
+            sender='a@example.com', recipient=account.email, received_date=timezone.now()
+        )
+        page = mock.Mock(status_code=200)
+        page.json.return_value = {
+            'value': [{'id': 'msg-1', '@removed': {'reason': 'changed'}}],
+            '@odata.deltaLink': 'https://graph.microsoft.com/delta?token=2'
+        }
+
+        with mock.patch('gmail_app.outlook_service.graph_client.get', return_value=page):
+            result = OutlookService(user).sync_emails(email_account_id=account.id)
+
+        self.assertEqual(result['removed_emails'], 1)
+        self.assertTrue(Email.objects.filter(provider_id='msg-1').exists())
+        account.refresh_from_db()
+        self.assertEqual(account.delta_link, 'https://graph.microsoft.com/delta?token=2')
+
+
+class BulkUpsertTests(TestCase):
+
+    def row(self, provider_id, **fields):
+        return {
+            'provider_id': provider_id, 'subject': f'Subject {provider_id}', 'sender': 'a@example.com',
+            'recipient': 'b@example.com', 'received_date': timezone.now(), **fields
+        }
+
+    def test_metadata_rows_keep_stored_bodies_in_a_mixed_page(self):
+        _, account = make_account()
+        bulk_upsert_emails(account, [self.row('m1', body_plain='stored body', body_fetched=True)])
+
+        created = bulk_upsert_emails(account, [
+            self.row('m1', subject='Renamed'),
+            self.row('m2', body_plain='new body', body_fetched=True),
+        ])
+
+        stored = Email.objects.get(provider_id='m1')
+        self.assertEqual(stored.subject, 'Renamed')
+        self.assertEqual(stored.body_plain, 'stored body')
+        self.assertTrue(stored.body_fetched)
+        self.assertEqual([email.provider_id for email in created], ['m2'])
+        self.assertEqual(Email.objects.get(provider_id='m2').body_plain, 'new body')
+
+
+class AutoSyncRefreshFailureTests(TestCase):
+
+    def test_invalid_grant_deactivates_only_the_failing_mailbox(self):
+        from .management.commands.auto_sync_emails import Command
+
+        user, account = make_account()
+        other = EmailAccount.objects.create(
+            user=user, email='other@example.com', provider='gmail', access_token='token',
+            token_expires_at=timezone.now() + timedelta(hours=1)
+        )
+        GmailAccount.objects.create(
+            user=user, email=other.email, access_token='token', refresh_token='refresh',
+            token_expires_at=timezone.now() + timedelta(hours=1)
+        )
+
+        with mock.patch.object(GmailService, 'sync_emails', side_effect=RefreshTokenInvalidError('expired')):
+            result = Command().sync_account(account)
+
+        self.assertEqual(result['status'], 'error')
+        account.refresh_from_db()
+        other.refresh_from_db()
+        self.assertFalse(account.is_active)
+        self.assertTrue(other.is_active)
+        # The legacy row belongs to the healthy mailbox
+        self.assertTrue(GmailAccount.objects.filter(user=user).exists())
+
+
+class SavePlansTests(TestCase):
+
+    def setUp(self):
+        _, self.account = make_account()
+        self.emails = [
+            Email.objects.create(
+                email_account=self.account, provider_id=f'm{index}', subject=f'Subject {index}',
+                sender='a@example.com', recipient=self.account.email, received_date=timezone.now()
+            )
+            for index in range(2)
+        ]
+
+    def plan(self, reason):
+        from .ai_service import EmailAIProcessor
+
+        return EmailAIProcessor.make_plan(
+            {'intent_type': 'unclear', 'confidence': 0.9, 'decision': 'respond', 'reason': reason,
+             'processing_time_ms': 1},
+            response_text=f'Reply {reason}'
+        )
+
+    def save_plans(self, emails, plans):
+        from .ai_service import EmailAIProcessor
+
+        with mock.patch('gmail_app.ai_service.OpenAI'):
+            processor = EmailAIProcessor()
+        return processor.save_plans(emails, plans)
+
+    def test_concurrent_analysis_is_kept_and_the_rest_saved(self):
+        first, second = self.emails
+        self.save_plans([first], {first.id: self.plan('other job')})
+
+        # first was analyzed by another job meanwhile, and second appears twice
+        intents, responses = self.save_plans(
+            [first, second, second], {first.id: self.plan('late'), second.id: self.plan('new')}
+        )
+
+        self.assertEqual(set(intents), {second.id})
+        self.assertEqual(set(responses), {second.id})
+        self.assertEqual(EmailIntent.objects.get(email=first).decision_reason, 'other job')
+        self.assertEqual(AIResponse.objects.filter(email_intent__email=first).count(), 1)
+        self.assertEqual(AIResponse.objects.filter(email_intent__email=second).count(), 1)
+
+
+class FakeBatchClient:
+    """OpenAI client whose batches finish at once, answering each request with reply(request line)"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.uploaded = {}  # file id -> JSONL content
+        self.inputs = {}    # batch id -> input file id
+        self.files = mock.Mock(create=self._create_file, content=self._content)
+        self.batches = mock.Mock(create=self._create_batch, retrieve=self._retrieve)
+
+    def _create_file(self, file, purpose):
+        file_id = f'file-{len(self.uploaded) + 1}'
+        self.uploaded[file_id] = file[1].decode('utf-8')
+        return mock.Mock(id=file_id)
+
+    def _content(self, file_id):
+        return mock.Mock(text=self.uploaded[file_id])
+
+    def _create_batch(self, input_file_id, **params):
+        batch_id = f'batch-{len(self.inputs) + 1}'
+        self.inputs[batch_id] = input_file_id
+        return mock.Mock(id=batch_id, status='validating')
+
+    def _write(self, records):
+        """Result file with records, or None when there are none"""
+        if not records:
+            return None
+        payload = '\n'.join(json.dumps(record) for record in records).encode('utf-8')
+        return self._create_file(('results.jsonl', payload), 'batch_output').id
+
+    def _retrieve(self, batch_id):
+        lines = [json.loads(line) for line in self.uploaded[self.inputs[batch_id]].splitlines()]
+        output, errors = [], []
+        for line in lines:
+            content = self.reply(line)
+            if content is None:
+                # Failed request: goes to the error file
+                errors.append({'custom_id': line['custom_id'], 'response': {
+                    'status_code': 429, 'body': {'error': {'message': 'Rate limit reached'}}
+                }})
+            else:
+                output.append({'custom_id': line['custom_id'], 'response': {
+                    'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}
+                }})
+        return mock.Mock(
+            status='completed', output_file_id=self._write(output), error_file_id=self._write(errors),
+            request_counts=mock.Mock(completed=len(output), failed=len(errors)), errors=None
+        )
+
+
+@override_settings(AI_TRIAGE_ENABLED=False)
+class AIBatchProcessorTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account()
+        AIRole.objects.create(user=self.user, name='Professor', context_description='Teaches a course')
+        self.email = Email.objects.create(
+            email_account=self.account, provider_id='m1', subject='Exam date',
+            sender='student@example.com', recipient=self.account.email, received_date=timezone.now(),
+            body_plain='When is the final exam?', body_fetched=True
+        )
+
+    @staticmethod
+    def reply(line):
+        if line['custom_id'].startswith('analysis-'):
+            return json.dumps({'intent_type': 'question', 'confidence': 0.9, 'decision': 'respond',
+                               'reason': 'Course question'})
+        return 'The exam is on Monday.'
+
+    def processor(self, client):
+        from .ai_batch import AIBatchProcessor
+
+        with mock.patch('gmail_app.ai_service.OpenAI'):
+            return AIBatchProcessor(client=client)
+
+    def test_analysis_then_response_jobs(self):
+        client = FakeBatchClient(self.reply)
+        processor = self.processor(client)
+
+        result = processor.submit([self.email], user=self.user)
+        self.assertEqual((result['decided_locally'], result['submitted']), (0, 1))
+        analysis = AIBatchJob.objects.get(phase='analysis')
+        self.assertEqual(analysis.email_ids, [self.email.id])
+        # Emails of a pending job are not submitted again
+        self.assertFalse(processor.pending_emails(self.user).exists())
+
+        self.assertEqual(processor.poll(), [analysis])
+        intent = EmailIntent.objects.get(email=self.email)
+        self.assertEqual(intent.ai_decision, 'respond')
+        response_job = AIBatchJob.objects.get(phase='response')
+        self.assertEqual(response_job.parent, analysis)
+        self.assertFalse(AIResponse.objects.exists())
+
+        self.assertEqual(processor.poll(), [response_job])
+        response = AIResponse.objects.get(email_intent=intent)
+        self.assertEqual(response.status, 'pending_approval')
+        self.assertEqual(response.response_text, 'The exam is on Monday.')
+        self.assertEqual(processor.poll(), [])
+
+    def test_failed_request_is_submitted_again(self):
+        client = FakeBatchClient(lambda line: None)
+        processor = self.processor(client)
+        processor.submit([self.email], user=self.user)
+
+        self.assertEqual(len(processor.poll()), 1)
+        self.assertFalse(EmailIntent.objects.filter(email=self.email).exists())
+        self.assertFalse(AIBatchJob.objects.filter(phase='response').exists())
+
+        # The next submit picks the email up and a successful run analyzes it
+        client.reply = self.reply
+        result = processor.submit_backlog(user=self.user)
+        self.assertEqual(result['submitted'], 1)
+        processor.poll()
+        self.assertEqual(EmailIntent.objects.get(email=self.email).ai_decision, 'respond')
+
+    def test_email_without_role_is_decided_locally(self):
+        AIRole.objects.filter(user=self.user).update(is_active=False)
+        client = FakeBatchClient(self.reply)
+
+        result = self.processor(client).submit([self.email], user=self.user)
+
+        self.assertEqual((result['decided_locally'], result['submitted']), (1, 0))
+        self.assertFalse(client.inputs)
+        self.assertTrue(EmailIntent.objects.filter(email=self.email).exists())
+
+
+def gmail_push_body(email, history_id):
+    """Pub/Sub push request body of a Gmail mailbox change"""
+    data = base64.b64encode(json.dumps({'emailAddress': email, 'historyId': history_id}).encode()).decode()
+    return json.dumps({'message': {'data': data, 'messageId': '1'}, 'subscription': 'projects/p/subscriptions/s'})
+
+
+@override_settings(PUSH_VERIFICATION_TOKEN='secret')
+class GmailPushTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account(history_id='100')
+
+    def push(self, body, token='secret'):
+        return self.client.post(
+            f"{reverse('gmail_push_webhook')}?token={token}", data=body, content_type='application/json'
+        )
+
+    def test_notification_is_parsed(self):
+        self.assertEqual(
+            parse_gmail_notification(gmail_push_body('Ana@Example.com', '150')),
+            {'email': 'ana@example.com', 'history_id': 150}
+        )
+
+    def test_wrong_token_is_rejected(self):
+        response = self.push(gmail_push_body(self.account.email, 150), token='wrong')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Job.objects.exists())
+
+    def test_token_is_required_when_not_configured(self):
+        with self.settings(PUSH_VERIFICATION_TOKEN=''):
+            self.assertFalse(verify_push_token(''))
+
+    def test_malformed_notification_is_acknowledged(self):
+        response = self.push('{"message": {"data": "not base64 json"}}')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Job.objects.exists())
+
+    def test_notification_queues_a_high_priority_sync(self):
+        response = self.push(gmail_push_body(self.account.email.upper(), 150))
+        self.assertEqual(response.status_code, 204)
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.priority), ('sync_account', PRIORITY_HIGH))
+        self.assertEqual(job.payload, {'account_id': self.account.id})
+
+    def test_stale_history_id_is_ignored(self):
+        scheduled = handle_gmail_notification({'email': self.account.email, 'history_id': 100})
+        self.assertEqual(scheduled, 0)
+        self.assertFalse(Job.objects.exists())
+
+    def test_notifications_are_coalesced_into_the_queued_sync(self):
+        handle_gmail_notification({'email': self.account.email, 'history_id': 150})
+        handle_gmail_notification({'email': self.account.email, 'history_id': 160})
+        self.assertEqual(Job.objects.filter(status='queued').count(), 1)
+
+        # One arriving while the sync runs queues exactly one more run
+        claim('worker-1')
+        handle_gmail_notification({'email': self.account.email, 'history_id': 170})
+        handle_gmail_notification({'email': self.account.email, 'history_id': 180})
+        self.assertEqual(Job.objects.filter(status='running').count(), 1)
+        self.assertEqual(Job.objects.filter(status='queued').count(), 1)
+
+
+class OutlookPushTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account(
+            provider='outlook', push_subscription_id='sub-1', push_client_state='state-1'
+        )
+
+    def notify(self, client_state='state-1', subscription_id='sub-1', message_id='msg-1'):
+        return self.client.post(reverse('outlook_push_webhook'), data=json.dumps({'value': [{
+            'subscriptionId': subscription_id, 'clientState': client_state,
+            'changeType': 'created', 'resourceData': {'id': message_id}
+        }]}), content_type='application/json')
+
+    def test_validation_token_is_echoed(self):
+        response = self.client.post(f"{reverse('outlook_push_webhook')}?validationToken=abc%20123")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response.content, b'abc 123')
+
+    def test_notification_queues_the_message_fetch(self):
+        response = self.notify()
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.priority), ('fetch_outlook_message', PRIORITY_HIGH))
+        self.assertEqual(job.payload, {'account_id': self.account.id, 'message_id': 'msg-1'})
+
+        # Graph may deliver the same notification twice
+        self.notify()
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_wrong_client_state_is_rejected(self):
+        self.assertEqual(self.notify(client_state='forged').status_code, 202)
+        self.assertEqual(handle_outlook_notifications({'value': [{
+            'subscriptionId': 'sub-1', 'clientState': '', 'resourceData': {'id': 'msg-1'}
+        }]}), 0)
+        self.assertFalse(Job.objects.exists())
+
+    def test_unknown_or_disconnected_subscription_is_ignored(self):
+        self.notify(subscription_id='sub-2')
+        self.account.is_active = False
+        self.account.save()
+        self.notify()
+        self.assertFalse(Job.objects.exists())
+
+    def test_malformed_payload_is_acknowledged(self):
+        response = self.client.post(reverse('outlook_push_webhook'), data='not json', content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(Job.objects.exists())
+
+
+class RecordedHeartbeat:
+    """Heartbeat stand-in keeping beat() so a test can call it from the handler"""
+    instances = []
+
+    def __init__(self, interval, beat, name='heartbeat'):
+        self.beat = beat
+        RecordedHeartbeat.instances.append(self)
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+
+@override_settings(JOB_RETRY_BASE_SECONDS=30, JOB_RETRY_MAX_SECONDS=3600, JOB_LEASE_SECONDS=300)
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        self.beats = []
+        for kind, handler in (('test_ok', self.succeed), ('test_fail', self.fail_run),
+                              ('test_later', self.retry_later), ('test_beat', self.beat_while_running)):
+            register(kind)(handler)
+            self.addCleanup(_handlers.pop, kind)
+
+    def succeed(self, job):
+        return {'status': 'ok'}
+
+    def fail_run(self, job):
+        raise ValueError('boom')
+
+    def retry_later(self, job):
+        raise RetryLater('account locked', delay=5)
+
+    def beat_while_running(self, job):
+        beat = RecordedHeartbeat.instances[-1].beat
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() + timedelta(seconds=10))
+        self.beats.append(beat())
+        job.refresh_from_db()
+        self.assertGreater(job.lease_expires_at, timezone.now() + timedelta(seconds=290))
+
+        # Taken over by another worker: the heartbeat stops
+        Job.objects.filter(pk=job.pk).update(locked_by='worker-2')
+        self.beats.append(beat())
+        Job.objects.filter(pk=job.pk).update(locked_by=job.locked_by)
+
+    def assert_due_in(self, job, seconds):
+        job.refresh_from_db()
+        delay = (job.run_after - timezone.now()).total_seconds()
+        self.assertAlmostEqual(delay, seconds, delta=2)
+
+    def test_dedupe_key_reuses_the_queued_job(self):
+        first = enqueue('test_ok', {'n': 1}, dedupe_key='k')
+        self.assertEqual(enqueue('test_ok', {'n': 2}, dedupe_key='k'), first)
+
+        # Once it is claimed, the next enqueue queues one more run
+        claim('worker-1')
+        second = enqueue('test_ok', {'n': 3}, dedupe_key='k')
+        self.assertNotEqual(second, first)
+        self.assertEqual(enqueue('test_ok', dedupe_key='k'), second)
+
+    def test_claim_order_and_lease(self):
+        low = enqueue('test_ok')
+        high = enqueue('test_ok', priority=PRIORITY_HIGH)
+        enqueue('test_ok', delay=60)
+
+        job = claim('worker-1')
+        self.assertEqual(job, high)
+        self.assertEqual((job.status, job.locked_by, job.attempts), ('running', 'worker-1', 1))
+        self.assertEqual(claim('worker-2'), low)
+        # The delayed job is not due yet
+        self.assertIsNone(claim('worker-3'))
+
+    def test_conditional_update_loses_a_row_leased_after_it_was_read(self):
+        contested = enqueue('test_ok', priority=PRIORITY_HIGH)
+        other = enqueue('test_ok')
+        real_claimable = jobs._claimable
+
+        def read_then_lose(now, kinds=None):
+            rows = list(real_claimable(now, kinds).values('id', 'status', 'locked_by', 'attempts'))
+            # Another worker leases the first row between the read and our UPDATE
+            Job.objects.filter(pk=contested.pk).update(status='running', locked_by='worker-2', attempts=1)
+            return mock.Mock(values=lambda *fields: rows)
+
+        with mock.patch('gmail_app.jobs._claimable', side_effect=read_then_lose):
+            job = claim('worker-1')
+
+        self.assertEqual(job, other)
+        contested.refresh_from_db()
+        self.assertEqual((contested.locked_by, contested.attempts), ('worker-2', 1))
+
+    def test_expired_lease_is_taken_over(self):
+        job = enqueue('test_ok')
+        claim('worker-1')
+        self.assertIsNone(claim('worker-2'))
+
+        Job.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        taken = claim('worker-2')
+        self.assertEqual((taken.pk, taken.locked_by, taken.attempts), (job.pk, 'worker-2', 2))
+
+        # The worker that lost the lease cannot record an outcome anymore
+        job.locked_by = 'worker-1'
+        jobs._finish(job, 'failed', error='late')
+        self.assertTrue(run_job(taken))
+        taken.refresh_from_db()
+        self.assertEqual((taken.status, taken.result), ('done', {'status': 'ok'}))
+
+    def test_failures_back_off_exponentially_then_fail(self):
+        job = enqueue('test_fail', max_attempts=3)
+
+        self.assertFalse(run_job(claim('worker-1')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), ('queued', 'ValueError: boom'))
+        self.assert_due_in(job, 30)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_job(claim('worker-1'))
+        self.assert_due_in(job, 60)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_job(claim('worker-1'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 3))
+
+    def test_retry_later_does_not_count_as_an_attempt(self):
+        job = enqueue('test_later')
+        self.assertFalse(run_job(claim('worker-1')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), ('queued', 0, 'account locked'))
+        self.assert_due_in(job, 5)
+
+    def test_heartbeat_extends_the_lease_until_it_is_lost(self):
+        RecordedHeartbeat.instances = []
+        job = enqueue('test_beat')
+
+        with mock.patch('gmail_app.jobs.Heartbeat', RecordedHeartbeat):
+            self.assertTrue(run_job(claim('worker-1')))
+
+        beat = RecordedHeartbeat.instances[-1].beat
+        self.assertEqual(self.beats, [True, False])
+        # Not extended once the job is finished either
+        self.assertFalse(beat())
+        job.refresh_from_db()
+        self.assertIsNone(job.lease_expires_at)
+
+
+class LockTests(TestCase):
+
+    def expire(self, name):
+        Lease.objects.filter(name=name).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_held_lock_is_not_acquired(self):
+        self.assertTrue(acquire('auto_sync', 'a'))
+        self.assertFalse(acquire('auto_sync', 'b'))
+        self.assertEqual(Lease.objects.get(name='auto_sync').owner, 'a')
+
+    def test_expired_lease_is_taken_over(self):
+        acquire('sync-account:1', 'a')
+        self.expire('sync-account:1')
+
+        self.assertTrue(acquire('sync-account:1', 'b'))
+        # The previous holder lost it: renewing and releasing do nothing
+        self.assertFalse(renew('sync-account:1', 'a'))
+        release('sync-account:1', 'a')
+        self.assertEqual(Lease.objects.get(name='sync-account:1').owner, 'b')
+
+    def test_renew_and_release(self):
+        acquire('auto_sync', 'a', ttl=10)
+        self.assertTrue(renew('auto_sync', 'a', ttl=600))
+        self.assertGreater(Lease.objects.get(name='auto_sync').expires_at, timezone.now() + timedelta(seconds=590))
+
+        release('auto_sync', 'a')
+        self.assertTrue(acquire('auto_sync', 'b'))
+
+    def test_hold_raises_when_held_and_releases_after_the_block(self):
+        acquire('auto_sync', 'other')
+        with self.assertRaises(LockHeld):
+            with hold('auto_sync'):
+                pass
+
+        release('auto_sync', 'other')
+        with hold('auto_sync'):
+            self.assertEqual(Lease.objects.get(name='auto_sync').owner, default_owner())
+        self.assertFalse(Lease.objects.filter(name='auto_sync').exists())
+
+
+class HeartbeatTests(SimpleTestCase):
+
+    def test_beats_until_stopped(self):
+        beats = threading.Semaphore(0)
+        heartbeat = Heartbeat(0.01, beats.release).start()
+        self.assertTrue(beats.acquire(timeout=5))
+        self.assertTrue(beats.acquire(timeout=5))
+        heartbeat.stop()
+        self.assertFalse(heartbeat._thread.is_alive())
+
+    def test_stops_when_beat_returns_false(self):
+        calls = []
+
+        def beat():
+            calls.append(1)
+            return False
+
+        heartbeat = Heartbeat(0.01, beat).start()
+        heartbeat._thread.join(timeout=5)
+        self.assertFalse(heartbeat._thread.is_alive())
+        self.assertEqual(len(calls), 1)
+        heartbeat.stop()
+
+
+class GraphClientRetryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.session.request.side_effect = [
+            mock.Mock(status_code=503, headers={'Retry-After': '1'}),
+            mock.Mock(status_code=200, headers={}),
+        ]
+        for target in ('gmail_app.graph_client.get_session', 'gmail_app.graph_client.time.sleep'):
+            patcher = mock.patch(target, return_value=self.session)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_idempotent_call_is_retried(self):
+        response = graph_client.get('https://graph.microsoft.com/v1.0/me/messages/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.request.call_count, 2)
+
+    def test_send_is_not_retried(self):
+        response = graph_client.post('https://graph.microsoft.com/v1.0/me/messages/1/send')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.session.request.call_count, 1)
+
+    def test_post_retried_when_asked(self):
+        response = graph_client.post('https://graph.microsoft.com/v1.0/me/messages', retry=True)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(SEND_RATE_LIMITS={'gmail': {'per_minute': 2, 'per_day': 3}})
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account()
+        self.count = 0
+        self.response = self.make_response()
+        queue_send(self.response, self.user)
+        for target in ('send_reply', 'find_sent_reply'):
+            patcher = mock.patch(f'gmail_app.outbox.{target}')
+            setattr(self, target, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.send_reply.return_value = '<sent@example.com>'
+        self.find_sent_reply.return_value = None
+
+    def make_response(self, **fields):
+        self.count += 1
+        email = Email.objects.create(
+            email_account=self.account, provider_id=f'm{self.count}', subject='Exam date',
+            sender='student@example.com', recipient=self.account.email, received_date=timezone.now()
+        )
+        intent = EmailIntent.objects.create(
+            email=email, intent_type='unclear', confidence_score=0.9, ai_decision='respond',
+            decision_reason='Course question', processing_time_ms=1
+        )
+        return AIResponse.objects.create(
+            email_intent=intent, response_text='On Monday.', response_subject='Re: Exam date',
+            status=fields.pop('status', 'pending_approval'), **fields
+        )
+
+    def sent_ago(self, *seconds):
+        for ago in seconds:
+            self.make_response(status='sent', sent_at=timezone.now() - timedelta(seconds=ago))
+
+    def test_first_attempt_sends(self):
+        result = deliver(self.response.id)
+
+        self.assertEqual(result, {'status': 'ok', 'message_id': '<sent@example.com>'})
+        self.find_sent_reply.assert_not_called()
+        self.response.refresh_from_db()
+        self.assertEqual((self.response.status, self.response.send_attempts), ('sent', 1))
+        self.assertEqual(self.response.provider_message_id, '<sent@example.com>')
+
+    def test_retry_after_a_partial_send_does_not_send_again(self):
+        AIResponse.objects.filter(id=self.response.id).update(send_attempts=1)
+        self.find_sent_reply.return_value = '<earlier@example.com>'
+
+        deliver(self.response.id)
+
+        self.send_reply.assert_not_called()
+        self.response.refresh_from_db()
+        self.assertEqual((self.response.status, self.response.send_attempts), ('sent', 2))
+        self.assertEqual(self.response.provider_message_id, '<earlier@example.com>')
+
+    def test_retry_sends_when_the_previous_attempt_did_not_arrive(self):
+        AIResponse.objects.filter(id=self.response.id).update(send_attempts=1)
+
+        deliver(self.response.id)
+
+        self.find_sent_reply.assert_called_once()
+        self.send_reply.assert_called_once()
+
+    def test_failure_keeps_the_response_approved_until_the_final_attempt(self):
+        self.send_reply.side_effect = Exception('SMTP down')
+
+        with self.assertRaises(Exception):
+            deliver(self.response.id)
+        self.response.refresh_from_db()
+        self.assertEqual((self.response.status, self.response.last_send_error), ('approved', 'SMTP down'))
+
+        with self.assertRaises(Exception):
+            deliver(self.response.id, final_attempt=True)
+        self.response.refresh_from_db()
+        self.assertEqual((self.response.status, self.response.send_attempts), ('failed', 2))
+
+    def test_per_minute_limit_waits_for_the_oldest_send_to_leave_the_window(self):
+        self.sent_ago(10, 40)
+
+        with self.assertRaises(RetryLater) as raised:
+            deliver(self.response.id)
+
+        self.assertAlmostEqual(raised.exception.delay, 21, delta=2)
+        self.send_reply.assert_not_called()
+
+    def test_per_day_limit(self):
+        self.sent_ago(120, 7200, 23 * 3600)
+
+        with self.assertRaises(RetryLater) as raised:
+            deliver(self.response.id)
+
+        self.assertAlmostEqual(raised.exception.delay, 3601, delta=2)
+
+    def test_sends_outside_the_windows_do_not_count(self):
+        self.sent_ago(120, 2 * 86400)
+        deliver(self.response.id)
+        self.send_reply.assert_called_once()
+
+    def test_account_busy_sending_is_retried_shortly(self):
+        acquire(f'send-account:{self.account.id}', 'other-worker')
+
+        with self.assertRaises(RetryLater) as raised:
+            deliver(self.response.id)
+
+        self.assertEqual(raised.exception.delay, 2)
+
+
+class KeywordAutomatonTests(SimpleTestCase):
+
+    def test_matches_naive_substring_search(self):
+        rng = random.Random(7)
+        for _ in range(300):
+            keywords = {
+                ''.join(rng.choice('abc') for _ in range(rng.randint(1, 4))): rank
+                for rank in range(rng.randint(1, 6))
+            }
+            text = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 30)))
+            found = [rank for keyword, rank in keywords.items() if keyword in text]
+
+            self.assertEqual(KeywordAutomaton(keywords).search(text), min(found, default=None), (keywords, text))
+
+    def test_keyword_found_through_a_failure_link(self):
+        automaton = KeywordAutomaton({'exam date': 1, 'am': 0})
+        self.assertEqual(automaton.search('the exam date'), 0)
+        self.assertIsNone(automaton.search('final grade'))
+
+
+class RuleIndexTests(TestCase):
+
+    def setUp(self):
+        self.user, _ = make_account()
+        self.role = AIRole.objects.create(user=self.user, name='Professor', context_description='Teaches a course')
+        self.now = timezone.now()
+        self.addCleanup(rule_matcher._indexes.clear)
+
+    def rule(self, name, keywords, start, end, priority=1):
+        return TemporalRule.objects.create(
+            ai_role=self.role, name=name, keywords=keywords, response_template='...', status='active',
+            start_date=self.now + timedelta(hours=start), end_date=self.now + timedelta(hours=end),
+            priority=priority
+        )
+
+    def test_highest_priority_rule_wins(self):
+        self.rule('Exam', 'exam, final', -1, 1, priority=1)
+        midterm = self.rule('Midterm', 'midterm exam', -1, 1, priority=5)
+
+        index = get_rule_index(self.role)
+        self.assertEqual(index.match('when is the midterm exam?'), midterm)
+        self.assertEqual(index.match('the final exam').name, 'Exam')
+        self.assertIsNone(index.match('office hours'))
+
+    @override_settings(TEMPORAL_RULE_INDEX_MAX_AGE_SECONDS=86400)
+    def test_index_expires_when_a_rule_ends_or_the_next_starts(self):
+        ending = self.rule('Exam', 'exam', -1, 2)
+        self.assertEqual(get_rule_index(self.role).expires_at, ending.end_date)
+
+        upcoming = self.rule('Holidays', 'holidays', 1, 48)
+        self.assertEqual(get_rule_index(self.role).expires_at, upcoming.start_date)
+
+        # Once the upcoming rule has started, the index is compiled again and includes it
+        with mock.patch('gmail_app.rule_matcher.timezone.now', return_value=upcoming.start_date):
+            self.assertEqual(get_rule_index(self.role).match('holidays'), upcoming)
+
+    def test_rule_changes_invalidate_the_index(self):
+        rule = self.rule('Exam', 'exam', -1, 1)
+        self.assertEqual(get_rule_index(self.role).match('exam'), rule)
+
+        rule.keywords = 'grades'
+        rule.save()
+        index = get_rule_index(self.role)
+        self.assertIsNone(index.match('exam'))
+        self.assertEqual(index.match('grades'), rule)
+
+        rule.delete()
+        self.assertIsNone(get_rule_index(self.role).match('grades'))
+
+
+class FakeClock:
+    """time.monotonic / time.sleep stand-in: sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def openai_error(status, headers=None, body=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    error_class = openai.RateLimitError if status == 429 else openai.InternalServerError
+    return error_class('error', response=response, body=body)
+
+
+@override_settings(AI_MAX_RETRIES=3, AI_RETRY_BASE_SECONDS=1.0, AI_RETRY_MAX_SECONDS=60.0)
+class RateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('gmail_app.ai_rate_limit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requests_wait_for_the_bucket_to_refill(self):
+        limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=0)
+        limiter.acquire(0)
+        limiter.acquire(0)
+        self.assertEqual(self.clock.sleeps, [])
+
+        # One request refills every 30s
+        limiter.acquire(0)
+        self.assertAlmostEqual(sum(self.clock.sleeps), 30)
+
+    def test_tokens_budget(self):
+        limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=600)
+        limiter.acquire(500)
+        limiter.acquire(200)
+        # 100 tokens left: 100 more refill in 10s
+        self.assertAlmostEqual(sum(self.clock.sleeps), 10)
+
+    def test_pause_stops_every_caller(self):
+        limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=0)
+        limiter.pause(20)
+        limiter.acquire(0)
+        self.assertAlmostEqual(sum(self.clock.sleeps), 20)
+
+    def test_rate_limit_honours_retry_after_and_pauses_the_bucket(self):
+        limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=0)
+        call = mock.Mock(side_effect=[openai_error(429, {'retry-after': '7'}), 'ok'])
+
+        self.assertEqual(call_with_retries(call, limiter), 'ok')
+        self.assertEqual(call.call_count, 2)
+        self.assertAlmostEqual(sum(self.clock.sleeps), 7)
+        self.assertGreaterEqual(limiter._paused_until, 1007)
+
+    def test_retry_after_ms_header(self):
+        call = mock.Mock(side_effect=[openai_error(429, {'retry-after-ms': '1500'}), 'ok'])
+        call_with_retries(call)
+        self.assertEqual(self.clock.sleeps, [1.5])
+
+    def test_exhausted_quota_is_not_retried(self):
+        call = mock.Mock(side_effect=openai_error(429, body={'code': 'insufficient_quota'}))
+        with self.assertRaises(openai.RateLimitError):
+            call_with_retries(call)
+        self.assertEqual(call.call_count, 1)
+        self.assertTrue(is_transient_error(call.side_effect))
+
+    def test_server_errors_back_off_exponentially_then_raise(self):
+        call = mock.Mock(side_effect=openai_error(500))
+        with mock.patch('gmail_app.ai_rate_limit.random.uniform', return_value=1.0):
+            with self.assertRaises(openai.InternalServerError):
+                call_with_retries(call)
+        self.assertEqual(call.call_count, 4)
+        self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0])
+
+    def test_other_errors_are_not_retried(self):
+        call = mock.Mock(side_effect=ValueError('bad request'))
+        with self.assertRaises(ValueError):
+            call_with_retries(call)
+        self.assertEqual(call.call_count, 1)
+
+
+class TriageTests(TestCase):
+
+    def setUp(self):
+        self.user, self.account = make_account()
+        self.role = AIRole.objects.create(user=self.user, name='Professor', context_description='Teaches a course')
+        self.addCleanup(rule_matcher._indexes.clear)
+
+    def email(self, sender='Student <student@example.com>', subject='Hello', **fields):
+        return Email.objects.create(
+            email_account=self.account, provider_id=f'm{Email.objects.count()}', subject=subject,
+            sender=sender, recipient=self.account.email, received_date=timezone.now(),
+            body_plain='Question about the course', body_fetched=True, **fields
+        )
+
+    def test_regular_email_needs_the_model(self):
+        self.assertIsNone(triage_email(self.email(), self.role))
+
+    def test_no_reply_senders_are_ignored(self):
+        for sender in ('no-reply@example.com', 'Canvas <noreply+42@example.com>', 'MAILER-DAEMON@example.com'):
+            decision = triage_email(self.email(sender=sender), self.role)
+            self.assertEqual(decision['decision'], 'ignore', sender)
+        self.assertIsNone(triage_email(self.email(sender='noreplyfan@example.com'), self.role))
+
+    def test_bulk_mail_is_ignored(self):
+        decision = triage_email(self.email(is_bulk=True), self.role)
+        self.assertEqual((decision['intent_type'], decision['decision']), ('spam', 'ignore'))
+
+    def test_sender_outside_allowed_domains_is_escalated(self):
+        self.role.allowed_domains = '@eafit.edu.co, @company.com'
+
+        self.assertEqual(triage_email(self.email(), self.role)['decision'], 'escalate')
+        self.assertIsNone(triage_email(self.email(sender='ana@eafit.edu.co'), self.role))
+        self.assertIsNone(triage_email(self.email(sender='ana@mail.company.com'), self.role))
+
+    def test_temporal_rule_match_overrides_the_ignore(self):
+        TemporalRule.objects.create(
+            ai_role=self.role, name='Exam', keywords='final exam', response_template='...', status='active',
+            start_date=timezone.now() - timedelta(hours=1), end_date=timezone.now() + timedelta(hours=1)
+        )
+        email = self.email(sender='no-reply@lms.example.com', subject='Final exam schedule published')
+        self.assertIsNone(triage_email(email, self.role))
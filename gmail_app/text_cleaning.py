@@ -0,0 +1,218 @@
+"""
+Email body preprocessing for LLM calls
+
+Turns the stored body into the text worth sending to the model:
+HTML is converted to text, quoted reply history, signatures and legal disclaimers are
+removed, and the result is truncated to a token budget measured with the model's tokenizer
+(tiktoken, with a ~4 characters per token estimate when it is not available).
+
+The cleaned (untruncated) text is cached on Email.cleaned_body; it is reset whenever the
+body is stored again.
+"""
+import re
+import logging
+import threading
+from html import unescape
+from html.parser import HTMLParser
+
+from django.conf import settings
+
+logger = logging.getLogger('gmail_app')
+
+# Lines that start the quoted history of a reply (English / Spanish clients)
+QUOTE_HEADER_PATTERNS = [
+    re.compile(r'^On .{0,200} wrote:\s*$', re.IGNORECASE),
+    re.compile(r'^El .{0,200} escribi[oó]:\s*$', re.IGNORECASE),
+    re.compile(r'^-{2,}\s*(Original Message|Mensaje original|Forwarded message|Mensaje reenviado)\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^_{10,}\s*$'),  # Outlook separator before the quoted headers
+]
+
+# "From:" starts quoted history only as the first line of a header block (Outlook style)
+FROM_HEADER_PATTERN = re.compile(r'^(From|De):\s.+$', re.IGNORECASE)
+QUOTED_HEADER_PATTERN = re.compile(r'^(Sent|Date|To|Cc|Subject|Enviado|Fecha|Para|Asunto):\s', re.IGNORECASE)
+# Lines after "From:" searched for the rest of the header block
+HEADER_BLOCK_LINES = 4
+
+# Lines that start a signature block
+SIGNATURE_PATTERNS = [
+    re.compile(r'^--\s*$'),
+    re.compile(r'^(Sent from my|Enviado desde mi) .{0,40}$', re.IGNORECASE),
+    re.compile(r'^Get Outlook for .{0,20}$', re.IGNORECASE),
+]
+
+# Lines that start a legal disclaimer (everything after them is dropped). Only matched at the
+# start of a trailing block, see _cut_at_trailing_block
+DISCLAIMER_PATTERNS = [
+    # Heading style: "DISCLAIMER", "*** Confidentiality notice ***", "Aviso legal: ..."
+    re.compile(r'^[\W_]*(CONFIDENTIALITY NOTICE|DISCLAIMER|AVISO DE CONFIDENCIALIDAD|AVISO LEGAL)[\W_]*(:|$)', re.IGNORECASE),
+    re.compile(r'^This (e-?mail|message)( and any (files|attachments).{0,40})? (is|are|may be) (confidential|intended)', re.IGNORECASE),
+    re.compile(r'^Este (correo|mensaje)( electr[oó]nico)?( y sus anexos)? (es|son|puede) (confidencial|para uso)', re.IGNORECASE),
+]
+
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'hr'}
+SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+
+# Characters per token when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, with line breaks at block elements"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+        # div/blockquote elements open inside quoted history; text is dropped while non-empty
+        self._quote_stack = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag == 'blockquote' or (tag == 'div' and (self._quote_stack or _is_gmail_quote(attrs))):
+            # Quoted history of a reply (and the divs nested in it, to find where it closes)
+            self._quote_stack.append(tag)
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self._quote_stack:
+            # Close up to the matching element (tolerates unclosed children)
+            while self._quote_stack.pop() != tag:
+                pass
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth and not self._quote_stack:
+            self.parts.append(data)
+
+
+def _is_gmail_quote(attrs):
+    return any(name == 'class' and 'gmail_quote' in (value or '').split() for name, value in attrs)
+
+
+def html_to_text(html):
+    """Visible text of an HTML body (quoted blocks are left out)"""
+    parser = _HTMLTextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+        text = ''.join(parser.parts)
+    except Exception:
+        # Malformed markup: fall back to stripping tags
+        text = unescape(re.sub(r'<[^>]+>', ' ', html))
+
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def _cut_at(lines, patterns):
+    """Lines before the first one matching any of patterns"""
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if any(pattern.search(stripped) for pattern in patterns):
+            return lines[:index]
+    return lines
+
+
+def _cut_at_quoted_headers(lines):
+    """Lines before a "From:" line that opens a quoted header block (From + Sent/To/Subject...)"""
+    for index, line in enumerate(lines):
+        if FROM_HEADER_PATTERN.search(line.strip()) and any(
+            QUOTED_HEADER_PATTERN.search(following.strip())
+            for following in lines[index + 1:index + 1 + HEADER_BLOCK_LINES]
+        ):
+            return lines[:index]
+    return lines
+
+
+def _cut_at_trailing_block(lines, patterns):
+    """
+    Lines before the first block matching patterns in the trailing part of the body
+
+    A line only qualifies when some content comes before it and it starts a block (the previous
+    line is blank or a separator), so a mention in the middle of a paragraph never cuts the text.
+    """
+    seen_content = False
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        previous = lines[index - 1].strip() if index else ''
+        starts_block = not previous or not any(char.isalnum() for char in previous)
+        if seen_content and starts_block and any(pattern.search(stripped) for pattern in patterns):
+            return lines[:index]
+        seen_content = seen_content or bool(stripped)
+    return lines
+
+
+def strip_noise(text):
+    """Remove quoted history, signature and disclaimer from a plain-text body"""
+    lines = [line for line in text.splitlines() if not line.lstrip().startswith('>')]
+    lines = _cut_at(lines, QUOTE_HEADER_PATTERNS)
+    lines = _cut_at_quoted_headers(lines)
+    lines = _cut_at(lines, SIGNATURE_PATTERNS)
+    lines = _cut_at_trailing_block(lines, DISCLAIMER_PATTERNS)
+
+    cleaned = re.sub(r'\n{3,}', '\n\n', '\n'.join(line.rstrip() for line in lines)).strip()
+    # A message that is only quoted text (e.g. a bare forward) keeps its content
+    return cleaned or text.strip()
+
+
+def clean_body(body_plain, body_html):
+    """Cleaned text of a body, using the HTML part when there is no plain text"""
+    text = body_plain if body_plain.strip() else html_to_text(body_html or '')
+    return strip_noise(text)
+
+
+def _get_encoding():
+    """tiktoken encoding of OPENAI_MODEL, loaded once per process (None when unavailable)"""
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+                try:
+                    _encoding = tiktoken.encoding_for_model(settings.OPENAI_MODEL)
+                except KeyError:
+                    _encoding = tiktoken.get_encoding('o200k_base')
+            except Exception as e:
+                logger.warning(f"Tokenizer unavailable, estimating {CHARS_PER_TOKEN} chars per token: {e}")
+                _encoding = None
+    return _encoding
+
+
+def truncate_to_tokens(text, max_tokens):
+    """text cut to at most max_tokens tokens"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+
+    # No need to tokenize text that is short enough by any measure
+    if len(text) <= max_tokens:
+        return text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def get_cleaned_body(email):
+    """Cleaned body of email, computed once and cached on the row"""
+    if email.cleaned_body is None:
+        email.cleaned_body = clean_body(email.body_plain, email.body_html)
+        # Not cached while the body has not been downloaded (metadata-only sync)
+        if email.pk and email.body_fetched:
+            type(email).objects.filter(pk=email.pk).update(cleaned_body=email.cleaned_body)
+    return email.cleaned_body
+
+
+def body_for_prompt(email, max_tokens):
+    """Cleaned body of email truncated to max_tokens"""
+    return truncate_to_tokens(get_cleaned_body(email), max_tokens)
@@ -0,0 +1,88 @@
+"""
+Deterministic triage before the LLM
+
+Cheap local checks that decide obvious cases (senders outside the role's allowed domains,
+no-reply senders, newsletters and automated mail) without an OpenAI call. Emails that
+match an active temporal rule are never ignored here: they always reach the model.
+"""
+import re
+import logging
+from email.utils import parseaddr
+
+from .rule_matcher import match_temporal_rule
+
+logger = logging.getLogger('gmail_app')
+
+# Local parts of addresses that never read replies
+NO_REPLY_PATTERN = re.compile(
+    r'^(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer[-_.]daemon|postmaster|bounces?)([-+_.].*)?$'
+)
+
+
+def parse_allowed_domains(allowed_domains):
+    """
+    Normalize AIRole.allowed_domains ("@eafit.edu.co, @company.com", one per line, ...)
+
+    Returns:
+        list: lowercase domains without the leading '@'
+    """
+    return [
+        domain.strip().lstrip('@').lower()
+        for domain in re.split(r'[\s,;]+', allowed_domains or '')
+        if domain.strip().lstrip('@')
+    ]
+
+
+def sender_domain_allowed(address, domains):
+    """Whether address belongs to one of domains (subdomains included)"""
+    domain = address.rpartition('@')[2]
+    return any(domain == allowed or domain.endswith('.' + allowed) for allowed in domains)
+
+
+def is_no_reply(address):
+    """Whether address is a no-reply / automated mailbox"""
+    return bool(NO_REPLY_PATTERN.match(address.partition('@')[0]))
+
+
+def triage_email(email, ai_role):
+    """
+    Decide an email locally when the answer is obvious
+
+    Args:
+        email: Email instance
+        ai_role: active AIRole of the owner
+
+    Returns:
+        dict with intent_type, confidence, decision, reason (like analyze_email_intent),
+        or None when the email needs the model
+    """
+    address = parseaddr(email.sender)[1].lower()
+
+    domains = parse_allowed_domains(ai_role.allowed_domains)
+    if domains and not sender_domain_allowed(address, domains):
+        return {
+            'intent_type': 'unclear',
+            'confidence': 1.0,
+            'decision': 'escalate',
+            'reason': f"Triage: sender domain not in allowed domains ({address or email.sender})"
+        }
+
+    if is_no_reply(address):
+        reason = f"Triage: no-reply sender ({address})"
+    elif email.is_bulk:
+        reason = "Triage: bulk/automated mail (List-Unsubscribe, Precedence or Auto-Submitted header)"
+    else:
+        return None
+
+    # A temporal rule hit means the role expects this kind of email: let the model decide
+    rule = match_temporal_rule(email, ai_role)
+    if rule:
+        logger.info(f"Triage skipped for email {email.id}: matches temporal rule {rule.name}")
+        return None
+
+    return {
+        'intent_type': 'spam',
+        'confidence': 1.0,
+        'decision': 'ignore',
+        'reason': reason
+    }
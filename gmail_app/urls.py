@@ -28,6 +28,7 @@ urlpatterns = [
     # Email syncing (legacy)
     path('sync-emails/', views.sync_emails, name='sync_emails'),
     path('api/sync-emails/', views.sync_emails_api, name='sync_emails_api'),
+    path('api/jobs/<int:job_id>/', views.job_status, name='job_status'),
 
     # Email details & system
     path('email/<int:email_id>/', views.email_detail, name='email_detail'),
@@ -51,4 +52,8 @@ urlpatterns = [
     path('response/edit/<int:response_id>/', views.edit_response, name='edit_response'),
     path('api/emails-ai-status/', views.get_all_emails_with_ai_status, name='get_all_emails_with_ai_status'),
     path('process-existing-emails/', views.process_existing_emails, name='process_existing_emails'),
+
+    # Push notifications
+    path('webhooks/gmail/', views.gmail_push_webhook, name='gmail_push_webhook'),
+    path('webhooks/outlook/', views.outlook_push_webhook, name='outlook_push_webhook'),
 ]
\ No newline at end of file
@@ -1,23 +1,29 @@
+import json
 import logging
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.models import User
-from django.http import JsonResponse
-from django.utils import timezone
+from django.http import JsonResponse, HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.conf import settings
 from django.db.models import Q
-from .gmail_service import GmailService
+from . import client_cache
+from .gmail_service import GmailService, ensure_email_body
 from .outlook_service import OutlookService
-from .models import Email, EmailAccount, GmailAccount
-from .exceptions import (
-    RefreshTokenInvalidError, OAuthError, GmailAPIError,
-    QuotaExceededError, PermissionError
-)
+from .models import Email, EmailAccount, GmailAccount, Job
+from .exceptions import OAuthError
 from .ai_models import AIRole, TemporalRule, EmailIntent, AIResponse
-from .ai_service import EmailAIProcessor
 from .forms import UserRegistrationForm, UserLoginForm
+from .jobs import PRIORITY_HIGH
+from .outbox import queue_send
+from .tasks import enqueue_account_sync, enqueue_email_processing
+from .push import (
+    verify_push_token, parse_gmail_notification, handle_gmail_notification, handle_outlook_notifications
+)
 
 logger = logging.getLogger('gmail_app')
 
@@ -182,6 +188,13 @@ def gmail_callback(request):
         gmail_service = GmailService(request.user)
         gmail_account = gmail_service.handle_oauth_callback(request)
         messages.success(request, f'✅ Gmail account {gmail_account.email} connected successfully!')
+
+        # Start push notifications right away (renewed later by renew_mail_watches)
+        if getattr(settings, 'GMAIL_PUBSUB_TOPIC', ''):
+            try:
+                gmail_service.watch_mailbox()
+            except Exception as e:
+                logger.warning(f"Could not register Gmail watch for {gmail_account.email}: {e}")
         messages.info(request, '📥 Ready to sync your emails! Click "Sync Now" to start.')
         return redirect('dashboard')
     except OAuthError as e:
@@ -233,100 +246,47 @@ def sync_emails(request):
 
 @login_required
 def sync_emails_api(request):
-    """API endpoint for email synchronization"""
-    try:
-        logger.info(f"User {request.user.username} initiated email sync")
-        gmail_service = GmailService(request.user)
-        synced_emails = gmail_service.sync_emails()
-
-        # Check if user has AI processing enabled
-        try:
-            # Get active AIRole
-            ai_context = AIRole.get_active_role(request.user)
-
-            if ai_context and synced_emails:
-                # Process new emails with AI
-                ai_processor = EmailAIProcessor()
-                processed_count = 0
-                responses_generated = 0
-
-                for email in synced_emails:
-                    try:
-                        intent, ai_response = ai_processor.process_email(email)
-                        processed_count += 1
-
-                        if ai_response:
-                            responses_generated += 1
-
-                    except Exception as e:
-                        logger.error(f"Error processing email {email.id} with AI: {e}")
-
-                return JsonResponse({
-                    'success': True,
-                    'synced': len(synced_emails),
-                    'ai_processed': processed_count,
-                    'ai_responses': responses_generated,
-                    'message': f'✅ Synced {len(synced_emails)} emails successfully!',
-                    'ai_enabled': True
-                })
-            else:
-                return JsonResponse({
-                    'success': True,
-                    'synced': len(synced_emails),
-                    'message': f'✅ Synced {len(synced_emails)} new emails successfully!',
-                    'ai_enabled': False
-                })
-
-        except Exception as e:
-            logger.error(f"Error getting AI context for user {request.user.username}: {e}")
-            return JsonResponse({
-                'success': True,
-                'synced': len(synced_emails),
-                'message': f'✅ Synced {len(synced_emails)} new emails successfully!',
-                'ai_enabled': False
-            })
-
-    except RefreshTokenInvalidError as e:
-        logger.warning(f"Token expired for user {request.user.username}: {e}")
-        # Delete the expired account to force reconnection
-        try:
-            GmailAccount.objects.get(user=request.user).delete()
-        except GmailAccount.DoesNotExist:
-            pass
-        return JsonResponse({
-            'success': False,
-            'error': 'token_expired',
-            'message': '⚠️ Your Gmail access has expired. Please reconnect your account.'
-        })
-    except QuotaExceededError as e:
-        logger.error(f"Gmail API quota exceeded for user {request.user.username}: {e}")
-        return JsonResponse({
-            'success': False,
-            'error': 'quota_exceeded',
-            'message': '⏳ Gmail API quota exceeded. Please try again in a few minutes.'
-        })
-    except PermissionError as e:
-        logger.error(f"Permission error for user {request.user.username}: {e}")
-        return JsonResponse({
-            'success': False,
-            'error': 'permission_error',
-            'message': '🔒 Insufficient permissions. Please reconnect your account.'
-        })
-    except GmailAPIError as e:
-        logger.error(f"Gmail API error for user {request.user.username}: {e}")
-        return JsonResponse({
-            'success': False,
-            'error': 'api_error',
-            'message': f'📧 Gmail service error: {str(e)}. Please try again later.'
-        })
-    except Exception as e:
-        logger.error(f"Unexpected error during sync for user {request.user.username}: {e}")
+    """
+    API endpoint for email synchronization: queues a sync of the Gmail account and returns
+    the job to poll (job_status)
+    """
+    account = EmailAccount.objects.filter(user=request.user, provider='gmail', is_active=True).first()
+    if not account:
         return JsonResponse({
             'success': False,
-            'error': 'unexpected_error',
-            'message': f'❌ Unexpected error occurred: {str(e)}.'
+            'error': 'no_account',
+            'message': '⚠️ No Gmail account connected. Please connect your account.'
         })
 
+    logger.info(f"User {request.user.username} initiated email sync")
+    job = enqueue_account_sync(account, priority=PRIORITY_HIGH)
+    return JsonResponse({
+        'success': True,
+        'queued': True,
+        'job_id': job.id,
+        'status_url': reverse('job_status', args=[job.id]),
+        'ai_enabled': AIRole.get_active_role(request.user) is not None
+    })
+
+
+@login_required
+def job_status(request, job_id):
+    """API endpoint with the state and result of one of the user's background jobs"""
+    try:
+        job = Job.objects.get(id=job_id, user=request.user)
+    except Job.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'not_found'}, status=404)
+
+    return JsonResponse({
+        'success': True,
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'result': job.result,
+        'error': job.last_error
+    })
+
 
 @login_required
 def email_detail(request, email_id):
@@ -347,6 +307,9 @@ def email_detail(request, email_id):
             messages.error(request, 'Email not found')
             return redirect('dashboard')
 
+    # Metadata-only syncs load the body the first time the email is opened
+    ensure_email_body(email)
+
     return render(request, 'gmail_app/email_detail.html', {'email': email})
 
 
@@ -384,6 +347,12 @@ def disconnect_gmail(request):
         
         # Delete the Gmail account
         gmail_account.delete()
+
+        # Cached tokens/clients of the same mailbox are read again from the database
+        for account_id in EmailAccount.objects.filter(
+            user=request.user, provider='gmail', email=email
+        ).values_list('id', flat=True):
+            client_cache.invalidate(account_id)
         
         logger.info(f"User {request.user.username} disconnected Gmail account {email}")
         messages.success(request, f'✅ Successfully disconnected Gmail account {email}')
@@ -533,7 +502,7 @@ def approve_response(request, response_id):
     """Approve and send AI response (allows retry for approved responses)"""
     from django.db.models import Q
     try:
-        # Accept both 'pending_approval' and 'approved' to allow retries
+        # Accept 'pending_approval', 'approved' and 'failed' to allow retries
         # Support both email_account and gmail_account
         ai_response = AIResponse.objects.get(
             Q(email_intent__email__gmail_account__user=request.user) |
@@ -541,8 +510,8 @@ def approve_response(request, response_id):
             id=response_id
         )
 
-        # Only allow pending or approved (not sent or rejected)
-        if ai_response.status not in ['pending_approval', 'approved']:
+        # Only allow pending, approved or failed (not sent or rejected)
+        if ai_response.status not in ['pending_approval', 'approved', 'failed']:
             messages.warning(
                 request,
                 f'Esta respuesta ya fue {ai_response.get_status_display()}. No se puede enviar de nuevo desde aqui.'
@@ -551,50 +520,12 @@ def approve_response(request, response_id):
 
         logger.info(f"User {request.user.username} attempting to send response {response_id} (current status: {ai_response.status})")
 
-        # Mark as approved first
-        ai_response.status = 'approved'
-        ai_response.approved_at = timezone.now()
-        ai_response.save()
-
-        # Try to send the email
-        try:
-            logger.info(f"Creating Gmail service for user {request.user.username}")
-            gmail_service = GmailService(request.user)
-
-            logger.info(f"Attempting to send email to {ai_response.email_intent.email.sender}")
-            logger.info(f"  Subject: {ai_response.response_subject}")
-            logger.info(f"  Reply to: {ai_response.email_intent.email.provider_id}")
-
-            sent_message_id = gmail_service.send_email(
-                to_email=ai_response.email_intent.email.sender,
-                subject=ai_response.response_subject,
-                body=ai_response.response_text,
-                reply_to_message_id=ai_response.email_intent.email.provider_id
-            )
-
-            logger.info(f"Email sent successfully! Message ID: {sent_message_id}")
-
-            # Update status to sent
-            ai_response.status = 'sent'
-            ai_response.sent_at = timezone.now()
-            ai_response.save()
-
-            messages.success(request, f'Correo enviado exitosamente a {ai_response.email_intent.email.sender}!')
-            logger.info(f"Email sent by user {request.user.username} to {ai_response.email_intent.email.sender}")
-
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"ERROR enviando email (response {response_id}): {error_msg}")
-            logger.exception("Stack trace completo:")  # Esto imprime el stack trace completo
-
-            messages.error(
-                request,
-                f'Error al enviar email: {error_msg}. La respuesta queda aprobada pero no enviada. Puedes intentar reenviarla desde el tab "Aprobadas".'
-            )
-
-            # Keep as approved but not sent
-            ai_response.status = 'approved'
-            ai_response.save()
+        # Approve and send in the background (the row becomes 'sent' when a worker delivers it)
+        queue_send(ai_response, request.user)
+        messages.success(
+            request,
+            f'Respuesta aprobada. Se enviará en unos segundos a {ai_response.email_intent.email.sender}.'
+        )
 
     except AIResponse.DoesNotExist:
         messages.error(request, 'Respuesta no encontrada o no tienes permiso para acceder a ella')
@@ -641,7 +572,7 @@ def resend_response(request, response_id):
     """Resend or send a previously sent/approved AI response"""
     from django.db.models import Q
     try:
-        # Accept both 'sent' and 'approved' statuses
+        # Accept 'sent', 'approved' and 'failed' statuses
         # Support both email_account and gmail_account
         ai_response = AIResponse.objects.get(
             Q(email_intent__email__gmail_account__user=request.user) |
@@ -649,37 +580,20 @@ def resend_response(request, response_id):
             id=response_id
         )
 
-        # Only allow resending for 'sent' or 'approved' responses
-        if ai_response.status not in ['sent', 'approved']:
+        # Only allow resending for 'sent', 'approved' or 'failed' responses
+        if ai_response.status not in ['sent', 'approved', 'failed']:
             messages.warning(
                 request,
                 f'⚠️ Solo puedes reenviar respuestas que fueron enviadas o aprobadas. Estado actual: {ai_response.get_status_display()}'
             )
             return redirect('ai_responses')
 
-        # Send the email
-        try:
-            logger.info(f"User {request.user.username} attempting to resend response {response_id} with status {ai_response.status}")
-
-            gmail_service = GmailService(request.user)
-            sent_message_id = gmail_service.send_email(
-                to_email=ai_response.email_intent.email.sender,
-                subject=ai_response.response_subject,
-                body=ai_response.response_text,
-                reply_to_message_id=ai_response.email_intent.email.provider_id
-            )
-
-            # Update status and timestamp
-            ai_response.status = 'sent'
-            ai_response.sent_at = timezone.now()
-            ai_response.save()
-
-            messages.success(request, f'📧 Respuesta enviada exitosamente a {ai_response.email_intent.email.sender}!')
-            logger.info(f"Email resent by user {request.user.username} to {ai_response.email_intent.email.sender}")
+        logger.info(f"User {request.user.username} queued resend of response {response_id} (status {ai_response.status})")
 
-        except Exception as e:
-            logger.error(f"Error resending response {response_id}: {e}")
-            messages.error(request, f'❌ Error al enviar email: {str(e)}. Por favor verifica tu conexión con Gmail.')
+        # A sent response is a deliberate second send (new Message-ID); an approved or failed one
+        # is retried with its own, so it is never delivered twice
+        queue_send(ai_response, request.user, resend=ai_response.status == 'sent')
+        messages.success(request, f'📧 Respuesta en cola de envío a {ai_response.email_intent.email.sender}.')
 
     except AIResponse.DoesNotExist:
         messages.error(request, '❌ Respuesta no encontrada o no tienes permiso para acceder a ella')
@@ -693,51 +607,28 @@ def resend_response(request, response_id):
 
 @login_required
 def process_existing_emails(request):
-    """Process existing emails with AI"""
+    """Queue the AI processing of existing emails"""
     try:
         # Get active AIRole
-        ai_role = AIRole.objects.get(user=request.user, is_active=True)
+        AIRole.objects.get(user=request.user, is_active=True)
 
-        # Get emails that haven't been processed by AI yet
-        unprocessed_emails = Email.objects.filter(
+        has_unprocessed = Email.objects.filter(
             Q(email_account__user=request.user) | Q(gmail_account__user=request.user)
         ).exclude(
             id__in=EmailIntent.objects.values('email_id')
-        )[:10]  # Process max 10 emails at once to avoid timeout
+        ).exists()
 
-        if not unprocessed_emails:
+        if not has_unprocessed:
             messages.info(request, 'ℹ️ No unprocessed emails found. All emails have been analyzed by AI.')
             return redirect('ai_responses')
 
-        ai_processor = EmailAIProcessor()
-        processed_count = 0
-        responses_generated = 0
-
-        logger.info(f"Processing {len(unprocessed_emails)} existing emails for user {request.user.username}")
-
-        for email in unprocessed_emails:
-            try:
-                intent, ai_response = ai_processor.process_email(email)
-                processed_count += 1
-
-                if ai_response:
-                    responses_generated += 1
-
-            except Exception as e:
-                logger.error(f"Error processing existing email {email.id} with AI: {e}")
-
-        if responses_generated > 0:
-            messages.success(request,
-                f'🤖 Processed {processed_count} existing emails! AI generated {responses_generated} responses.')
-            messages.info(request,
-                f'📤 {responses_generated} responses are pending your approval.')
-        else:
-            messages.success(request,
-                f'🤖 Analyzed {processed_count} existing emails. None required responses.')
-
-        if len(unprocessed_emails) == 10:
-            messages.info(request,
-                f'💡 There might be more emails to process. Click "Process More" to continue.')
+        enqueue_email_processing(request.user)
+        logger.info(f"Queued processing of existing emails for user {request.user.username}")
+        messages.success(
+            request,
+            '🤖 Processing your existing emails in the background. '
+            'Responses will appear here for your approval in a few moments.'
+        )
 
     except AIRole.DoesNotExist:
         messages.error(request, '⚠️ Please create an active AI role first.')
@@ -777,6 +668,13 @@ def outlook_callback(request):
             request,
             f'✅ Outlook account {email_account.email} connected successfully!'
         )
+
+        # Start change notifications right away (renewed later by renew_mail_watches)
+        if getattr(settings, 'OUTLOOK_NOTIFICATION_URL', ''):
+            try:
+                outlook_service.subscribe_inbox(email_account.id)
+            except Exception as e:
+                logger.warning(f"Could not create Graph subscription for {email_account.email}: {e}")
         messages.info(request, '📥 Ready to sync your Outlook emails! Click "Sync Outlook" to start.')
         return redirect('dashboard')
         
@@ -895,72 +793,24 @@ def disconnect_email_account(request, account_id):
 
 @login_required
 def sync_all_accounts(request):
-    """Sync emails from ALL connected accounts (Gmail + Outlook)"""
+    """Queue a sync of ALL connected accounts (Gmail + Outlook); workers run them in the background"""
     try:
-        email_accounts = EmailAccount.objects.filter(user=request.user, is_active=True)
-        
-        if not email_accounts.exists():
+        email_accounts = list(EmailAccount.objects.filter(user=request.user, is_active=True).select_related('user'))
+
+        if not email_accounts:
             messages.warning(request, '⚠️ No email accounts connected. Please connect Gmail or Outlook first.')
             return redirect('dashboard')
-        
-        total_synced = 0
-        total_new = 0
-        total_updated = 0
-        errors = []
-        
-        # Sync Gmail accounts (now supports multiple accounts!)
-        gmail_accounts = email_accounts.filter(provider='gmail')
-        for account in gmail_accounts:
-            try:
-                gmail_service = GmailService(request.user)
-                # Now syncs specific Gmail account by ID (supports multiple)
-                synced_emails = gmail_service.sync_emails(email_account_id=account.id)
-                count = len(synced_emails) if synced_emails else 0
-                total_synced += count
-                total_new += count
-                logger.info(f"Synced {count} emails from Gmail account {account.email}")
-            except Exception as e:
-                error_msg = f"Gmail ({account.email}): {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Error syncing Gmail account {account.email}: {e}")
-        
-        # Sync Outlook accounts
-        outlook_accounts = email_accounts.filter(provider='outlook')
-        for account in outlook_accounts:
-            try:
-                outlook_service = OutlookService(request.user)
-                result = outlook_service.sync_emails(max_results=50)
-                total_synced += result['total_synced']
-                total_new += result['new_emails']
-                total_updated += result['updated_emails']
-                logger.info(
-                    f"Synced {result['total_synced']} emails from Outlook account {account.email}: "
-                    f"{result['new_emails']} new, {result['updated_emails']} updated"
-                )
-            except Exception as e:
-                error_msg = f"Outlook ({account.email}): {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Error syncing Outlook account {account.email}: {e}")
-        
-        # Show results
-        if total_synced > 0:
-            messages.success(
-                request,
-                f'✅ Synced {total_synced} emails from {email_accounts.count()} account(s)! '
-                f'({total_new} new, {total_updated} updated)'
-            )
-        else:
-            messages.info(request, 'ℹ️ No new emails to sync')
-        
-        if errors:
-            for error in errors:
-                messages.warning(request, f'⚠️ {error}')
-        
-        logger.info(
-            f"Sync all complete for {request.user.username}: "
-            f"{total_synced} total, {total_new} new, {total_updated} updated"
+
+        for account in email_accounts:
+            enqueue_account_sync(account, priority=PRIORITY_HIGH)
+
+        messages.success(
+            request,
+            f'🔄 Syncing {len(email_accounts)} account(s) in the background. '
+            f'New emails will appear in a few moments.'
         )
-        
+        logger.info(f"Sync all queued for {request.user.username}: {len(email_accounts)} accounts")
+
     except Exception as e:
         logger.error(f"Error syncing all accounts for user {request.user.username}: {e}")
         messages.error(request, f'❌ Error syncing accounts: {str(e)}')
@@ -1323,3 +1173,50 @@ def get_all_emails_with_ai_status(request):
             'success': False,
             'error': str(e)
         }, status=400)
+
+
+# ========== PUSH NOTIFICATION WEBHOOKS ==========
+
+@csrf_exempt
+@require_POST
+def gmail_push_webhook(request):
+    """
+    Receive Gmail push notifications from a Cloud Pub/Sub push subscription
+    (endpoint: /webhooks/gmail/?token=<PUSH_VERIFICATION_TOKEN>)
+    """
+    if not verify_push_token(request.GET.get('token')):
+        logger.warning("Rejected Gmail push notification with an invalid token")
+        return HttpResponse(status=403)
+
+    try:
+        notification = parse_gmail_notification(request.body)
+    except (ValueError, KeyError, TypeError) as e:
+        # Acknowledge anyway: Pub/Sub would redeliver a malformed message forever
+        logger.warning(f"Ignoring malformed Gmail push notification: {e}")
+        return HttpResponse(status=204)
+
+    handle_gmail_notification(notification)
+    return HttpResponse(status=204)
+
+
+@csrf_exempt
+@require_POST
+def outlook_push_webhook(request):
+    """
+    Receive Microsoft Graph change notifications for new inbox messages
+    (each notification is authenticated by the clientState of its subscription)
+    """
+    # Subscription validation: echo the token as plain text within 10 seconds
+    validation_token = request.GET.get('validationToken')
+    if validation_token is not None:
+        return HttpResponse(validation_token, content_type='text/plain')
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError as e:
+        logger.warning(f"Ignoring malformed Graph notification: {e}")
+        return HttpResponse(status=202)
+
+    handle_outlook_notifications(payload)
+    # Graph expects 202 Accepted within 3 seconds; the work runs in the background
+    return HttpResponse(status=202)